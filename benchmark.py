@@ -0,0 +1,608 @@
+# Benchmark bota bez sieci - lokalne atrapy API Notion i Airtable (opóźnienia,
+# limity zapytań, wstrzykiwane błędy 429/5xx) i syntetyczne aktualizacje
+# Telegrama przepuszczane przez procesor aktualizacji aplikacji (kolejność
+# w obrębie czatu, limit MAX_CONCURRENT_UPDATES) tak jak przy pollingu.
+# /setbudget to pełny przebieg: komenda, wybór kategorii z klawiatury,
+# wiadomość z kwotą i - gdy bot pyta o nadpisanie - przycisk "Tak".
+#
+# Przykład: python benchmark.py --users 20 --requests 50 --latency 0.08 --json wynik.json
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import time
+import uuid
+from datetime import datetime, timezone
+from urllib.parse import parse_qs, urlsplit
+
+# Benchmark nigdy nie dotyka prawdziwej bazy ani kluczy
+os.environ["BUDGET_DB_PATH"] = os.environ.get("BENCHMARK_DB_PATH", ":memory:")
+for name in ("TELEGRAM_TOKEN", "NOTION_API_TOKEN", "AIRTABLE_TOKEN"):
+    os.environ.setdefault(name, "benchmark")
+os.environ.setdefault("AIRTABLE_BASE_ID", "appBenchmark")
+
+from telegram import Update  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+import main as bot  # noqa: E402
+
+COMMANDS = ("add", "setbudget", "getcategories")
+
+
+def _now():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class FakeServer:
+    # Minimalny serwer HTTP/1.1 z keep-alive; opóźnienie, limit zapytań
+    # (token bucket) i losowe błędy są wspólne dla wszystkich ścieżek
+    def __init__(self, latency=0.0, jitter=0.0, rate_limit=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.tokens = max(1.0, rate_limit)
+        self.updated_at = time.monotonic()
+        self.stats = {"requests": 0, "throttled": 0, "errors": 0}
+        self.server = None
+        self._connections = {}
+
+    @property
+    def url(self):
+        host, port = self.server.sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+        return self
+
+    async def stop(self):
+        # Otwarte połączenia keep-alive zamykane przed zatrzymaniem serwera
+        for writer in self._connections:
+            writer.close()
+        if self._connections:
+            await asyncio.wait(list(self._connections.values()), timeout=1)
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        self._connections[writer] = asyncio.current_task()
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode().strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                raw = await reader.readexactly(length) if length else b""
+                status, extra, body = await self._respond(method, target, raw)
+                payload = json.dumps(body).encode()
+                head = [
+                    f"HTTP/1.1 {status} X",
+                    "Content-Type: application/json",
+                    f"Content-Length: {len(payload)}",
+                    *(f"{k}: {v}" for k, v in extra.items()),
+                ]
+                writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + payload)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._connections.pop(writer, None)
+            writer.close()
+
+    async def _respond(self, method, target, raw):
+        self.stats["requests"] += 1
+        await asyncio.sleep(self.latency + self.random.uniform(0, self.jitter))
+        if self.rate_limit:
+            now = time.monotonic()
+            self.tokens = min(
+                max(1.0, self.rate_limit),
+                self.tokens + (now - self.updated_at) * self.rate_limit,
+            )
+            self.updated_at = now
+            if self.tokens < 1:
+                self.stats["throttled"] += 1
+                retry_after = (1 - self.tokens) / self.rate_limit
+                return 429, {"Retry-After": f"{retry_after:.3f}"}, {}
+            self.tokens -= 1
+        if self.random.random() < self.error_rate:
+            self.stats["errors"] += 1
+            return 502, {}, {"message": "injected error"}
+        parts = urlsplit(target)
+        query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        data = json.loads(raw) if raw else {}
+        status, body = self.route(method, parts.path, query, data)
+        return status, {}, body
+
+    def route(self, method, path, query, data):
+        raise NotImplementedError
+
+
+def _notion_text(items):
+    return "".join(
+        item.get("plain_text") or item.get("text", {}).get("content", "")
+        for item in items or []
+    )
+
+
+def _notion_matches(page, condition):
+    if not condition:
+        return True
+    if "and" in condition:
+        return all(_notion_matches(page, c) for c in condition["and"])
+    if "or" in condition:
+        return any(_notion_matches(page, c) for c in condition["or"])
+    if "timestamp" in condition:
+        value, checks = page[condition["timestamp"]], condition[condition["timestamp"]]
+    else:
+        prop = page["properties"].get(condition.get("property"), {})
+        if "title" in condition:
+            value, checks = _notion_text(prop.get("title")), condition["title"]
+        elif "date" in condition:
+            value = ((prop.get("date") or {}).get("start") or "")[:10]
+            checks = condition["date"]
+        else:
+            return True
+    for operator, expected in checks.items():
+        expected = expected[:10] if "date" in condition else expected
+        if operator == "equals" and value != expected:
+            return False
+        if operator == "on_or_after" and not value >= expected:
+            return False
+        if operator == "on_or_before" and not value <= expected:
+            return False
+    return True
+
+
+class FakeNotion(FakeServer):
+    def __init__(self, **options):
+        super().__init__(**options)
+        self.databases = {}
+        self.pages = {}
+
+    def add_page(self, database_id, properties):
+        now = _now()
+        page = {
+            "object": "page",
+            "id": str(uuid.uuid4()),
+            "created_time": now,
+            "last_edited_time": now,
+            "archived": False,
+            "properties": properties,
+        }
+        self.databases.setdefault(database_id, []).append(page)
+        self.pages[page["id"]] = page
+        return page
+
+    def route(self, method, path, query, data):
+        parts = path.strip("/").split("/")[1:]
+        if method == "POST" and parts[0] == "databases" and parts[-1] == "query":
+            pages = [
+                page
+                for page in self.databases.get(parts[1], [])
+                if _notion_matches(page, data.get("filter"))
+            ]
+            start = int(data.get("start_cursor") or 0)
+            end = start + data.get("page_size", 100)
+            more = end < len(pages)
+            return 200, {
+                "object": "list",
+                "results": pages[start:end],
+                "has_more": more,
+                "next_cursor": str(end) if more else None,
+            }
+        if method == "POST" and parts == ["pages"]:
+            page = self.add_page(data["parent"]["database_id"], data["properties"])
+            return 200, page
+        if method == "PATCH" and parts[0] == "pages":
+            page = self.pages.get(parts[1])
+            if page is None:
+                return 404, {"object": "error", "code": "object_not_found"}
+            page["properties"].update(data.get("properties", {}))
+            page["last_edited_time"] = _now()
+            return 200, page
+        return 404, {"object": "error", "code": "invalid_request_url"}
+
+
+def _airtable_matches(fields, formula):
+    if not formula:
+        return True
+    for name, value in re.findall(r"\{?(\w+)\}?\s*=\s*'([^']*)'", formula):
+        if str(fields.get(name)) != value:
+            return False
+    after = re.search(r"NOT\(IS_BEFORE\(\{(\w+)\}, '([^']*)'\)\)", formula)
+    if after and fields.get(after.group(1), "") < after.group(2):
+        return False
+    before = re.search(r"NOT\(IS_AFTER\(\{(\w+)\}, '([^']*)'\)\)", formula)
+    if before and fields.get(before.group(1), "") > before.group(2):
+        return False
+    return True
+
+
+class FakeAirtable(FakeServer):
+    def __init__(self, **options):
+        super().__init__(**options)
+        self.tables = {}
+
+    def add_record(self, table, fields):
+        record = {"id": f"rec{uuid.uuid4().hex[:14]}", "createdTime": _now()}
+        record["fields"] = dict(fields)
+        self.tables.setdefault(table, {})[record["id"]] = record
+        return record
+
+    def _update(self, table, record_id, fields):
+        record = self.tables.get(table, {}).get(record_id)
+        if record is not None:
+            record["fields"].update(fields)
+        return record
+
+    def route(self, method, path, query, data):
+        # /v0/{baza}/{tabela}[/{rekord}|/listRecords]
+        parts = path.strip("/").split("/")[2:]
+        table = parts[0]
+        if method == "GET" or parts[-1] == "listRecords":
+            options = {**query, **data}
+            formula = options.get("filterByFormula")
+            records = [
+                record
+                for record in self.tables.get(table, {}).values()
+                if _airtable_matches(record["fields"], formula)
+            ]
+            start = int(options.get("offset") or 0)
+            end = start + int(options.get("pageSize") or 100)
+            body = {"records": records[start:end]}
+            if end < len(records):
+                body["offset"] = str(end)
+            return 200, body
+        if method == "POST":
+            if "records" in data:
+                created = [self.add_record(table, r["fields"]) for r in data["records"]]
+                return 200, {"records": created}
+            return 200, self.add_record(table, data["fields"])
+        if method == "PATCH" and len(parts) > 1:
+            record = self._update(table, parts[1], data["fields"])
+            return (200, record) if record else (404, {"error": "NOT_FOUND"})
+        if method == "PATCH":
+            updated = [
+                self._update(table, r["id"], r["fields"]) for r in data["records"]
+            ]
+            return 200, {"records": [r for r in updated if r is not None]}
+        return 404, {"error": "NOT_FOUND"}
+
+
+class FakeTelegramRequest(BaseRequest):
+    # Odpowiedzi Bot API bez sieci; zlicza wysłane wiadomości i pamięta
+    # przyciski ostatniej wiadomości w każdym czacie
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.sent = 0
+        self.buttons = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        endpoint = url.rsplit("/", 1)[-1]
+        parameters = request_data.parameters if request_data else {}
+        if endpoint == "getMe":
+            result = {
+                "id": 1,
+                "is_bot": True,
+                "first_name": "Benchmark",
+                "username": "benchmark_bot",
+            }
+        elif endpoint.startswith("send") or endpoint.startswith("edit"):
+            self.sent += 1
+            markup = parameters.get("reply_markup") or {}
+            self.buttons[int(parameters.get("chat_id", 1))] = [
+                button for row in markup.get("inline_keyboard", []) for button in row
+            ]
+            result = {
+                "message_id": self.sent,
+                "date": int(time.time()),
+                "chat": {"id": int(parameters.get("chat_id", 1)), "type": "private"},
+                "text": parameters.get("text", ""),
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def seed(notion, airtable, categories, month):
+    names = [f"Kategoria{index:02d}" for index in range(categories)]
+    for name in names:
+        notion.add_page(
+            bot.NOTION_BUDGET_DATABASE_ID,
+            {
+                "Kategoria": {"title": [{"text": {"content": name}}]},
+                "Miesiąc": {"date": {"start": f"{month}-01"}},
+                "Budżet": {"number": 1000},
+                "Pozostało": {"number": 1000},
+            },
+        )
+        airtable.add_record(
+            bot.AIRTABLE_BUDGET_TABLE,
+            {"Category": name, "Month": month, "Budget": 1000, "Remaining": 1000},
+        )
+    return names
+
+
+def _user(chat_id):
+    return {"id": chat_id, "is_bot": False, "first_name": "User"}
+
+
+def _message(update_id, chat_id, text):
+    return {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": _user(chat_id),
+        "text": text,
+    }
+
+
+def make_update(application, update_id, chat_id, text):
+    message = _message(update_id, chat_id, text)
+    if text.startswith("/"):
+        command = text.split()[0]
+        message["entities"] = [
+            {"type": "bot_command", "offset": 0, "length": len(command)}
+        ]
+    return Update.de_json({"update_id": update_id, "message": message}, application.bot)
+
+
+def make_callback_update(application, update_id, chat_id, data):
+    return Update.de_json(
+        {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": _user(chat_id),
+                "chat_instance": str(chat_id),
+                "data": data,
+                "message": _message(update_id, chat_id, ""),
+            },
+        },
+        application.bot,
+    )
+
+
+def command_text(command, rng, categories, month):
+    category = rng.choice(categories)
+    if command == "add":
+        return f"/add {category} Konto1 {rng.randint(1, 50)}.00 Benchmark"
+    return f"/{command}"
+
+
+def parse_mix(value):
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        if name not in COMMANDS:
+            raise argparse.ArgumentTypeError(f"nieznana komenda: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+async def run_benchmark(options):
+    server_options = {
+        "latency": options.latency,
+        "jitter": options.jitter,
+        "error_rate": options.error_rate,
+    }
+    notion = await FakeNotion(
+        rate_limit=options.notion_rate_limit, seed=options.seed, **server_options
+    ).start()
+    airtable = await FakeAirtable(
+        rate_limit=options.airtable_rate_limit, seed=options.seed + 1, **server_options
+    ).start()
+
+    # Bot kierowany na lokalne atrapy zamiast prawdziwych API
+    await bot.close_http_clients()
+    bot.NOTION_API_URL = f"{notion.url}/v1"
+    bot.AIRTABLE_ENDPOINT_URL = airtable.url
+    bot._airtable_api = None
+    bot.CACHE_WARMUP = options.warm_up
+    bot.ENABLED_BACKENDS = tuple(options.backends.split(","))
+    if options.client_rate_limit:
+        for name in bot.rate_limiters:
+            bot.rate_limiters[name] = bot.RateLimiter(options.client_rate_limit)
+    bot.category_cache.invalidate()
+    bot.airtable_budget_snapshot.invalidate()
+    bot.metrics.reset()
+
+    month = datetime.now().strftime("%Y-%m")
+    categories = seed(notion, airtable, options.categories, month)
+    telegram = FakeTelegramRequest(options.telegram_latency)
+    application = bot.build_application("1:benchmark", request=telegram)
+    commands, weights = zip(*options.mix.items())
+    latencies = {command: [] for command in commands}
+    update_ids = iter(range(1, 1 << 31))
+
+    async def dispatch(update):
+        # Procesor może odłożyć aktualizację za wcześniejszymi z tego czatu
+        # i wrócić od razu - koniec obsługi sygnalizuje dopiero future
+        done = asyncio.get_running_loop().create_future()
+
+        async def handle():
+            try:
+                await application.process_update(update)
+            finally:
+                done.set_result(None)
+
+        await application.update_processor.process_update(update, handle())
+        await done
+
+    def pressed(chat_id, text):
+        for button in telegram.buttons.get(chat_id, []):
+            if button["text"] == text:
+                return button["callback_data"]
+        return None
+
+    async def set_budget(chat_id, rng):
+        category = rng.choice(categories)
+        await dispatch(
+            make_update(application, next(update_ids), chat_id, "/setbudget")
+        )
+        # Klawiatura jest stronicowana - "»" aż do strony z kategorią
+        for _ in range(len(categories)):
+            data = pressed(chat_id, category) or pressed(chat_id, "»")
+            if data is None:
+                return
+            update = make_callback_update(application, next(update_ids), chat_id, data)
+            await dispatch(update)
+            if data.split(":")[-1].isdigit():
+                break
+        text = f"{rng.randint(500, 1500)} {month}"
+        await dispatch(make_update(application, next(update_ids), chat_id, text))
+        if pressed(chat_id, "Tak") is not None:
+            update = make_callback_update(application, next(update_ids), chat_id, "yes")
+            await dispatch(update)
+
+    async def user(chat_id):
+        # Osobne ziarno na czat - ta sama sekwencja komend niezależnie od przeplotu
+        rng = random.Random(options.seed * 100003 + chat_id)
+        for _ in range(options.requests):
+            command = rng.choices(commands, weights)[0]
+            if options.cold_cache:
+                bot.category_cache.invalidate()
+            started = time.perf_counter()
+            if command == "setbudget":
+                await set_budget(chat_id, rng)
+            else:
+                text = command_text(command, rng, categories, month)
+                await dispatch(
+                    make_update(application, next(update_ids), chat_id, text)
+                )
+            latencies[command].append(time.perf_counter() - started)
+
+    async with application:
+        await application.start()
+        started = time.perf_counter()
+        await asyncio.gather(*(user(1000 + index) for index in range(options.users)))
+        elapsed = time.perf_counter() - started
+        # Czas opróżnienia kolejki zapisów po ostatniej odpowiedzi
+        drain_started = time.perf_counter()
+        deadline = drain_started + options.drain_timeout
+        while bot.pending_outbox_count() and time.perf_counter() < deadline:
+            await bot.flush_outbox()
+            await asyncio.sleep(0.05)
+        drain = time.perf_counter() - drain_started
+        await application.stop()
+    await bot.close_http_clients()
+    await notion.stop()
+    await airtable.stop()
+
+    # Identyfikatory są kolejne - /setbudget to kilka aktualizacji
+    total = next(update_ids) - 1
+    return {
+        "config": {key: value for key, value in vars(options).items() if key != "json"},
+        "elapsed": round(elapsed, 4),
+        "updates": total,
+        "throughput": round(total / elapsed, 2) if elapsed else 0.0,
+        "replies": telegram.sent,
+        "outbox_drain": round(drain, 4),
+        "outbox_pending": bot.pending_outbox_count(),
+        "commands": {
+            command: {
+                "count": len(values),
+                "p50_ms": round(percentile(values, 0.5) * 1000, 2),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+                "max_ms": round(max(values, default=0) * 1000, 2),
+            }
+            for command, values in latencies.items()
+        },
+        "servers": {"notion": notion.stats, "airtable": airtable.stats},
+    }
+
+
+def format_results(results):
+    lines = [f"{'komenda':<15}{'liczba':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}"]
+    for command, stats in results["commands"].items():
+        lines.append(
+            f"{command:<15}{stats['count']:>8}{stats['p50_ms']:>10.2f}"
+            f"{stats['p99_ms']:>10.2f}{stats['max_ms']:>10.2f}"
+        )
+    lines.append(
+        f"\nprzepustowość: {results['throughput']} aktualizacji/s"
+        f" ({results['elapsed']} s), odpowiedzi: {results['replies']}"
+    )
+    lines.append(
+        f"opróżnienie kolejki zapisów: {results['outbox_drain']} s,"
+        f" pozostało: {results['outbox_pending']}"
+    )
+    for name, stats in results["servers"].items():
+        lines.append(f"{name}: {stats}")
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark bota budżetowego")
+    parser.add_argument("--users", type=int, default=10, help="równoległe czaty")
+    parser.add_argument("--requests", type=int, default=20, help="aktualizacje na czat")
+    parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        default=parse_mix("add=6,setbudget=2,getcategories=2"),
+        help="wagi komend, np. add=6,setbudget=2,getcategories=2",
+    )
+    parser.add_argument("--categories", type=int, default=8)
+    parser.add_argument("--backends", default="notion")
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="opóźnienie atrap API w s"
+    )
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="odsetek odpowiedzi 502"
+    )
+    parser.add_argument(
+        "--notion-rate-limit", type=float, default=0.0, help="zapytań/s, 0 = bez"
+    )
+    parser.add_argument("--airtable-rate-limit", type=float, default=0.0)
+    parser.add_argument(
+        "--client-rate-limit",
+        type=float,
+        default=0.0,
+        help="nadpisuje limiter bota (zapytań/s na backend)",
+    )
+    parser.add_argument("--telegram-latency", type=float, default=0.0)
+    parser.add_argument("--cold-cache", action="store_true", help="bez cache kategorii")
+    parser.add_argument(
+        "--warm-up", action="store_true", help="rozgrzewanie cache przy starcie"
+    )
+    parser.add_argument("--drain-timeout", type=float, default=60.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="zapisz wyniki do pliku JSON")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    options = parse_args()
+    results = asyncio.run(run_benchmark(options))
+    print(format_results(results))
+    if options.json:
+        with open(options.json, "w") as output:
+            json.dump(results, output, indent=2, ensure_ascii=False)
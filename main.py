@@ -1,44 +1,1312 @@
+import asyncio
+import bisect
+import calendar
+import contextvars
+import csv
+import functools
+import gzip
+import hashlib
+import io
+import json
+import logging
+import random
+import sqlite3
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque, namedtuple
+from contextlib import aclosing
+import httpx
 import requests
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     filters,
     CallbackContext,
     CallbackQueryHandler,
+    TypeHandler,
 )
-from datetime import datetime
+from datetime import datetime, time as dt_time, timedelta
 import os
 from pyairtable import Api
+from pyairtable.formulas import match
+
+logger = logging.getLogger(__name__)
 
 # Notion API configuration
-NOTION_API_TOKEN = os.environ["NOTION_API_TOKEN"]
 NOTION_EXPENSES_DATABASE_ID = "e01498b500854922bde3d422ee7c5ecd"
 NOTION_BUDGET_DATABASE_ID = "27197324ba6043ad83c9529741de465e"
-AIRTABLE_BASE_ID = os.environ["AIRTABLE_BASE_ID"]
-AIRTABLE_API_KEY = os.environ["AIRTABLE_TOKEN"]
 AIRTABLE_EXPENSES_TABLE = "Expenses"
 AIRTABLE_BUDGET_TABLE = "BudgetData"
 
-AIRTABLE_API_URL = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}"
+AIRTABLE_ENDPOINT_URL = "https://api.airtable.com"
+NOTION_API_URL = "https://api.notion.com/v1"
+NOTION_API_VERSION = "2022-06-28"
+
+# Zmienne środowiskowe z kluczami są czytane dopiero przy pierwszym użyciu
+# backendu - import modułu nie wymaga konfiguracji ani nie łączy się z API
+BACKEND_REQUIRED_ENV = {
+    "telegram": ("TELEGRAM_TOKEN",),
+    "notion": ("NOTION_API_TOKEN",),
+    "airtable": ("AIRTABLE_BASE_ID", "AIRTABLE_TOKEN"),
+}
+
+
+def get_env(name):
+    value = os.environ.get(name)
+    if not value:
+        raise RuntimeError(f"Missing required environment variable {name}")
+    return value
+
+
+def missing_env(backends):
+    return [
+        name
+        for backend in backends
+        for name in BACKEND_REQUIRED_ENV.get(backend, ())
+        if not os.environ.get(name)
+    ]
+
+
+# Konfiguracja wspólnych klientów HTTP (jedna pula połączeń na backend)
+HTTP_TIMEOUT = httpx.Timeout(
+    float(os.environ.get("HTTP_TIMEOUT", "10")),
+    connect=float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5")),
+)
+HTTP_LIMITS = httpx.Limits(
+    max_connections=20, max_keepalive_connections=10, keepalive_expiry=30.0
+)
+_airtable_api = None
+
+
+def get_airtable_api():
+    global _airtable_api
+    if _airtable_api is None:
+        _airtable_api = Api(
+            get_env("AIRTABLE_TOKEN"),
+            timeout=(HTTP_TIMEOUT.connect, HTTP_TIMEOUT.read),
+            endpoint_url=AIRTABLE_ENDPOINT_URL,
+        )
+    return _airtable_api
+
+
+try:
+    import h2  # noqa: F401
+
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+_http_clients = {}
+
+
+def _backend_settings(backend):
+    if backend == "notion":
+        return NOTION_API_URL, {
+            "Authorization": f"Bearer {get_env('NOTION_API_TOKEN')}",
+            "Content-Type": "application/json",
+            "Notion-Version": NOTION_API_VERSION,
+        }
+    if backend == "airtable":
+        return f"{AIRTABLE_ENDPOINT_URL}/v0/{get_env('AIRTABLE_BASE_ID')}", {
+            "Authorization": f"Bearer {get_env('AIRTABLE_TOKEN')}",
+            "Content-Type": "application/json",
+        }
+    raise ValueError(f"Unknown backend: {backend}")
+
+
+def get_http_client(backend):
+    client = _http_clients.get(backend)
+    if client is None or client.is_closed:
+        base_url, backend_headers = _backend_settings(backend)
+        client = httpx.AsyncClient(
+            base_url=base_url,
+            headers=backend_headers,
+            timeout=HTTP_TIMEOUT,
+            limits=HTTP_LIMITS,
+            http2=HTTP2_AVAILABLE,
+        )
+        _http_clients[backend] = client
+    return client
+
+
+async def close_http_clients(application=None):
+    clients = list(_http_clients.values())
+    _http_clients.clear()
+    await asyncio.gather(*(client.aclose() for client in clients))
+
+
+# Metryki - histogramy opóźnień o stałych przedziałach trzymane w pamięci;
+# pomiar to jeden odczyt zegara i kilka operacji na słowniku
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+ADMIN_CHAT_IDS = {
+    int(chat_id)
+    for chat_id in os.environ.get("ADMIN_CHAT_IDS", "").split(",")
+    if chat_id.strip()
+}
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        # Górna granica przedziału, w którym wypada kwantyl
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+    def __init__(self):
+        self.histograms = {}
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(labels.items()))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = LatencyHistogram()
+        histogram.observe(seconds)
+
+    def series(self, name):
+        for (series_name, labels), histogram in sorted(
+            self.histograms.items(), key=lambda item: str(item[0])
+        ):
+            if series_name == name:
+                yield dict(labels), histogram
+
+    def render(self):
+        # Format tekstowy Prometheus
+        lines = []
+        for name in sorted({name for name, _ in self.histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in self.series(name):
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                cumulative = 0
+                for bound, count in zip((*LATENCY_BUCKETS, "+Inf"), histogram.buckets):
+                    cumulative += count
+                    lines.append(
+                        f'{name}_bucket{{{label_text},le="{bound}"}} {cumulative}'
+                    )
+                lines.append(f"{name}_sum{{{label_text}}} {histogram.sum:.6f}")
+                lines.append(f"{name}_count{{{label_text}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        self.histograms.clear()
+
+
+metrics = Metrics()
+
+
+def endpoint_label(path):
+    # Identyfikatory stron/rekordów zastąpione stałą, żeby etykiet było niewiele
+    return "/".join(
+        ":id" if len(part) >= 15 and any(c.isdigit() for c in part) else part
+        for part in path.split("?")[0].split("/")
+    )
+
 
-headers = {
-    "Authorization": f"Bearer {AIRTABLE_API_KEY}",
-    "Content-Type": "application/json",
+def instrument_handler(callback):
+    name = getattr(callback, "__name__", repr(callback))
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            status = "stopped"
+            raise
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            metrics.observe(
+                "handler_seconds",
+                time.perf_counter() - started,
+                handler=name,
+                status=status,
+            )
+
+    return wrapper
+
+
+async def _serve_metrics(reader, writer):
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        body = metrics.render().encode()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/plain; version=0.0.4\r\n"
+            b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+            b"Connection: close\r\n\r\n" + body
+        )
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, OSError):
+        pass
+    finally:
+        writer.close()
+
+
+_metrics_server = None
+
+
+async def start_metrics_server(application=None):
+    global _metrics_server
+    if METRICS_PORT and _metrics_server is None:
+        _metrics_server = await asyncio.start_server(
+            _serve_metrics, METRICS_HOST, METRICS_PORT
+        )
+        logger.info("Metrics available on %s:%s", METRICS_HOST, METRICS_PORT)
+
+
+async def stop_metrics_server(application=None):
+    global _metrics_server
+    if _metrics_server is not None:
+        _metrics_server.close()
+        await _metrics_server.wait_closed()
+        _metrics_server = None
+
+
+def format_stats():
+    lines = ["Handlery (liczba, błędy, p50/p95 ms):"]
+    handlers = {}
+    for labels, histogram in metrics.series("handler_seconds"):
+        handlers.setdefault(labels["handler"], []).append((labels, histogram))
+    for name, series in sorted(handlers.items()):
+        merged = LatencyHistogram()
+        errors = 0
+        for labels, histogram in series:
+            merged.buckets = [a + b for a, b in zip(merged.buckets, histogram.buckets)]
+            merged.count += histogram.count
+            merged.max = max(merged.max, histogram.max)
+            if labels["status"] == "error":
+                errors += histogram.count
+        lines.append(
+            f"{name}: {merged.count}, {errors}, "
+            f"{merged.quantile(0.5) * 1000:.0f}/{merged.quantile(0.95) * 1000:.0f}"
+        )
+    lines.append("\nZapytania do backendów (liczba, p50/p95 ms):")
+    for labels, histogram in metrics.series("upstream_request_seconds"):
+        lines.append(
+            f"{labels['backend']} {labels['method']} {labels['endpoint']}"
+            f" [{labels['status']}]: {histogram.count}, "
+            f"{histogram.quantile(0.5) * 1000:.0f}/"
+            f"{histogram.quantile(0.95) * 1000:.0f}"
+        )
+    lines.append("\nLimitery:")
+    lines += [f"{name}: {limiter.stats()}" for name, limiter in rate_limiters.items()]
+    lines.append("\nWyłączniki obwodu:")
+    lines += [
+        f"{name}: {breaker.stats()}" for name, breaker in circuit_breakers.items()
+    ]
+    lines.append(f"Zdublowane odczyty: {hedged_reads}")
+    return "\n".join(lines)
+
+
+# Limity zapytań: Notion ~3 zapytania/s na integrację, Airtable 5 zapytań/s na bazę
+NOTION_RATE_LIMIT = float(os.environ.get("NOTION_RATE_LIMIT", "3"))
+AIRTABLE_RATE_LIMIT = float(os.environ.get("AIRTABLE_RATE_LIMIT", "5"))
+HTTP_MAX_RETRIES = int(os.environ.get("HTTP_MAX_RETRIES", "5"))
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30.0
+
+
+class RateLimiter:
+    # Token bucket wspólny dla wszystkich wywołań danego backendu. Po 429 tempo
+    # jest obniżane o połowę i odbudowywane stopniowo po udanych zapytaniach.
+    def __init__(self, rate, burst=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self.acquired = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.rejections = 0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                delay = max(
+                    self.blocked_until - now, (1 - self.tokens) / self.rate, 0.0
+                )
+                if delay <= 0:
+                    break
+                self.waits += 1
+                self.wait_time += delay
+                await asyncio.sleep(delay)
+            self.tokens -= 1
+            self.acquired += 1
+
+    def on_success(self):
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.1)
+
+    def on_rejected(self, delay):
+        self.rejections += 1
+        self.rate = max(self.max_rate * 0.1, self.rate / 2)
+        self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+
+    def stats(self):
+        return {
+            "rate": round(self.rate, 2),
+            "acquired": self.acquired,
+            "waits": self.waits,
+            "wait_time": round(self.wait_time, 3),
+            "rejections": self.rejections,
+        }
+
+
+rate_limiters = {
+    "notion": RateLimiter(NOTION_RATE_LIMIT),
+    "airtable": RateLimiter(AIRTABLE_RATE_LIMIT),
+}
+
+
+def retry_delay(response, attempt):
+    retry_after = response.headers.get("Retry-After")
+    if retry_after:
+        try:
+            return min(RETRY_MAX_DELAY, float(retry_after))
+        except ValueError:
+            pass
+    # Wykładnicze opóźnienie z losowym rozrzutem
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+# Wyłączniki obwodu - backend, który zbyt często zawodzi lub odpowiada zbyt
+# wolno, jest na chwilę odcinany; wywołania kończą się od razu błędem zamiast
+# czekać na timeout, a odczyty korzystają z ostatnich znanych wartości
+CIRCUIT_WINDOW = int(os.environ.get("CIRCUIT_WINDOW", "20"))
+CIRCUIT_MIN_CALLS = int(os.environ.get("CIRCUIT_MIN_CALLS", "10"))
+CIRCUIT_FAILURE_RATIO = float(os.environ.get("CIRCUIT_FAILURE_RATIO", "0.5"))
+CIRCUIT_SLOW_CALL = float(os.environ.get("CIRCUIT_SLOW_CALL", "5"))
+CIRCUIT_OPEN_SECONDS = float(os.environ.get("CIRCUIT_OPEN_SECONDS", "30"))
+# Łączny czas jednego wywołania (z czekaniem na limiter i ponowieniami po 429)
+HTTP_DEADLINE = float(os.environ.get("HTTP_DEADLINE", "20"))
+READ_DEADLINE = float(os.environ.get("READ_DEADLINE", "8"))
+# Po tym czasie bez odpowiedzi idempotentny odczyt jest wysyłany drugi raz
+HEDGE_DELAY = float(os.environ.get("HEDGE_DELAY", "1.5"))
+
+
+class CircuitOpenError(httpx.HTTPError):
+    pass
+
+
+class CircuitBreaker:
+    # Zamknięty -> otwarty, gdy w ostatnich CIRCUIT_WINDOW wywołaniach co
+    # najmniej CIRCUIT_FAILURE_RATIO to błędy lub wywołania wolniejsze niż
+    # CIRCUIT_SLOW_CALL; po CIRCUIT_OPEN_SECONDS jedno wywołanie próbne decyduje,
+    # czy obwód wraca do zamkniętego
+    def __init__(self, name):
+        self.name = name
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.trips = 0
+        self.rejected = 0
+        self._outcomes = deque(maxlen=CIRCUIT_WINDOW)
+        self._probing = False
+
+    @property
+    def closed(self):
+        return self.state == "closed"
+
+    def check(self):
+        # Szybka odmowa jeszcze przed czekaniem na limiter
+        if self.state == "open" and (
+            time.monotonic() - self.opened_at < CIRCUIT_OPEN_SECONDS
+        ):
+            self.rejected += 1
+            raise CircuitOpenError(f"{self.name} circuit is open")
+
+    def before_call(self):
+        # Zwraca True, gdy to wywołanie jest próbą w stanie półotwartym
+        self.check()
+        if self.state == "open":
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._probing:
+                self.rejected += 1
+                raise CircuitOpenError(f"{self.name} circuit is half-open")
+            self._probing = True
+            return True
+        return False
+
+    def abandon(self, probe):
+        # Anulowane wywołanie (np. przegrana kopia odczytu) nie jest ani
+        # sukcesem, ani błędem - zwalnia tylko miejsce na próbę
+        if probe and self.state == "half_open":
+            self._probing = False
+
+    def record(self, elapsed, ok):
+        bad = not ok or elapsed > CIRCUIT_SLOW_CALL
+        if self.state == "half_open":
+            self._probing = False
+            if bad:
+                self._trip()
+            else:
+                logger.info("%s circuit closed", self.name)
+                self.state = "closed"
+                self._outcomes.clear()
+            return
+        self._outcomes.append(bad)
+        if (
+            self.state == "closed"
+            and len(self._outcomes) >= CIRCUIT_MIN_CALLS
+            and sum(self._outcomes) >= CIRCUIT_FAILURE_RATIO * len(self._outcomes)
+        ):
+            self._trip()
+
+    def _trip(self):
+        logger.warning("%s circuit opened", self.name)
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self.trips += 1
+        self._outcomes.clear()
+
+    def reset(self):
+        self.state = "closed"
+        self._probing = False
+        self._outcomes.clear()
+
+    def stats(self):
+        return {"state": self.state, "trips": self.trips, "rejected": self.rejected}
+
+
+circuit_breakers = {
+    "notion": CircuitBreaker("notion"),
+    "airtable": CircuitBreaker("airtable"),
 }
-api = Api(AIRTABLE_API_KEY)
 
 
-def add_expense_airtable(date, category, account, amount, description):
-    add_expense_to_airtable(date, category, account, amount, description)
-    month = date[:7]
-    budget = get_budget_from_airtable(category, month)
-    update_budget_in_airtable(budget["id"], budget["fields"]["Remaining"] - amount)
+def degraded_backends(backends=None):
+    return [
+        name
+        for name in backends or ENABLED_BACKENDS
+        if not circuit_breakers[name].closed
+    ]
+
+
+def stale_note(backends=None):
+    degraded = degraded_backends(backends)
+    if not degraded:
+        return ""
+    return (
+        f"\n(Nieaktualne dane z pamięci podręcznej - "
+        f"{', '.join(degraded)} chwilowo niedostępny)"
+    )
+
+
+async def backend_request(backend, method, path, deadline=None, **kwargs):
+    deadline = deadline or HTTP_DEADLINE
+    try:
+        async with asyncio.timeout(deadline):
+            return await _backend_request(backend, method, path, **kwargs)
+    except TimeoutError:
+        # Przekroczony termin to błąd backendu; samo anulowane wywołanie
+        # w _backend_request nie trafia do wyłącznika obwodu
+        circuit_breakers[backend].record(deadline, False)
+        raise httpx.TimeoutException(
+            f"{backend} {method} {path} exceeded the {deadline}s deadline"
+        ) from None
+
+
+async def _backend_request(backend, method, path, **kwargs):
+    limiter = rate_limiters[backend]
+    breaker = circuit_breakers[backend]
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        breaker.check()
+        await limiter.acquire()
+        probe = breaker.before_call()
+        started = time.perf_counter()
+        try:
+            response = await get_http_client(backend).request(method, path, **kwargs)
+        except asyncio.CancelledError:
+            breaker.abandon(probe)
+            raise
+        except httpx.HTTPError:
+            breaker.record(time.perf_counter() - started, False)
+            metrics.observe(
+                "upstream_request_seconds",
+                time.perf_counter() - started,
+                backend=backend,
+                method=method,
+                endpoint=endpoint_label(path),
+                status="error",
+            )
+            raise
+        breaker.record(time.perf_counter() - started, response.status_code < 500)
+        metrics.observe(
+            "upstream_request_seconds",
+            time.perf_counter() - started,
+            backend=backend,
+            method=method,
+            endpoint=endpoint_label(path),
+            status=response.status_code,
+        )
+        if response.status_code != 429:
+            limiter.on_success()
+            return response
+        delay = retry_delay(response, attempt)
+        limiter.on_rejected(delay)
+        logger.info(
+            "%s rate limited on %s %s, retry in %.2fs", backend, method, path, delay
+        )
+    return response
+
+
+async def notion_request(method, path, **kwargs):
+    return await backend_request("notion", method, path, **kwargs)
+
+
+hedged_reads = {"sent": 0, "won": 0}
+
+
+async def hedged_request(backend, method, path, **kwargs):
+    # Tylko dla idempotentnych odczytów: gdy pierwsza próba nie odpowie
+    # w HEDGE_DELAY, druga rusza równolegle i wygrywa szybsza odpowiedź
+    request = {"notion": notion_request, "airtable": airtable_request}[backend]
+    first = asyncio.ensure_future(
+        request(method, path, deadline=READ_DEADLINE, **kwargs)
+    )
+    done, _ = await asyncio.wait({first}, timeout=HEDGE_DELAY)
+    if done or not circuit_breakers[backend].closed:
+        return await first
+    hedged_reads["sent"] += 1
+    second = asyncio.ensure_future(
+        request(method, path, deadline=READ_DEADLINE, **kwargs)
+    )
+    pending = {first, second}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    if task is second:
+                        hedged_reads["won"] += 1
+                    return task.result()
+        return await first
+    finally:
+        first.cancel()
+        second.cancel()
+
+
+async def airtable_request(method, path, **kwargs):
+    return await backend_request("airtable", method, path, **kwargs)
+
+
+# Idempotencja - ta sama aktualizacja Telegrama (np. dostarczona ponownie po
+# restarcie) jest przetwarzana najwyżej raz; sprawdzenie to słownik LRU,
+# a przy braku w nim - odczyt klucza głównego w SQLite
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", "4096"))
+# Telegram przechowuje niepobrane aktualizacje do 24 h
+IDEMPOTENCY_WINDOW = float(os.environ.get("IDEMPOTENCY_WINDOW", str(48 * 3600)))
+IDEMPOTENCY_PRUNE_EVERY = 1000
+
+outbound_idempotency_key = contextvars.ContextVar(
+    "outbound_idempotency_key", default=None
+)
+
+
+def idempotency_headers():
+    # Klucz wpisu kolejki trafia tylko do zapisu tworzącego rekord: zapytania
+    # to odczyty, a PATCH ustawia wartości i powtórzony nie zmienia wyniku
+    key = outbound_idempotency_key.get()
+    return {"Idempotency-Key": key} if key else {}
+
+
+class ProcessedUpdates:
+    def __init__(self, size, window):
+        self.size = size
+        self.window = window
+        self.duplicates = 0
+        self._recent = OrderedDict()
+        self._claims = 0
+
+    def claim(self, key):
+        # True przy pierwszym przetworzeniu klucza, False dla duplikatu
+        if key in self._recent:
+            self._recent.move_to_end(key)
+            self.duplicates += 1
+            return False
+        now = time.time()
+        with get_db() as db:
+            claimed = db.execute(
+                "INSERT OR IGNORE INTO processed_updates (key, processed_at)"
+                " VALUES (?, ?)",
+                (key, now),
+            ).rowcount
+            self._claims += 1
+            if self._claims % IDEMPOTENCY_PRUNE_EVERY == 0:
+                db.execute(
+                    "DELETE FROM processed_updates WHERE processed_at < ?",
+                    (now - self.window,),
+                )
+        self._recent[key] = None
+        if len(self._recent) > self.size:
+            self._recent.popitem(last=False)
+        if not claimed:
+            self.duplicates += 1
+        return bool(claimed)
+
+    def clear(self):
+        self._recent.clear()
+
+
+processed_updates = ProcessedUpdates(IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_WINDOW)
+
+
+def update_key(update):
+    # Wiadomość (także edytowana) po (czat, message_id), pozostałe po update_id
+    chat = update.effective_chat
+    message = update.effective_message
+    if message is not None and chat is not None and update.callback_query is None:
+        return f"message:{chat.id}:{message.message_id}"
+    return f"update:{update.update_id}"
+
+
+async def drop_duplicate_updates(update: Update, context: CallbackContext) -> None:
+    if not processed_updates.claim(update_key(update)):
+        logger.info("Dropping duplicate update %s", update.update_id)
+        raise ApplicationHandlerStop
+
+
+# Jednoczesne identyczne odczyty współdzielą jedno zapytanie do backendu
+coalesced_calls = {}
+
+
+def single_flight(func):
+    in_flight = {}
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+        task = in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            in_flight[key] = task
+            task.add_done_callback(lambda _: in_flight.pop(key, None))
+        else:
+            coalesced_calls[func.__name__] = coalesced_calls.get(func.__name__, 0) + 1
+        # shield - anulowanie jednego oczekującego nie przerywa zapytania pozostałym
+        return await asyncio.shield(task)
+
+    return wrapper
+
+
+# Lokalna baza SQLite (indeks stron budżetu w Notion i księga budżetów/wydatków)
+BUDGET_DB_PATH = os.environ.get("BUDGET_DB_PATH", "budget-bot.db")
+
+SCHEMA_MIGRATIONS = [
+    """
+    CREATE TABLE budget_pages (
+        category TEXT NOT NULL,
+        month TEXT NOT NULL,
+        page_id TEXT NOT NULL,
+        remaining REAL,
+        PRIMARY KEY (category, month)
+    );
+    """,
+    """
+    CREATE TABLE budgets (
+        category TEXT NOT NULL,
+        month TEXT NOT NULL,
+        budget REAL NOT NULL,
+        remaining REAL NOT NULL,
+        PRIMARY KEY (category, month)
+    );
+    CREATE TABLE expenses (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        date TEXT NOT NULL,
+        month TEXT NOT NULL,
+        category TEXT NOT NULL,
+        account TEXT,
+        amount REAL NOT NULL,
+        description TEXT
+    );
+    CREATE INDEX expenses_month_category ON expenses (month, category);
+    """,
+    """
+    CREATE TABLE pending_budget_deltas (
+        category TEXT NOT NULL,
+        month TEXT NOT NULL,
+        amount REAL NOT NULL,
+        PRIMARY KEY (category, month)
+    );
+    CREATE TABLE outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        ordering_key TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL NOT NULL DEFAULT 0,
+        last_error TEXT,
+        created_at REAL NOT NULL
+    );
+    CREATE INDEX outbox_status ON outbox (status, id);
+    """,
+    """
+    ALTER TABLE expenses ADD COLUMN page_id TEXT;
+    ALTER TABLE expenses ADD COLUMN last_edited_time TEXT;
+    CREATE UNIQUE INDEX expenses_page_id ON expenses (page_id);
+    CREATE TABLE sync_state (
+        name TEXT PRIMARY KEY,
+        value TEXT
+    );
+    """,
+    """
+    CREATE TABLE processed_updates (
+        key TEXT PRIMARY KEY,
+        processed_at REAL NOT NULL
+    );
+    CREATE INDEX processed_updates_processed_at ON processed_updates (processed_at);
+    """,
+]
+
+_db = None
+
+
+def get_db():
+    global _db
+    if _db is None:
+        _db = sqlite3.connect(BUDGET_DB_PATH, check_same_thread=False)
+        _db.row_factory = sqlite3.Row
+        _db.execute("PRAGMA journal_mode = WAL")
+        _db.execute("PRAGMA synchronous = NORMAL")
+        migrate_db(_db)
+    return _db
+
+
+def migrate_db(db):
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    for number, script in enumerate(SCHEMA_MIGRATIONS[version:], start=version + 1):
+        db.executescript(f"BEGIN; {script} PRAGMA user_version = {number}; COMMIT;")
+
+
+def month_key(month):
+    # Notion przechowuje miesiąc jako YYYY-MM-01, Airtable jako YYYY-MM
+    return month[:7]
+
+
+# Brak strony stwierdzony zapytaniem (np. przy sprawdzaniu nadpisania w
+# /setbudget) - zapis z kolejki tworzy wtedy stronę bez ponownego zapytania.
+# Tylko w pamięci i na krótko, bo stronę może dodać ktoś inny w Notion
+BUDGET_PAGE_MISS_TTL = float(os.environ.get("BUDGET_PAGE_MISS_TTL", "300"))
+budget_page_misses = {}
+
+
+def remember_missing_budget_page(category, month):
+    budget_page_misses[(category, month_key(month))] = time.monotonic()
+
+
+def take_missing_budget_page(category, month):
+    # Jednorazowo - ponowienie nieudanego zapisu znów pyta Notion
+    seen = budget_page_misses.pop((category, month_key(month)), None)
+    return seen is not None and time.monotonic() - seen < BUDGET_PAGE_MISS_TTL
+
+
+def remember_budget_page(category, month, page_id, remaining):
+    budget_page_misses.pop((category, month_key(month)), None)
+    with get_db() as db:
+        db.execute(
+            """
+            INSERT INTO budget_pages (category, month, page_id, remaining)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (category, month) DO UPDATE
+            SET page_id = excluded.page_id, remaining = excluded.remaining
+            """,
+            (category, month_key(month), page_id, remaining),
+        )
+
+
+def lookup_budget_page(category, month):
+    row = (
+        get_db()
+        .execute(
+            "SELECT page_id, remaining FROM budget_pages"
+            " WHERE category = ? AND month = ?",
+            (category, month_key(month)),
+        )
+        .fetchone()
+    )
+    return (row["page_id"], row["remaining"]) if row else None
+
+
+def forget_budget_page(category, month):
+    with get_db() as db:
+        db.execute(
+            "DELETE FROM budget_pages WHERE category = ? AND month = ?",
+            (category, month_key(month)),
+        )
+
+
+def remember_notion_budget_page(page):
+    properties = page["properties"]
+    remember_budget_page(
+        properties["Kategoria"]["title"][0]["text"]["content"],
+        properties["Miesiąc"]["date"]["start"],
+        page["id"],
+        properties["Pozostało"]["number"],
+    )
+
+
+# Księga budżetów - pozostała kwota liczona lokalnie w jednej transakcji,
+# backendy dostają tylko wyliczoną wartość
+def get_ledger_budget(category, month):
+    row = (
+        get_db()
+        .execute(
+            "SELECT budget, remaining FROM budgets WHERE category = ? AND month = ?",
+            (category, month_key(month)),
+        )
+        .fetchone()
+    )
+    return (row["budget"], row["remaining"]) if row else None
+
+
+def seed_ledger_budget(category, month, budget, remaining):
+    # Nie nadpisuje budżetu, który księga już zna; wydatki zapisane zanim budżet
+    # był znany (np. podczas awarii Notion) są odejmowane przy zasianiu
+    month = month_key(month)
+    with get_db() as db:
+        pending = db.execute(
+            "SELECT amount FROM pending_budget_deltas WHERE category = ? AND month = ?",
+            (category, month),
+        ).fetchone()
+        db.execute(
+            """
+            INSERT INTO budgets (category, month, budget, remaining)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (category, month) DO NOTHING
+            """,
+            (
+                category,
+                month,
+                budget or 0,
+                (remaining or 0) - (pending["amount"] if pending else 0),
+            ),
+        )
+        db.execute(
+            "DELETE FROM pending_budget_deltas WHERE category = ? AND month = ?",
+            (category, month),
+        )
+    invalidate_reports([month])
+
+
+def _apply_budget_delta(db, category, month, amount):
+    updated = db.execute(
+        "UPDATE budgets SET remaining = remaining - ? WHERE category = ? AND month = ?",
+        (amount, category, month),
+    ).rowcount
+    if not updated:
+        db.execute(
+            """
+            INSERT INTO pending_budget_deltas (category, month, amount)
+            VALUES (?, ?, ?)
+            ON CONFLICT (category, month) DO UPDATE
+            SET amount = amount + excluded.amount
+            """,
+            (category, month, amount),
+        )
+
+
+def record_expense(
+    date, category, account, amount, description, backends=(), idempotency_key=None
+):
+    month = month_key(date)
+    with get_db() as db:
+        expense_id = db.execute(
+            """
+            INSERT INTO expenses (date, month, category, account, amount, description)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (date, month, category, account, amount, description),
+        ).lastrowid
+        _apply_budget_delta(db, category, month, amount)
+        for backend in backends:
+            enqueue_outbox(
+                db,
+                f"{backend}_expense",
+                category,
+                month,
+                {
+                    "expense_id": expense_id,
+                    "date": date,
+                    "category": category,
+                    "account": account,
+                    "amount": amount,
+                    "description": description,
+                    "idempotency_key": idempotency_key,
+                },
+            )
+            enqueue_outbox(
+                db,
+                f"{backend}_remaining",
+                category,
+                month,
+                {"category": category, "month": month},
+            )
+        row = db.execute(
+            "SELECT remaining FROM budgets WHERE category = ? AND month = ?",
+            (category, month),
+        ).fetchone()
+    invalidate_reports([month])
+    budget_totals.add(category, month, amount)
+    return row["remaining"] if row else None
+
+
+def record_expenses(expenses, backends=(), idempotency_key=None):
+    # Import wsadowy - jedna transakcja, jedna zmiana budżetu na (kategoria, miesiąc)
+    # i wpisy kolejki po IMPORT_BATCH_SIZE wydatków zamiast jednego na wiersz
+    deltas = {}
+    with get_db() as db:
+        payloads = []
+        for expense in expenses:
+            month = month_key(expense["date"])
+            expense_id = db.execute(
+                """
+                INSERT INTO expenses (date, month, category, account, amount,
+                                      description)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    expense["date"],
+                    month,
+                    expense["category"],
+                    expense["account"],
+                    expense["amount"],
+                    expense["description"],
+                ),
+            ).lastrowid
+            payloads.append({"expense_id": expense_id, **expense})
+            key = (expense["category"], month)
+            deltas[key] = deltas.get(key, 0) + expense["amount"]
+        for (category, month), amount in deltas.items():
+            _apply_budget_delta(db, category, month, amount)
+        for backend in backends:
+            for start in range(0, len(payloads), IMPORT_BATCH_SIZE):
+                batch = payloads[start : start + IMPORT_BATCH_SIZE]
+                enqueue_outbox(
+                    db,
+                    f"{backend}_expense_batch",
+                    None,
+                    None,
+                    {
+                        "expenses": batch,
+                        "idempotency_key": idempotency_key
+                        and f"{idempotency_key}:{start}",
+                    },
+                    ordering_key=f"import|{batch[0]['expense_id']}",
+                )
+            for category, month in deltas:
+                enqueue_outbox(
+                    db,
+                    f"{backend}_remaining",
+                    category,
+                    month,
+                    {"category": category, "month": month},
+                )
+        remaining = {}
+        for category, month in deltas:
+            row = db.execute(
+                "SELECT remaining FROM budgets WHERE category = ? AND month = ?",
+                (category, month),
+            ).fetchone()
+            remaining[(category, month)] = row["remaining"] if row else None
+    invalidate_reports({month for _, month in deltas})
+    for (category, month), amount in deltas.items():
+        budget_totals.add(category, month, amount)
+    return remaining
+
+
+def record_budget(category, month, budget, backends=(), idempotency_key=None):
+    # Upsert - pozostała kwota to nowy budżet minus wydatki już zapisane w miesiącu
+    with get_db() as db:
+        spent = db.execute(
+            "SELECT COALESCE(SUM(amount), 0) FROM expenses"
+            " WHERE category = ? AND month = ?",
+            (category, month_key(month)),
+        ).fetchone()[0]
+        remaining = budget - spent
+        db.execute(
+            """
+            INSERT INTO budgets (category, month, budget, remaining)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (category, month) DO UPDATE
+            SET budget = excluded.budget, remaining = excluded.remaining
+            """,
+            (category, month_key(month), budget, remaining),
+        )
+        db.execute(
+            "DELETE FROM pending_budget_deltas WHERE category = ? AND month = ?",
+            (category, month_key(month)),
+        )
+        for backend in backends:
+            enqueue_outbox(
+                db,
+                f"{backend}_budget",
+                category,
+                month,
+                {
+                    "category": category,
+                    "month": month,
+                    "budget": budget,
+                    "idempotency_key": idempotency_key,
+                },
+            )
+    budget_totals.set_budget(category, month, budget)
+    invalidate_reports([month])
+    ledger_budget_misses.pop((category, month_key(month)), None)
+    return remaining
+
+
+# Brak budżetu potwierdzony przez backendy - /add w kategorii bez budżetu nie
+# czeka przy każdym wydatku na zapytanie. Wpis usuwa record_budget, a po
+# LEDGER_MISS_TTL backendy są pytane znowu (budżet dodany wprost w Notion)
+LEDGER_MISS_TTL = float(os.environ.get("LEDGER_MISS_TTL", "600"))
+ledger_budget_misses = {}
+
 
+async def ensure_ledger_budget(category, month, backends=None, fresh=False):
+    if get_ledger_budget(category, month) is not None:
+        return
+    misses = ledger_budget_misses.setdefault((category, month_key(month)), {})
+    names = tuple(backends or ENABLED_BACKENDS)
+    seen = misses.get(names)
+    if not fresh and seen is not None and time.monotonic() - seen < LEDGER_MISS_TTL:
+        return
+    results = await fan_out("get_budget", category, month, backends=backends)
+    for result in results.values():
+        if result.ok and result.value is not None:
+            seed_ledger_budget(category, month, *result.value)
+            return
+    # Błąd backendu to nie brak budżetu - wtedy następne wywołanie pyta znowu
+    if all(result.ok for result in results.values()):
+        misses[names] = time.monotonic()
+
+
+# Trwała kolejka zapisów (outbox) - handlery odpowiadają od razu po zapisie
+# w SQLite, a zadanie w tle wysyła zmiany do Notion/Airtable
+OUTBOX_FLUSH_INTERVAL = float(os.environ.get("OUTBOX_FLUSH_INTERVAL", "30"))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "10"))
+OUTBOX_BASE_BACKOFF = 2.0
+OUTBOX_MAX_BACKOFF = 900.0
+# 10 to limit rekordów w jednym żądaniu batch_create Airtable
+IMPORT_BATCH_SIZE = 10
+
+_outbox_lock = asyncio.Lock()
+
+
+def enqueue_outbox(db, kind, category, month, payload, ordering_key=None):
+    if ordering_key is None:
+        ordering_key = f"{category}|{month_key(month)}"
+    db.execute(
+        """
+        INSERT INTO outbox (kind, ordering_key, payload, created_at)
+        VALUES (?, ?, ?, ?)
+        """,
+        (kind, ordering_key, json.dumps(payload), time.time()),
+    )
 
-def add_expense_to_airtable(date, category, account, amount, description):
-    url = f"{AIRTABLE_API_URL}/{AIRTABLE_EXPENSES_TABLE}"
+
+def pending_outbox_count():
+    return (
+        get_db()
+        .execute("SELECT COUNT(*) FROM outbox WHERE status = 'pending'")
+        .fetchone()[0]
+    )
+
+
+def schedule_outbox_flush(context):
+    job_queue = getattr(context, "job_queue", None)
+    if job_queue is not None:
+        job_queue.run_once(flush_outbox, 0)
+
+
+def _outbox_call(operation, p):
+    if operation == "expense":
+        return "add_expense", (
+            p["date"],
+            p["category"],
+            p["account"],
+            p["amount"],
+            p["description"],
+        )
+    if operation == "expense_batch":
+        return "add_expenses", (p["expenses"],)
+    if operation == "budget":
+        return "upsert_budget", (p["category"], p["month"], p["budget"])
+    return "sync_remaining", (p["category"], p["month"])
+
+
+def _mark_outbox_failed(entry, error):
+    attempts = entry["attempts"] + 1
+    status = "dead" if attempts >= OUTBOX_MAX_ATTEMPTS else "pending"
+    delay = min(OUTBOX_MAX_BACKOFF, OUTBOX_BASE_BACKOFF * 2**attempts)
+    logger.warning(
+        "Outbox entry %s (%s) failed, attempt %s: %s",
+        entry["id"],
+        entry["kind"],
+        attempts,
+        error,
+    )
+    with get_db() as db:
+        db.execute(
+            """
+            UPDATE outbox
+            SET attempts = ?, status = ?, next_attempt_at = ?, last_error = ?
+            WHERE id = ?
+            """,
+            (attempts, status, time.time() + delay, error, entry["id"]),
+        )
+
+
+async def _flush_outbox_group(backend_name, entries, now):
+    db = get_db()
+    backend = STORAGE_BACKENDS[backend_name]
+    delivered = failed = 0
+    deferred = []
+    # Wpisy *_remaining wysyłają bieżący stan księgi, wystarczy ostatni z nich
+    latest_sync_id = max(
+        (entry["id"] for entry in entries if entry["kind"].endswith("_remaining")),
+        default=None,
+    )
+    for entry in entries:
+        if entry["next_attempt_at"] > now:
+            break
+        if entry["kind"].endswith("_remaining"):
+            if entry["id"] != latest_sync_id:
+                with db:
+                    db.execute("DELETE FROM outbox WHERE id = ?", (entry["id"],))
+                continue
+            # Backendy z zapisem wsadowym dostają wszystkie kwoty naraz po przebiegu
+            if hasattr(backend, "sync_remaining_batch"):
+                deferred.append(entry)
+                continue
+        payload = json.loads(entry["payload"])
+        method, args = _outbox_call(entry["kind"].split("_", 1)[1], payload)
+        # Ten sam klucz przy każdej próbie - ponowienie nie tworzy duplikatu
+        outbound_idempotency_key.set(
+            payload.get("idempotency_key") or f"outbox:{entry['id']}"
+        )
+        result = await call_backend(backend, method, *args)
+        if result.ok:
+            delivered += 1
+            with db:
+                db.execute("DELETE FROM outbox WHERE id = ?", (entry["id"],))
+            if entry["kind"] == "notion_expense":
+                link_expense_page(payload, result.value[1])
+            continue
+        # Kolejność w obrębie (kategoria, miesiąc) - błąd wstrzymuje dalsze wpisy
+        failed += 1
+        _mark_outbox_failed(entry, result.error)
+        return backend_name, delivered, failed, []
+    return backend_name, delivered, failed, deferred
+
+
+async def _flush_outbox_batch(backend_name, entries):
+    keys = []
+    for entry in entries:
+        payload = json.loads(entry["payload"])
+        keys.append((payload["category"], payload["month"]))
+    result = await call_backend(
+        STORAGE_BACKENDS[backend_name], "sync_remaining_batch", keys
+    )
+    if not result.ok:
+        for entry in entries:
+            _mark_outbox_failed(entry, result.error)
+        return 0, len(entries)
+    with get_db() as db:
+        db.executemany(
+            "DELETE FROM outbox WHERE id = ?", [(entry["id"],) for entry in entries]
+        )
+    return len(entries), 0
+
+
+async def flush_outbox(context=None):
+    if _outbox_lock.locked():
+        return {}
+    async with _outbox_lock:
+        entries = (
+            get_db()
+            .execute("SELECT * FROM outbox WHERE status = 'pending' ORDER BY id")
+            .fetchall()
+        )
+        groups = {}
+        for entry in entries:
+            backend_name = entry["kind"].split("_", 1)[0]
+            groups.setdefault((backend_name, entry["ordering_key"]), []).append(entry)
+
+        # Backendy i klucze (kategoria, miesiąc) są wysyłane równolegle
+        now = time.time()
+        results = await asyncio.gather(
+            *(
+                _flush_outbox_group(backend_name, group, now)
+                for (backend_name, _), group in groups.items()
+            )
+        )
+        summary = {}
+        deferred = {}
+        for backend_name, delivered, failed, batch in results:
+            totals = summary.setdefault(backend_name, {"delivered": 0, "failed": 0})
+            totals["delivered"] += delivered
+            totals["failed"] += failed
+            if batch:
+                deferred.setdefault(backend_name, []).extend(batch)
+        for backend_name, batch in deferred.items():
+            delivered, failed = await _flush_outbox_batch(backend_name, batch)
+            summary[backend_name]["delivered"] += delivered
+            summary[backend_name]["failed"] += failed
+        if any(totals["failed"] for totals in summary.values()):
+            logger.warning("Outbox flush finished with failures: %s", summary)
+        return summary
+
+
+async def add_expense_airtable(date, category, account, amount, description):
+    await ensure_ledger_budget(category, date, backends=("airtable",))
+    return record_expense(
+        date, category, account, amount, description, backends=("airtable",)
+    )
+
+
+async def add_expense_to_airtable(date, category, account, amount, description):
     data = {
         "fields": {
             "Date": date,
@@ -49,88 +1317,391 @@ def add_expense_to_airtable(date, category, account, amount, description):
         }
     }
 
-    response = requests.post(url, headers=headers, json=data)
+    response = await airtable_request(
+        "POST",
+        f"/{AIRTABLE_EXPENSES_TABLE}",
+        json=data,
+        headers=idempotency_headers(),
+    )
     return response.status_code, response.json()
 
 
-def get_budget_from_airtable(category, month):
-    url = f"{AIRTABLE_API_URL}/{AIRTABLE_BUDGET_TABLE}"
-    params = {"filterByFormula": f"AND(Category='{category}', Month='{month}')"}
-    response = requests.get(url, headers=headers, params=params)
-    if response.status_code == 200:
-        records = response.json().get("records", [])
-        if records:
-            return records[0]
-    return None
+# Migawka budżetów Airtable dla całego miesiąca - jedno stronicowane pobranie
+# wszystkich wierszy BudgetData zamiast zapytania przy każdym wydatku
+AIRTABLE_SNAPSHOT_TTL = float(os.environ.get("AIRTABLE_SNAPSHOT_TTL", "300"))
+AIRTABLE_BATCH_SIZE = 10
+
 
+def get_airtable_table(table_name):
+    return get_airtable_api().table(get_env("AIRTABLE_BASE_ID"), table_name)
 
-def update_budget_in_airtable(record_id, remaining_budget):
-    url = f"{AIRTABLE_API_URL}/{AIRTABLE_BUDGET_TABLE}/{record_id}"
-    data = {"fields": {"Remaining": remaining_budget}}
-    response = requests.patch(url, headers=headers, json=data)
+
+async def airtable_table_call(endpoint, func, *args):
+    # Synchroniczne wywołania pyairtable idą w wątku, przez wyłącznik obwodu,
+    # limiter i pomiar czasu; po HTTP_DEADLINE wywołujący przestaje czekać
+    breaker = circuit_breakers["airtable"]
+    breaker.check()
+    await rate_limiters["airtable"].acquire()
+    probe = breaker.before_call()
+    started = time.perf_counter()
+    status = 200
+    try:
+        async with asyncio.timeout(HTTP_DEADLINE):
+            return await asyncio.to_thread(func, *args)
+    except asyncio.CancelledError:
+        breaker.abandon(probe)
+        status = "cancelled"
+        raise
+    except TimeoutError:
+        status = "error"
+        raise httpx.TimeoutException(
+            f"airtable {endpoint} exceeded the {HTTP_DEADLINE}s deadline"
+        ) from None
+    except requests.HTTPError as e:
+        status = e.response.status_code if e.response is not None else "error"
+        raise
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        if status != "cancelled":
+            breaker.record(
+                time.perf_counter() - started, status != "error" and status < 500
+            )
+        metrics.observe(
+            "upstream_request_seconds",
+            time.perf_counter() - started,
+            backend="airtable",
+            method="SDK",
+            endpoint=endpoint,
+            status=status,
+        )
+
+
+@single_flight
+async def fetch_airtable_month_budgets(month):
+    pages = get_airtable_table(AIRTABLE_BUDGET_TABLE).iterate(
+        formula=match({"Month": month}), page_size=100
+    )
+    records = {}
+    while True:
+        page = await airtable_table_call(
+            f"/{AIRTABLE_BUDGET_TABLE}:iterate", next, pages, None
+        )
+        if page is None:
+            return records
+        for record in page:
+            records[record["fields"].get("Category")] = record
+
+
+class AirtableBudgetSnapshot:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._months = {}
+
+    async def month(self, month):
+        month = month_key(month)
+        cached = self._months.get(month)
+        if cached is not None and time.monotonic() < cached[0]:
+            return cached[1]
+        records = await fetch_airtable_month_budgets(month)
+        self._months[month] = (time.monotonic() + self.ttl, records)
+        return records
+
+    async def get(self, category, month):
+        return (await self.month(month)).get(category)
+
+    def put(self, record):
+        cached = self._months.get(month_key(record["fields"].get("Month", "")))
+        if cached is not None:
+            cached[1][record["fields"].get("Category")] = record
+
+    def invalidate(self, month=None):
+        if month is None:
+            self._months.clear()
+        else:
+            self._months.pop(month_key(month), None)
+
+
+airtable_budget_snapshot = AirtableBudgetSnapshot(AIRTABLE_SNAPSHOT_TTL)
+
+
+@single_flight
+async def get_budget_from_airtable(category, month):
+    return await airtable_budget_snapshot.get(category, month)
+
+
+async def patch_airtable_budget(record_id, fields):
+    response = await airtable_request(
+        "PATCH", f"/{AIRTABLE_BUDGET_TABLE}/{record_id}", json={"fields": fields}
+    )
+    if response.status_code == 200:
+        airtable_budget_snapshot.put(response.json())
     return response.status_code, response.json()
 
 
-def add_budget_to_airtable(category, budget, month):
-    url = f"{AIRTABLE_API_URL}/{AIRTABLE_BUDGET_TABLE}"
+async def update_budget_in_airtable(record_id, remaining_budget):
+    return await patch_airtable_budget(record_id, {"Remaining": remaining_budget})
+
+
+async def upsert_budget_in_airtable(category, month, budget, remaining):
+    # Rekord szukany w migawce miesiąca; nowy tworzony tylko, gdy go nie ma
+    record = await get_budget_from_airtable(category, month_key(month))
+    if record is None:
+        return await add_budget_to_airtable(
+            category, budget, month_key(month), remaining
+        )
+    return await patch_airtable_budget(
+        record["id"], {"Budget": budget, "Remaining": remaining}
+    )
+
+
+async def update_budgets_in_airtable(updates):
+    # updates: lista (record_id, pozostało); batch_update wysyła po 10 rekordów
+    table = get_airtable_table(AIRTABLE_BUDGET_TABLE)
+    records = [
+        {"id": record_id, "fields": {"Remaining": remaining}}
+        for record_id, remaining in updates
+    ]
+    updated = []
+    for start in range(0, len(records), AIRTABLE_BATCH_SIZE):
+        updated += await airtable_table_call(
+            f"/{AIRTABLE_BUDGET_TABLE}:batch_update",
+            table.batch_update,
+            records[start : start + AIRTABLE_BATCH_SIZE],
+        )
+    for record in updated:
+        airtable_budget_snapshot.put(record)
+    return updated
+
+
+async def add_expenses_to_airtable(expenses):
+    # Wpisy kolejki mają najwyżej AIRTABLE_BATCH_SIZE wydatków, więc zwykle
+    # jest to jedno żądanie - niepodzielne po stronie Airtable
+    table = get_airtable_table(AIRTABLE_EXPENSES_TABLE)
+    records = [
+        {
+            "Date": expense["date"],
+            "Category": expense["category"],
+            "Account": expense["account"],
+            "Amount": expense["amount"],
+            "Description": expense["description"],
+        }
+        for expense in expenses
+    ]
+    created = []
+    for start in range(0, len(records), AIRTABLE_BATCH_SIZE):
+        created += await airtable_table_call(
+            f"/{AIRTABLE_EXPENSES_TABLE}:batch_create",
+            table.batch_create,
+            records[start : start + AIRTABLE_BATCH_SIZE],
+        )
+    return created
+
+
+async def iter_airtable_expenses(date_from, date_to):
+    # Kolejne strony po 100 rekordów pobierane dopiero, gdy są potrzebne
+    formula = (
+        f"AND(NOT(IS_BEFORE({{Date}}, '{date_from}')),"
+        f" NOT(IS_AFTER({{Date}}, '{date_to}')))"
+    )
+    pages = get_airtable_table(AIRTABLE_EXPENSES_TABLE).iterate(
+        formula=formula, sort=["Date"], page_size=100
+    )
+    while True:
+        page = await airtable_table_call(
+            f"/{AIRTABLE_EXPENSES_TABLE}:iterate", next, pages, None
+        )
+        if page is None:
+            return
+        for record in page:
+            yield record
+
+
+async def add_budget_to_airtable(category, budget, month, remaining=None):
     data = {
         "fields": {
             "Category": category,
             "Month": month,
             "Budget": budget,
-            "Remaining": budget,
+            "Remaining": budget if remaining is None else remaining,
         }
     }
-    response = requests.post(url, headers=headers, json=data)
+    response = await airtable_request(
+        "POST",
+        f"/{AIRTABLE_BUDGET_TABLE}",
+        json=data,
+        headers=idempotency_headers(),
+    )
+    if response.status_code == 200:
+        airtable_budget_snapshot.put(response.json())
     return response.status_code, response.json()
 
 
-def check_category_exists(category):
-    url = f"https://api.notion.com/v1/databases/{NOTION_BUDGET_DATABASE_ID}/query"
-    headers = {
-        "Authorization": f"Bearer {NOTION_API_TOKEN}",
-        "Content-Type": "application/json",
-        "Notion-Version": "2022-06-28",
-    }
-    data = {"filter": {"property": "Kategoria", "title": {"equals": category}}}
-    response = requests.post(url, json=data, headers=headers)
-    if response.status_code == 200:
-        results = response.json().get("results", [])
-        return len(results) > 0
-    return False
+# Podręczna pamięć kategorii - lista zmienia się rzadko, więc nie pytamy o nią
+# Notion przy każdej komendzie
+CATEGORY_CACHE_TTL = float(os.environ.get("CATEGORY_CACHE_TTL", "300"))
+
+
+class CategoryCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        # Ostatni odczyt zwrócił listę z pamięci, bo Notion nie odpowiedział
+        self.degraded = False
+        self._categories = None
+        self._expires_at = 0.0
+
+    def get(self):
+        if self._categories is not None and time.monotonic() < self._expires_at:
+            self.hits += 1
+            return list(self._categories)
+        self.misses += 1
+        return None
+
+    def set(self, categories):
+        self._categories = list(categories)
+        self._expires_at = time.monotonic() + self.ttl
+        self.degraded = False
+
+    def stale(self):
+        # Ostatnia znana lista bez względu na TTL - gdy Notion nie odpowiada
+        if self._categories is None:
+            return None
+        self.stale_hits += 1
+        self.degraded = True
+        return list(self._categories)
+
+    def add(self, category):
+        if self._categories is not None and category not in self._categories:
+            self._categories.append(category)
+
+    def invalidate(self):
+        self._categories = None
+        self._expires_at = 0.0
+        self.degraded = False
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale_hits": self.stale_hits,
+            "size": len(self._categories or []),
+            "ttl": self.ttl,
+        }
 
 
-def add_category_to_notion(category):
-    url = "https://api.notion.com/v1/pages"
-    headers = {
-        "Authorization": f"Bearer {NOTION_API_TOKEN}",
-        "Content-Type": "application/json",
-        "Notion-Version": "2022-06-28",
+category_cache = CategoryCache(CATEGORY_CACHE_TTL)
+STALE_CATEGORIES_NOTE = (
+    "\n(Nieaktualna lista z pamięci podręcznej - Notion chwilowo niedostępny)"
+)
+
+
+# Zapytania do baz Notion - kolejne strony wyników są pobierane leniwie,
+# dopiero gdy wywołujący ich potrzebuje
+NOTION_PAGE_SIZE = 100
+
+
+async def iter_notion_query(
+    database_id,
+    filter=None,
+    sorts=None,
+    page_size=NOTION_PAGE_SIZE,
+    filter_properties=None,
+    limit=None,
+):
+    body = {"page_size": min(page_size, NOTION_PAGE_SIZE)}
+    if filter:
+        body["filter"] = filter
+    if sorts:
+        body["sorts"] = sorts
+    params = [("filter_properties", prop) for prop in filter_properties or ()]
+    yielded = 0
+    while True:
+        # Zapytanie do bazy niczego nie zmienia, więc można je wysłać ponownie
+        response = await hedged_request(
+            "notion",
+            "POST",
+            f"/databases/{database_id}/query",
+            json=body,
+            params=params,
+        )
+        if response.status_code != 200:
+            raise httpx.HTTPStatusError(
+                f"Notion query failed with {response.status_code}",
+                request=response.request,
+                response=response,
+            )
+        page = response.json()
+        for result in page.get("results", []):
+            yield result
+            yielded += 1
+            if limit is not None and yielded >= limit:
+                return
+        if not page.get("has_more") or not page.get("next_cursor"):
+            return
+        body["start_cursor"] = page["next_cursor"]
+
+
+async def find_notion_page(database_id, filter):
+    pages = iter_notion_query(database_id, filter, page_size=1, limit=1)
+    async with aclosing(pages):
+        async for page in pages:
+            return page
+    return None
+
+
+def budget_page_filter(category, month):
+    return {
+        "and": [
+            {"property": "Kategoria", "title": {"equals": category}},
+            {"property": "Miesiąc", "date": {"equals": month}},
+        ]
     }
+
+
+async def check_category_exists(category):
+    return category in await get_categories_from_notion()
+
+
+async def add_category_to_notion(category):
     data = {
         "parent": {"database_id": NOTION_BUDGET_DATABASE_ID},
         "properties": {"Kategoria": {"title": [{"text": {"content": category}}]}},
     }
-    response = requests.post(url, json=data, headers=headers)
+    response = await notion_request("POST", "/pages", json=data)
+    if response.status_code == 200:
+        category_cache.add(category)
     return response.status_code, response.json()
 
 
-def get_categories_from_notion():
-    url = f"https://api.notion.com/v1/databases/{NOTION_BUDGET_DATABASE_ID}/query"
-    headers = {
-        "Authorization": f"Bearer {NOTION_API_TOKEN}",
-        "Content-Type": "application/json",
-        "Notion-Version": "2022-06-28",
-    }
-    response = requests.post(url, headers=headers)
-    if response.status_code == 200:
-        results = response.json().get("results", [])
-        categories = [
-            entry["properties"]["Kategoria"]["title"][0]["text"]["content"]
-            for entry in results
-        ]
-        return list(set(categories))  # Unikalne kategorie
-    return []
+@single_flight
+async def get_categories_from_notion():
+    cached = category_cache.get()
+    if cached is not None:
+        return cached
+    categories = set()  # Unikalne kategorie
+    try:
+        # "title" to stałe id właściwości tytułu - pobieramy tylko nazwę kategorii
+        async for entry in iter_notion_query(
+            NOTION_BUDGET_DATABASE_ID, filter_properties=["title"]
+        ):
+            title = entry["properties"]["Kategoria"]["title"]
+            if title:
+                categories.add(title[0]["text"]["content"])
+    except httpx.HTTPError as e:
+        stale = category_cache.stale()
+        if stale is not None:
+            logger.warning("Serving stale categories: %s", e)
+            return stale
+        if isinstance(e, httpx.HTTPStatusError):
+            return []
+        raise
+    categories = list(categories)
+    category_cache.set(categories)
+    return categories
 
 
 async def add_category(update: Update, context: CallbackContext) -> None:
@@ -146,12 +1717,12 @@ async def add_category(update: Update, context: CallbackContext) -> None:
         category = text[1]
 
         # Sprawdź, czy kategoria już istnieje
-        if check_category_exists(category):
+        if await check_category_exists(category):
             await update.message.reply_text(f'Kategoria "{category}" już istnieje.')
             return
 
         # Dodaj kategorię do Notion
-        status_code, response = add_category_to_notion(category)
+        status_code, response = await add_category_to_notion(category)
         if status_code != 200:
             await update.message.reply_text(
                 f"Wystąpił błąd podczas dodawania kategorii do Notion: {response}"
@@ -166,9 +1737,11 @@ async def add_category(update: Update, context: CallbackContext) -> None:
 # Funkcja do wylistowania kategorii
 async def get_categories(update: Update, context: CallbackContext) -> None:
     try:
-        categories = get_categories_from_notion()
+        categories = await get_categories_from_notion()
         if categories:
             categories_message = "Dostępne kategorie:\n" + "\n".join(categories)
+            if category_cache.degraded:
+                categories_message += STALE_CATEGORIES_NOTE
         else:
             categories_message = "Nie znaleziono żadnych kategorii."
         await update.message.reply_text(categories_message)
@@ -176,88 +1749,101 @@ async def get_categories(update: Update, context: CallbackContext) -> None:
         await update.message.reply_text(f"Wystąpił błąd: {e}")
 
 
-def get_budget_from_notion(category, month):
-    url = f"https://api.notion.com/v1/databases/{NOTION_BUDGET_DATABASE_ID}/query"
-    headers = {
-        "Authorization": f"Bearer {NOTION_API_TOKEN}",
-        "Content-Type": "application/json",
-        "Notion-Version": "2022-06-28",
-    }
-    data = {
-        "filter": {
-            "and": [
-                {"property": "Kategoria", "title": {"equals": category}},
-                {"property": "Miesiąc", "date": {"equals": month}},
-            ]
-        }
-    }
-    response = requests.post(url, json=data, headers=headers)
-    if response.status_code == 200:
-        results = response.json().get("results", [])
-        if results:
-            return results[0]
-    return None
+@single_flight
+async def get_budget_from_notion(category, month):
+    try:
+        page = await find_notion_page(
+            NOTION_BUDGET_DATABASE_ID, budget_page_filter(category, month)
+        )
+    except httpx.HTTPStatusError:
+        return None
+    if page:
+        remember_notion_budget_page(page)
+    else:
+        remember_missing_budget_page(category, month)
+    return page
 
 
 # Funkcja do dodawania budżetu do Notion
-def add_budget_to_notion(category, budget, month):
-    url = "https://api.notion.com/v1/pages"
-    headers = {
-        "Authorization": f"Bearer {NOTION_API_TOKEN}",
-        "Content-Type": "application/json",
-        "Notion-Version": "2022-06-28",
-    }
+async def add_budget_to_notion(category, budget, month, remaining=None):
+    remaining = budget if remaining is None else remaining
     data = {
         "parent": {"database_id": NOTION_BUDGET_DATABASE_ID},
         "properties": {
             "Kategoria": {"title": [{"text": {"content": category}}]},
             "Miesiąc": {"date": {"start": month}},
             "Budżet": {"number": budget},
-            "Pozostało": {"number": budget},
+            "Pozostało": {"number": remaining},
         },
     }
-    response = requests.post(url, json=data, headers=headers)
+    response = await notion_request(
+        "POST", "/pages", json=data, headers=idempotency_headers()
+    )
+    if response.status_code == 200:
+        remember_budget_page(category, month, response.json()["id"], remaining)
     return response.status_code, response.json()
 
 
-def update_budget_in_notion(category, month, amount):
-    url = f"https://api.notion.com/v1/databases/{NOTION_BUDGET_DATABASE_ID}/query"
-    headers = {
-        "Authorization": f"Bearer {NOTION_API_TOKEN}",
-        "Content-Type": "application/json",
-        "Notion-Version": "2022-06-28",
-    }
-    data = {
-        "filter": {
-            "and": [
-                {"property": "Kategoria", "title": {"equals": category}},
-                {"property": "Miesiąc", "date": {"equals": month + "-01"}},
-            ]
-        }
-    }
-    response = requests.post(url, json=data, headers=headers)
+async def patch_notion_budget_page(page_id, properties):
+    response = await notion_request(
+        "PATCH", f"/pages/{page_id}", json={"properties": properties}
+    )
     if response.status_code == 200:
-        results = response.json().get("results", [])
-        if results:
-            page_id = results[0]["id"]
-            current_remaining = results[0]["properties"]["Pozostało"]["number"]
-            new_remaining = current_remaining - amount
-
-            url = f"https://api.notion.com/v1/pages/{page_id}"
-            data = {"properties": {"Pozostało": {"number": new_remaining}}}
-            response = requests.patch(url, json=data, headers=headers)
-            return response.status_code, response.json()
+        remember_notion_budget_page(response.json())
     return response.status_code, response.json()
 
 
+async def set_remaining_in_notion(page_id, remaining):
+    return await patch_notion_budget_page(page_id, {"Pozostało": {"number": remaining}})
+
+
+async def upsert_budget_in_notion(category, month, budget, remaining):
+    # Znana strona - jeden PATCH; nowa strona powstaje tylko, gdy jej nie ma
+    properties = {"Budżet": {"number": budget}, "Pozostało": {"number": remaining}}
+    indexed = lookup_budget_page(category, month)
+    if indexed is not None:
+        status_code, response = await patch_notion_budget_page(indexed[0], properties)
+        if status_code != 404:
+            return status_code, response
+        forget_budget_page(category, month)
+
+    month_start = f"{month_key(month)}-01"
+    if take_missing_budget_page(category, month):
+        return await add_budget_to_notion(category, budget, month_start, remaining)
+    try:
+        page = await find_notion_page(
+            NOTION_BUDGET_DATABASE_ID, budget_page_filter(category, month_start)
+        )
+    except httpx.HTTPStatusError as e:
+        return e.response.status_code, e.response.json()
+    if page:
+        return await patch_notion_budget_page(page["id"], properties)
+    return await add_budget_to_notion(category, budget, month_start, remaining)
+
+
+async def update_budget_in_notion(category, month, remaining):
+    # Znana strona budżetu - wystarczy jeden PATCH bez wcześniejszego zapytania
+    indexed = lookup_budget_page(category, month)
+    if indexed is not None:
+        status_code, response = await set_remaining_in_notion(indexed[0], remaining)
+        if status_code != 404:
+            return status_code, response
+        forget_budget_page(category, month)
+
+    try:
+        page = await find_notion_page(
+            NOTION_BUDGET_DATABASE_ID,
+            budget_page_filter(category, f"{month_key(month)}-01"),
+        )
+    except httpx.HTTPStatusError as e:
+        return e.response.status_code, e.response.json()
+    if page:
+        return await set_remaining_in_notion(page["id"], remaining)
+    return 200, {}
+
+
 # Funkcja do dodawania wydatków do Notion
-def add_expense_to_notion(date, category, account, expense, description):
-    url = "https://api.notion.com/v1/pages"
-    headers = {
-        "Authorization": f"Bearer {NOTION_API_TOKEN}",
-        "Content-Type": "application/json",
-        "Notion-Version": "2022-06-28",
-    }
+async def add_expense_to_notion(date, category, account, expense, description):
     data = {
         "parent": {"database_id": NOTION_EXPENSES_DATABASE_ID},
         "properties": {
@@ -268,10 +1854,978 @@ def add_expense_to_notion(date, category, account, expense, description):
             "Opis": {"rich_text": [{"text": {"content": description}}]},
         },
     }
-    response = requests.post(url, json=data, headers=headers)
+    response = await notion_request(
+        "POST", "/pages", json=data, headers=idempotency_headers()
+    )
     return response.status_code, response.json()
 
 
+# Wspólny interfejs backendów - zapisy trafiają równolegle do wszystkich
+# skonfigurowanych backendów (STORAGE_BACKENDS=notion,airtable)
+BackendResult = namedtuple("BackendResult", ["backend", "ok", "value", "error"])
+
+
+class StorageBackend(ABC):
+    name = ""
+
+    @abstractmethod
+    async def add_expense(self, date, category, account, amount, description):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def add_expenses(self, expenses):
+        raise NotImplementedError
+
+    async def upsert_budget(self, category, month, budget):
+        # Pozostała kwota z księgi w chwili wysyłki - uwzględnia późniejsze wydatki
+        ledger_budget = get_ledger_budget(category, month)
+        remaining = budget if ledger_budget is None else ledger_budget[1]
+        return await self.write_budget(category, month, budget, remaining)
+
+    @abstractmethod
+    async def write_budget(self, category, month, budget, remaining):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_budget(self, category, month):
+        # Zwraca (budżet, pozostało) albo None
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set_remaining(self, category, month, remaining):
+        raise NotImplementedError
+
+    @abstractmethod
+    def iter_expenses(self, date_from, date_to):
+        # Asynchroniczny generator krotek (data, kategoria, konto, kwota, opis)
+        raise NotImplementedError
+
+    async def sync_remaining(self, category, month):
+        await ensure_ledger_budget(category, month, backends=(self.name,))
+        ledger_budget = get_ledger_budget(category, month)
+        if ledger_budget is None:
+            return 200, {}
+        return await self.set_remaining(category, month, ledger_budget[1])
+
+    @abstractmethod
+    async def month_budgets(self, month):
+        # Świeże (nie z pamięci podręcznej) budżety miesiąca:
+        # {kategoria: (id rekordu, budżet, pozostało)}
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set_remaining_batch(self, updates):
+        # updates: lista (id rekordu, pozostało)
+        raise NotImplementedError
+
+    async def reconcile(self, month, skip=()):
+        # Pozostała kwota liczona od nowa z wydatków zapisanych w backendzie;
+        # zapisywane są tylko rekordy, które się rozjechały. Zwraca poprawki
+        # i przeliczone kwoty wszystkich uzgodnionych kategorii
+        month = month_key(month)
+        budgets = await self.month_budgets(month)
+        spent = {}
+        async with aclosing(
+            self.iter_expenses(export_period(month), export_period(month, end=True))
+        ) as expenses:
+            async for _, category, _, amount, _ in expenses:
+                spent[category] = spent.get(category, 0) + (amount or 0)
+
+        updates, corrections, expected_remaining = [], [], {}
+        for category, (record_id, budget, remaining) in sorted(budgets.items()):
+            if budget is None or (category, month) in skip:
+                continue
+            expected = budget - spent.get(category, 0)
+            expected_remaining[category] = expected
+            if remaining is None or abs(remaining - expected) > RECONCILE_TOLERANCE:
+                updates.append((record_id, expected))
+                corrections.append((category, remaining, expected))
+        if updates:
+            status_code, response = await self.set_remaining_batch(updates)
+            if status_code != 200:
+                raise httpx.HTTPError(
+                    f"Reconciliation write failed with {status_code}: {response}"
+                )
+        return {"corrections": corrections, "remaining": expected_remaining}
+
+
+class NotionBackend(StorageBackend):
+    name = "notion"
+
+    async def add_expense(self, date, category, account, amount, description):
+        return await add_expense_to_notion(date, category, account, amount, description)
+
+    async def add_expenses(self, expenses):
+        # Strony tworzone równolegle (tempo wyznacza limiter); wydatki już
+        # powiązane ze stroną przy poprzedniej próbie są pomijane
+        ids = [expense["expense_id"] for expense in expenses]
+        linked = {
+            row["id"]
+            for row in get_db().execute(
+                "SELECT id FROM expenses WHERE page_id IS NOT NULL"
+                f" AND id IN ({', '.join('?' * len(ids))})",
+                ids,
+            )
+        }
+
+        batch_key = outbound_idempotency_key.get()
+
+        async def add(expense):
+            # Każde zadanie gather ma własną kopię kontekstu
+            outbound_idempotency_key.set(f"{batch_key}:{expense['expense_id']}")
+            status, page = await add_expense_to_notion(
+                expense["date"],
+                expense["category"],
+                expense["account"],
+                expense["amount"],
+                expense["description"],
+            )
+            if status == 200:
+                link_expense_page(expense, page)
+            return status, page
+
+        results = await asyncio.gather(
+            *(add(e) for e in expenses if e["expense_id"] not in linked),
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+            if result[0] != 200:
+                return result
+        return 200, {"results": [page for _, page in results]}
+
+    async def write_budget(self, category, month, budget, remaining):
+        return await upsert_budget_in_notion(category, month, budget, remaining)
+
+    async def get_budget(self, category, month):
+        page = await get_budget_from_notion(category, f"{month_key(month)}-01")
+        if page is None:
+            return None
+        properties = page["properties"]
+        return properties["Budżet"]["number"], properties["Pozostało"]["number"]
+
+    async def set_remaining(self, category, month, remaining):
+        return await update_budget_in_notion(category, month, remaining)
+
+    async def month_budgets(self, month):
+        budgets = {}
+        async for page in iter_notion_query(
+            NOTION_BUDGET_DATABASE_ID,
+            filter={"property": "Miesiąc", "date": {"equals": f"{month}-01"}},
+        ):
+            properties = page["properties"]
+            if not properties["Kategoria"]["title"]:
+                continue
+            remember_notion_budget_page(page)
+            budgets[properties["Kategoria"]["title"][0]["text"]["content"]] = (
+                page["id"],
+                properties["Budżet"]["number"],
+                properties["Pozostało"]["number"],
+            )
+        return budgets
+
+    async def set_remaining_batch(self, updates):
+        # Notion nie ma zapisu wsadowego - porcje równoległych PATCH-y,
+        # tempo wyznacza limiter
+        for start in range(0, len(updates), RECONCILE_BATCH_SIZE):
+            results = await asyncio.gather(
+                *(
+                    set_remaining_in_notion(page_id, remaining)
+                    for page_id, remaining in updates[
+                        start : start + RECONCILE_BATCH_SIZE
+                    ]
+                )
+            )
+            for status_code, response in results:
+                if status_code != 200:
+                    return status_code, response
+        return 200, {}
+
+    async def iter_expenses(self, date_from, date_to):
+        async with aclosing(
+            iter_notion_query(
+                NOTION_EXPENSES_DATABASE_ID,
+                filter={
+                    "and": [
+                        {"property": "Data", "date": {"on_or_after": date_from}},
+                        {"property": "Data", "date": {"on_or_before": date_to}},
+                    ]
+                },
+                sorts=[{"property": "Data", "direction": "ascending"}],
+            )
+        ) as pages:
+            async for page in pages:
+                row = expense_row_from_page(page)
+                yield (row[1], *row[3:7])
+
+
+class AirtableBackend(StorageBackend):
+    name = "airtable"
+
+    async def add_expense(self, date, category, account, amount, description):
+        return await add_expense_to_airtable(
+            date, category, account, amount, description
+        )
+
+    async def add_expenses(self, expenses):
+        return 200, {"records": await add_expenses_to_airtable(expenses)}
+
+    async def write_budget(self, category, month, budget, remaining):
+        return await upsert_budget_in_airtable(category, month, budget, remaining)
+
+    async def get_budget(self, category, month):
+        record = await get_budget_from_airtable(category, month_key(month))
+        if record is None:
+            return None
+        return record["fields"].get("Budget"), record["fields"].get("Remaining")
+
+    async def set_remaining(self, category, month, remaining):
+        record = await get_budget_from_airtable(category, month_key(month))
+        if record is None:
+            return 200, {}
+        return await update_budget_in_airtable(record["id"], remaining)
+
+    async def month_budgets(self, month):
+        airtable_budget_snapshot.invalidate(month)
+        records = await airtable_budget_snapshot.month(month)
+        return {
+            category: (
+                record["id"],
+                record["fields"].get("Budget"),
+                record["fields"].get("Remaining"),
+            )
+            for category, record in records.items()
+        }
+
+    async def set_remaining_batch(self, updates):
+        await update_budgets_in_airtable(updates)
+        return 200, {}
+
+    async def iter_expenses(self, date_from, date_to):
+        async for record in iter_airtable_expenses(date_from, date_to):
+            fields = record["fields"]
+            yield (
+                fields.get("Date", ""),
+                fields.get("Category", ""),
+                fields.get("Account", ""),
+                fields.get("Amount", 0),
+                fields.get("Description", ""),
+            )
+
+    async def sync_remaining_batch(self, keys):
+        updates = {}
+        for category, month in keys:
+            await ensure_ledger_budget(category, month, backends=(self.name,))
+            ledger_budget = get_ledger_budget(category, month)
+            record = await get_budget_from_airtable(category, month_key(month))
+            if ledger_budget is not None and record is not None:
+                updates[record["id"]] = ledger_budget[1]
+        await update_budgets_in_airtable(list(updates.items()))
+        return 200, {}
+
+
+STORAGE_BACKENDS = {
+    backend.name: backend for backend in (NotionBackend(), AirtableBackend())
+}
+ENABLED_BACKENDS = tuple(
+    name.strip()
+    for name in os.environ.get("STORAGE_BACKENDS", "notion").split(",")
+    if name.strip()
+)
+
+
+BACKEND_WRITE_METHODS = (
+    "add_expense",
+    "add_expenses",
+    "upsert_budget",
+    "set_remaining",
+    "sync_remaining",
+    "sync_remaining_batch",
+)
+
+
+async def call_backend(backend, method, *args):
+    try:
+        value = await getattr(backend, method)(*args)
+    except (httpx.HTTPError, requests.RequestException) as e:
+        return BackendResult(backend.name, False, None, repr(e))
+    except Exception as e:
+        # Nieoczekiwany błąd (np. brak pola w odpowiedzi) to też nieudane
+        # wywołanie - inaczej przerwałby cały gather i wpis nie dostałby backoffu
+        logger.exception("%s on %s raised unexpectedly", method, backend.name)
+        return BackendResult(backend.name, False, None, repr(e))
+    # Metody zapisujące zwracają (status_code, odpowiedź)
+    if method in BACKEND_WRITE_METHODS and value[0] != 200:
+        return BackendResult(backend.name, False, value, f"{value[0]}: {value[1]}")
+    return BackendResult(backend.name, True, value, None)
+
+
+async def fan_out(method, *args, backends=None):
+    names = backends or ENABLED_BACKENDS
+    results = await asyncio.gather(
+        *(call_backend(STORAGE_BACKENDS[name], method, *args) for name in names)
+    )
+    failed = [result for result in results if not result.ok]
+    if failed:
+        logger.warning(
+            "%s failed on %s of %s backends: %s",
+            method,
+            len(failed),
+            len(results),
+            {result.backend: result.error for result in failed},
+        )
+    return {result.backend: result for result in results}
+
+
+# Lokalna kopia bazy wydatków Notion - synchronizowane są tylko strony
+# zmienione od ostatniego znacznika last_edited_time
+MIRROR_SYNC_INTERVAL = float(os.environ.get("MIRROR_SYNC_INTERVAL", "300"))
+MIRROR_FULL_SWEEP_EVERY = int(os.environ.get("MIRROR_FULL_SWEEP_EVERY", "12"))
+MIRROR_BATCH_SIZE = 100
+
+_mirror_lock = asyncio.Lock()
+_mirror_runs = 0
+
+
+def get_sync_state(name):
+    row = (
+        get_db()
+        .execute("SELECT value FROM sync_state WHERE name = ?", (name,))
+        .fetchone()
+    )
+    return row["value"] if row else None
+
+
+def set_sync_state(db, name, value):
+    db.execute(
+        """
+        INSERT INTO sync_state (name, value) VALUES (?, ?)
+        ON CONFLICT (name) DO UPDATE SET value = excluded.value
+        """,
+        (name, value),
+    )
+
+
+def _plain_text(items):
+    return "".join(
+        item.get("plain_text") or item.get("text", {}).get("content", "")
+        for item in items or []
+    )
+
+
+def expense_row_from_page(page):
+    properties = page["properties"]
+    date = (properties["Data"]["date"] or {}).get("start") or page["created_time"]
+    return (
+        page["id"],
+        date[:10],
+        month_key(date),
+        _plain_text(properties["Kategoria"]["title"]),
+        _plain_text(properties["Konto"]["rich_text"]),
+        properties["Wydatek"]["number"] or 0,
+        _plain_text(properties["Opis"]["rich_text"]),
+        page["last_edited_time"],
+    )
+
+
+def link_expense_page(payload, page):
+    # Wydatek dodany przez bota dostaje id strony, więc synchronizacja go nie zdubluje
+    expense_id = payload.get("expense_id")
+    if expense_id is None or "id" not in page:
+        return
+    with get_db() as db:
+        db.execute(
+            "DELETE FROM expenses WHERE page_id = ? AND id != ?",
+            (page["id"], expense_id),
+        )
+        db.execute(
+            "UPDATE expenses SET page_id = ?, last_edited_time = ? WHERE id = ?",
+            (page["id"], page.get("last_edited_time"), expense_id),
+        )
+
+
+def _apply_mirror_batch(rows, removed_ids, high_water_mark):
+    with get_db() as db:
+        db.executemany(
+            """
+            INSERT INTO expenses (page_id, date, month, category, account, amount,
+                                  description, last_edited_time)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (page_id) DO UPDATE
+            SET date = excluded.date, month = excluded.month,
+                category = excluded.category, account = excluded.account,
+                amount = excluded.amount, description = excluded.description,
+                last_edited_time = excluded.last_edited_time
+            """,
+            rows,
+        )
+        db.executemany(
+            "DELETE FROM expenses WHERE page_id = ?",
+            [(page_id,) for page_id in removed_ids],
+        )
+        if high_water_mark:
+            set_sync_state(db, "expenses_high_water_mark", high_water_mark)
+    invalidate_reports({row[2] for row in rows} if not removed_ids else None)
+    budget_totals.invalidate({row[2] for row in rows} if not removed_ids else None)
+
+
+async def _sweep_deleted_expenses():
+    # Zapytania do bazy nie zwracają stron usuniętych/zarchiwizowanych, więc
+    # co jakiś czas porównujemy same identyfikatory stron
+    existing = set()
+    async for page in iter_notion_query(
+        NOTION_EXPENSES_DATABASE_ID, filter_properties=["title"]
+    ):
+        existing.add(page["id"])
+    local = {
+        row["page_id"]
+        for row in get_db().execute(
+            "SELECT page_id FROM expenses WHERE page_id IS NOT NULL"
+        )
+    }
+    removed = local - existing
+    _apply_mirror_batch([], removed, None)
+    return len(removed)
+
+
+async def sync_expense_mirror(context=None, full_sweep=None):
+    global _mirror_runs
+    if _mirror_lock.locked():
+        return None
+    async with _mirror_lock:
+        _mirror_runs += 1
+        if full_sweep is None:
+            full_sweep = (_mirror_runs - 1) % MIRROR_FULL_SWEEP_EVERY == 0
+        high_water_mark = get_sync_state("expenses_high_water_mark")
+        query_filter = None
+        if high_water_mark:
+            query_filter = {
+                "timestamp": "last_edited_time",
+                "last_edited_time": {"on_or_after": high_water_mark},
+            }
+        rows, removed_ids = [], []
+        upserted = removed = 0
+        async for page in iter_notion_query(
+            NOTION_EXPENSES_DATABASE_ID,
+            filter=query_filter,
+            sorts=[{"timestamp": "last_edited_time", "direction": "ascending"}],
+        ):
+            if page.get("archived") or page.get("in_trash"):
+                removed_ids.append(page["id"])
+            else:
+                rows.append(expense_row_from_page(page))
+            high_water_mark = max(high_water_mark or "", page["last_edited_time"])
+            if len(rows) + len(removed_ids) >= MIRROR_BATCH_SIZE:
+                _apply_mirror_batch(rows, removed_ids, high_water_mark)
+                upserted += len(rows)
+                removed += len(removed_ids)
+                rows, removed_ids = [], []
+        _apply_mirror_batch(rows, removed_ids, high_water_mark)
+        upserted += len(rows)
+        removed += len(removed_ids)
+        if full_sweep:
+            removed += await _sweep_deleted_expenses()
+        if upserted or removed:
+            logger.info("Expense mirror: %s updated, %s removed", upserted, removed)
+        return {"updated": upserted, "removed": removed}
+
+
+def get_mirrored_expenses(date_from, date_to):
+    return (
+        get_db()
+        .execute(
+            "SELECT * FROM expenses WHERE date BETWEEN ? AND ? ORDER BY date, id",
+            (date_from, date_to),
+        )
+        .fetchall()
+    )
+
+
+# Uzgadnianie pozostałych kwot - okresowe przeliczenie budżetów miesiąca
+# z wydatków, które naprawia skutki nieudanych lub zdublowanych zapisów
+RECONCILE_INTERVAL = float(os.environ.get("RECONCILE_INTERVAL", "86400"))
+RECONCILE_BATCH_SIZE = int(os.environ.get("RECONCILE_BATCH_SIZE", "10"))
+RECONCILE_TOLERANCE = 0.005
+# Opóźnienie po starcie, gdy przebieg jest zaległy - po rozgrzaniu cache
+RECONCILE_MIN_DELAY = 60.0
+
+
+def reconcile_ledger(month, expected_remaining, skip=()):
+    # Lokalna tabela wydatków nie jest pełna (Airtable - tylko wydatki z bota,
+    # Notion - tyle, ile zsynchronizowała kopia), więc księga przejmuje kwoty
+    # przeliczone z danych backendu; pomijane są klucze z niewysłanymi zapisami
+    month = month_key(month)
+    with get_db() as db:
+        rows = db.execute(
+            "SELECT category, remaining FROM budgets WHERE month = ?", (month,)
+        ).fetchall()
+        corrections = [
+            (row["category"], row["remaining"], expected_remaining[row["category"]])
+            for row in rows
+            if row["category"] in expected_remaining
+            and (row["category"], month) not in skip
+            and abs(row["remaining"] - expected_remaining[row["category"]])
+            > RECONCILE_TOLERANCE
+        ]
+        db.executemany(
+            "UPDATE budgets SET remaining = ? WHERE category = ? AND month = ?",
+            [(expected, category, month) for category, _, expected in corrections],
+        )
+    return corrections
+
+
+def pending_outbox_keys(backend):
+    # (kategoria, miesiąc) z niewysłanymi jeszcze zapisami - ich stan w backendzie
+    # jest chwilowo niepełny, więc uzgadnianie je pomija
+    keys = set()
+    rows = get_db().execute(
+        "SELECT kind, ordering_key, payload FROM outbox"
+        " WHERE status = 'pending' AND kind LIKE ?",
+        (f"{backend}_%",),
+    )
+    for row in rows:
+        if row["kind"].endswith("_expense_batch"):
+            keys.update(
+                (expense["category"], month_key(expense["date"]))
+                for expense in json.loads(row["payload"])["expenses"]
+            )
+        else:
+            keys.add(tuple(row["ordering_key"].split("|", 1)))
+    return keys
+
+
+async def reconcile_month(month, backends=None):
+    # Zwraca {"ledger": poprawki, backend: BackendResult z poprawkami};
+    # poprawka to (kategoria, było, jest). Księga idzie za pierwszym backendem.
+    month = month_key(month)
+    names = backends or ENABLED_BACKENDS
+    # Blokada kolejki - uzgadnianie nie przeplata się z wysyłką zapisów
+    async with _outbox_lock:
+        results = await asyncio.gather(
+            *(
+                call_backend(
+                    STORAGE_BACKENDS[name],
+                    "reconcile",
+                    month,
+                    pending_outbox_keys(name),
+                )
+                for name in names
+            )
+        )
+        primary = results[0]
+        ledger = []
+        if primary.ok:
+            # Klucze sprawdzane ponownie - wydatki dodane w trakcie pobierania
+            # są w księdze, ale jeszcze nie w backendzie
+            ledger = reconcile_ledger(
+                month, primary.value["remaining"], pending_outbox_keys(primary.backend)
+            )
+    report = {"ledger": ledger}
+    report.update((result.backend, result) for result in results)
+    corrected = {
+        name: len(result)
+        if name == "ledger"
+        else len(result.value["corrections"] if result.ok else ())
+        for name, result in report.items()
+    }
+    failed = [result for result in results if not result.ok]
+    if any(corrected.values()) or failed:
+        logger.info("Reconciliation of %s corrected %s", month, corrected)
+    for result in failed:
+        logger.warning(
+            "Reconciliation of %s failed for %s: %s",
+            month,
+            result.backend,
+            result.error,
+        )
+    return report
+
+
+def format_reconciliation(month, report):
+    lines = [f"Uzgadnianie budżetów za {month_key(month)}"]
+    for name, result in report.items():
+        if name == "ledger":
+            corrections = result
+        elif not result.ok:
+            lines.append(f"{name}: błąd - {result.error}")
+            continue
+        else:
+            corrections = result.value["corrections"]
+        if not corrections:
+            lines.append(f"{name}: bez zmian")
+            continue
+        lines.append(f"{name}: poprawiono {len(corrections)}")
+        lines += [
+            f"  {category}: {before} -> {after:.2f}"
+            for category, before, after in corrections
+        ]
+    return "\n".join(lines)
+
+
+async def reconcile_budgets(context=None):
+    # Bieżący miesiąc; na początku miesiąca także poprzedni, do którego mogły
+    # jeszcze trafić spóźnione zapisy
+    today = datetime.now()
+    months = [today.strftime("%Y-%m")]
+    if today.day <= 3:
+        months.append((today.replace(day=1) - timedelta(days=1)).strftime("%Y-%m"))
+    reports = {month: await reconcile_month(month) for month in months}
+    with get_db() as db:
+        set_sync_state(db, "reconcile_last_run", time.time())
+    return reports
+
+
+def reconcile_first_delay():
+    # Liczone od ostatniego przebiegu zapisanego w bazie - restarty i wdrożenia
+    # częstsze niż RECONCILE_INTERVAL nie odsuwają uzgadniania w nieskończoność
+    last_run = get_sync_state("reconcile_last_run")
+    if last_run is None:
+        return RECONCILE_MIN_DELAY
+    return max(RECONCILE_MIN_DELAY, float(last_run) + RECONCILE_INTERVAL - time.time())
+
+
+# Raport miesięczny liczony lokalnie w SQLite (GROUP BY po indeksie
+# (month, category)) - bez zapytań do Notion dla każdej kategorii
+_report_cache = {}
+
+
+def invalidate_reports(months=None):
+    if months is None:
+        _report_cache.clear()
+        return
+    for month in months:
+        _report_cache.pop(month_key(month), None)
+
+
+def build_monthly_report(month):
+    month = month_key(month)
+    current_month = datetime.now().strftime("%Y-%m")
+    # Zamknięte miesiące się nie zmieniają, więc ich raporty trzymamy w pamięci
+    if month < current_month and month in _report_cache:
+        return _report_cache[month]
+
+    db = get_db()
+    by_category = db.execute(
+        """
+        SELECT category, SUM(amount) AS spent, COUNT(*) AS count
+        FROM expenses WHERE month = ?
+        GROUP BY category ORDER BY spent DESC
+        """,
+        (month,),
+    ).fetchall()
+    by_account = db.execute(
+        """
+        SELECT account, SUM(amount) AS spent
+        FROM expenses WHERE month = ?
+        GROUP BY account ORDER BY spent DESC
+        """,
+        (month,),
+    ).fetchall()
+    budgets = db.execute(
+        """
+        SELECT b.category, b.budget, COALESCE(SUM(e.amount), 0) AS spent
+        FROM budgets b
+        LEFT JOIN expenses e ON e.month = b.month AND e.category = b.category
+        WHERE b.month = ?
+        GROUP BY b.category, b.budget ORDER BY b.category
+        """,
+        (month,),
+    ).fetchall()
+
+    year, month_number = map(int, month.split("-"))
+    days_in_month = calendar.monthrange(year, month_number)[1]
+    if month == current_month:
+        days_elapsed = datetime.now().day
+    else:
+        days_elapsed = days_in_month if month < current_month else 0
+    total = sum(row["spent"] for row in by_category)
+    daily_burn = total / days_elapsed if days_elapsed else 0.0
+
+    report = {
+        "month": month,
+        "total": total,
+        "by_category": [(row["category"], row["spent"]) for row in by_category],
+        "by_account": [(row["account"], row["spent"]) for row in by_account],
+        "budgets": [(row["category"], row["budget"], row["spent"]) for row in budgets],
+        "daily_burn": daily_burn,
+        "projected": daily_burn * days_in_month,
+    }
+    if month < current_month:
+        _report_cache[month] = report
+    return report
+
+
+def format_report(report):
+    lines = [
+        f"Raport za {report['month']}",
+        f"Wydano łącznie: {report['total']:.2f} PLN",
+    ]
+    if report["by_category"]:
+        lines.append("\nWedług kategorii:")
+        lines += [f"{name}: {spent:.2f}" for name, spent in report["by_category"]]
+    if report["by_account"]:
+        lines.append("\nWedług kont:")
+        lines += [f"{name}: {spent:.2f}" for name, spent in report["by_account"]]
+    if report["budgets"]:
+        lines.append("\nBudżet / wydano:")
+        lines += [
+            f"{name}: {spent:.2f} / {budget:.2f} ({spent / budget:.0%})"
+            if budget
+            else f"{name}: {spent:.2f} / {budget:.2f}"
+            for name, budget, spent in report["budgets"]
+        ]
+    lines.append(
+        f"\nŚrednio dziennie: {report['daily_burn']:.2f} PLN, "
+        f"prognoza na koniec miesiąca: {report['projected']:.2f} PLN"
+    )
+    return "\n".join(lines)
+
+
+# Alerty budżetowe z bieżących sum (kategoria, miesiąc) trzymanych w pamięci -
+# sprawdzenie po wydatku to kilka operacji na słowniku, bez zapytań do backendów
+ALERT_THRESHOLDS = tuple(
+    sorted(
+        float(share)
+        for share in os.environ.get("ALERT_THRESHOLDS", "0.8,1.0").split(",")
+        if share.strip()
+    )
+)
+# Prognoza z kilku pierwszych dni miesiąca jest zbyt niepewna
+ALERT_PROJECTION_MIN_DAY = int(os.environ.get("ALERT_PROJECTION_MIN_DAY", "7"))
+DIGEST_TIME = os.environ.get("DIGEST_TIME", "20:00")
+DIGEST_CHAT_IDS = {
+    int(chat_id)
+    for chat_id in os.environ.get("DIGEST_CHAT_IDS", "").split(",")
+    if chat_id.strip()
+} or ADMIN_CHAT_IDS
+
+
+def projected_spend(spent, month, today=None):
+    today = today or datetime.now()
+    if month != today.strftime("%Y-%m") or today.day < ALERT_PROJECTION_MIN_DAY:
+        return None
+    days_in_month = calendar.monthrange(today.year, today.month)[1]
+    return spent / today.day * days_in_month
+
+
+class BudgetTotals:
+    def __init__(self):
+        self._totals = {}
+        self._loaded_months = set()
+
+    def _crossed(self, entry, today=None):
+        budget = entry["budget"]
+        if not budget:
+            return set()
+        crossed = {t for t in ALERT_THRESHOLDS if entry["spent"] >= budget * t}
+        projected = projected_spend(entry["spent"], entry["month"], today)
+        if projected is not None and projected > budget:
+            crossed.add("projection")
+        return crossed
+
+    def _entry(self, category, month, budget, spent, pending=0):
+        # Progi przekroczone przed załadowaniem sum nie są zgłaszane ponownie;
+        # pending to wydatek już zapisany w bazie, którego próg ma jeszcze
+        # zostać zgłoszony
+        entry = {"month": month, "budget": budget, "spent": spent - pending}
+        entry["alerted"] = self._crossed(entry)
+        entry["spent"] = spent
+        self._totals[(category, month)] = entry
+        return entry
+
+    def get(self, category, month, pending=0):
+        month = month_key(month)
+        entry = self._totals.get((category, month))
+        if entry is not None:
+            return entry
+        db = get_db()
+        spent = db.execute(
+            "SELECT COALESCE(SUM(amount), 0) FROM expenses"
+            " WHERE category = ? AND month = ?",
+            (category, month),
+        ).fetchone()[0]
+        row = db.execute(
+            "SELECT budget FROM budgets WHERE category = ? AND month = ?",
+            (category, month),
+        ).fetchone()
+        return self._entry(
+            category, month, row["budget"] if row else None, spent, pending
+        )
+
+    def add(self, category, month, amount):
+        # Wywoływane po zapisie wydatku - sumy jeszcze nie załadowane policzy
+        # zapytanie, które już go uwzględnia
+        entry = self._totals.get((category, month_key(month)))
+        if entry is None:
+            self.get(category, month, pending=amount)
+        else:
+            entry["spent"] += amount
+
+    def set_budget(self, category, month, budget):
+        entry = self._totals.get((category, month_key(month)))
+        if entry is not None:
+            entry["budget"] = budget
+            entry["alerted"] = self._crossed(entry)
+
+    def month(self, month):
+        # Wszystkie kategorie z budżetem lub wydatkami w miesiącu - jedno
+        # zapytanie przy pierwszym odczycie, potem same sumy z pamięci
+        month = month_key(month)
+        if month not in self._loaded_months:
+            rows = (
+                get_db()
+                .execute(
+                    """
+                SELECT category, MAX(budget) AS budget, SUM(spent) AS spent
+                FROM (
+                    SELECT category, budget, 0 AS spent FROM budgets
+                    WHERE month = ?
+                    UNION ALL
+                    SELECT category, NULL, amount FROM expenses WHERE month = ?
+                )
+                GROUP BY category
+                """,
+                    (month, month),
+                )
+                .fetchall()
+            )
+            for row in rows:
+                if (row["category"], month) not in self._totals:
+                    self._entry(row["category"], month, row["budget"], row["spent"])
+            self._loaded_months.add(month)
+        return {
+            category: entry
+            for (category, entry_month), entry in self._totals.items()
+            if entry_month == month
+        }
+
+    def check(self, category, month, today=None):
+        # Zwraca progi przekroczone od poprzedniego sprawdzenia i je zapamiętuje
+        entry = self.get(category, month)
+        new = self._crossed(entry, today) - entry["alerted"]
+        entry["alerted"] |= new
+        return entry, new
+
+    def invalidate(self, months=None):
+        if months is None:
+            self._totals.clear()
+            self._loaded_months.clear()
+            return
+        months = {month_key(month) for month in months}
+        self._totals = {
+            key: entry for key, entry in self._totals.items() if key[1] not in months
+        }
+        self._loaded_months -= months
+
+
+budget_totals = BudgetTotals()
+
+
+def budget_alerts(category, month, today=None):
+    entry, new = budget_totals.check(category, month, today)
+    budget = entry["budget"]
+    alerts = []
+    thresholds = [t for t in new if t != "projection"]
+    if thresholds:
+        alerts.append(
+            f"Uwaga: wydano {entry['spent'] / budget:.0%} budżetu kategorii "
+            f"{category} ({entry['spent']:.2f} z {budget:.2f} PLN)."
+        )
+    if "projection" in new:
+        projected = projected_spend(entry["spent"], entry["month"], today)
+        alerts.append(
+            f"Uwaga: przy obecnym tempie wydatki w kategorii {category} wyniosą "
+            f"{projected:.2f} PLN i przekroczą budżet {budget:.2f} PLN."
+        )
+    return alerts
+
+
+def format_digest(today=None):
+    today = today or datetime.now()
+    month = today.strftime("%Y-%m")
+    totals = budget_totals.month(month)
+    lines = [f"Podsumowanie dnia {today:%Y-%m-%d}"]
+    for category, entry in sorted(totals.items()):
+        spent, budget = entry["spent"], entry["budget"]
+        line = f"{category}: {spent:.2f}"
+        if budget:
+            line += f" / {budget:.2f} ({spent / budget:.0%})"
+        projected = projected_spend(spent, month, today)
+        if projected is not None:
+            line += f", prognoza {projected:.2f}"
+        lines.append(line)
+    if len(lines) == 1:
+        lines.append("Brak wydatków i budżetów w tym miesiącu.")
+    return "\n".join(lines)
+
+
+async def send_daily_digest(context: CallbackContext) -> None:
+    text = format_digest()
+    for chat_id in DIGEST_CHAT_IDS:
+        try:
+            await context.bot.send_message(chat_id, text)
+        except Exception:
+            logger.exception("Sending daily digest to %s failed", chat_id)
+
+
+def digest_time():
+    hour, minute = map(int, DIGEST_TIME.split(":"))
+    return dt_time(hour, minute, tzinfo=datetime.now().astimezone().tzinfo)
+
+
+# Eksport wydatków - wiersze zapisywane do skompresowanego pliku na bieżąco,
+# przy zapisie w pamięci jest najwyżej jedna strona wyników i EXPORT_SPOOL_BYTES
+# danych; wysyłka do Telegrama wczytuje cały plik, więc jego rozmiar po
+# kompresji ogranicza EXPORT_MAX_BYTES (limit Bot API to 50 MB)
+EXPORT_SPOOL_BYTES = int(os.environ.get("EXPORT_SPOOL_BYTES", str(1024 * 1024)))
+EXPORT_MAX_BYTES = int(os.environ.get("EXPORT_MAX_BYTES", str(20 * 1024 * 1024)))
+EXPORT_HEADER = ("Data", "Kategoria", "Konto", "Kwota", "Opis")
+
+
+class ExportTooLarge(Exception):
+    pass
+
+
+def export_period(value, end=False):
+    # YYYY, YYYY-MM albo YYYY-MM-DD -> pierwszy lub ostatni dzień okresu
+    for date_format in ("%Y-%m-%d", "%Y-%m", "%Y"):
+        try:
+            date = datetime.strptime(value, date_format)
+            break
+        except ValueError:
+            continue
+    else:
+        raise ValueError(value)
+    if not end or date_format == "%Y-%m-%d":
+        return date.strftime("%Y-%m-%d")
+    if date_format == "%Y":
+        return f"{date.year}-12-31"
+    last_day = calendar.monthrange(date.year, date.month)[1]
+    return f"{date.year}-{date.month:02d}-{last_day:02d}"
+
+
+async def write_expense_export(rows, fileobj, max_bytes=None):
+    count = 0
+    with gzip.GzipFile(fileobj=fileobj, mode="wb") as compressed:
+        text = io.TextIOWrapper(compressed, encoding="utf-8", newline="")
+        writer = csv.writer(text)
+        writer.writerow(EXPORT_HEADER)
+        async for row in rows:
+            writer.writerow(row)
+            count += 1
+            # Przerwanie od razu, bez pobierania reszty wyników
+            if max_bytes and fileobj.tell() > max_bytes:
+                raise ExportTooLarge(max_bytes)
+        # Odłączenie, żeby zamknięcie tekstu nie zamknęło pliku wywołującego
+        text.flush()
+        text.detach()
+    if max_bytes and fileobj.tell() > max_bytes:
+        raise ExportTooLarge(max_bytes)
+    fileobj.seek(0)
+    return count
+
+
 # Funkcja, która obsługuje komendę /start
 async def start(update: Update, context: CallbackContext) -> None:
     start_message = (
@@ -279,7 +2833,11 @@ async def start(update: Update, context: CallbackContext) -> None:
         "/add KATEGORIA KONTO WYDATEK OPIS - Dodaj wydatek. Przykład: /add Jedzenie Konto1 50.00 Obiad\n"
         "/setbudget KATEGORIA BUDŻET MIESIĄC - Ustaw budżet na kategorię. Przykład: /setbudget Jedzenie 1000 2024-06\n"
         "/getcategories - Wyświetl dostępne kategorie.\n"
-        "/addcategory KATEGORIA - Dodaj nową kategorię.\n\n"
+        "/addcategory KATEGORIA - Dodaj nową kategorię.\n"
+        "/report [YYYY-MM] - Raport wydatków za miesiąc.\n"
+        "/export [OD] [DO] - Eksport wydatków do pliku CSV. Przykład: /export 2024\n"
+        "KWOTA KATEGORIA KONTO OPIS - Szybkie dodanie wydatku, kilka linii naraz.\n"
+        "Plik CSV (Data, Kategoria, Kwota, Konto, Opis) - Import wielu wydatków naraz.\n\n"
         "Uwaga: Wszystkie kwoty są w PLN. Wydatki i budżety są skorelowane z interwałem miesięcznym."
         "Kolejne funkcjonalnści w implementacji"
         "Wydaj mi komendę a ja będę działać.."
@@ -287,75 +2845,224 @@ async def start(update: Update, context: CallbackContext) -> None:
     await update.message.reply_text(start_message)
 
 
-async def set_budget(update: Update, context: CallbackContext) -> None:
-    categories = get_categories_from_notion()
+# Klawiatury kategorii - stronicowane, a przyciski niosą tylko krótkie id
+# "prefiks:wersja:indeks" zamiast nazwy kategorii (limit 64 bajtów callback_data)
+CATEGORY_PAGE_SIZE = int(os.environ.get("CATEGORY_PAGE_SIZE", "12"))
+CATEGORY_KEYBOARD_COLUMNS = 3
+
+
+class CategoryKeyboards:
+    # Posortowane listy kategorii pod skrótem ich zawartości; kilka ostatnich
+    # wersji zostaje w pamięci, więc starsze klawiatury nadal działają. Skrót
+    # nie zależy od procesu, więc po restarcie id ze starej klawiatury albo
+    # wskazuje tę samą listę, albo jest odrzucane - nigdy inną kategorię
+    def __init__(self, keep=4):
+        self.keep = keep
+        self._versions = OrderedDict()
+
+    @staticmethod
+    def version_of(categories):
+        content = "\n".join(categories).encode()
+        return hashlib.blake2b(content, digest_size=4).hexdigest()
+
+    def register(self, categories):
+        categories = sorted(categories, key=str.lower)
+        version = self.version_of(categories)
+        self._versions[version] = categories
+        self._versions.move_to_end(version)
+        while len(self._versions) > self.keep:
+            self._versions.popitem(last=False)
+        return version
+
+    def categories(self, version):
+        return self._versions.get(version)
+
+    def resolve(self, version, index):
+        categories = self._versions.get(version)
+        if categories is None or not 0 <= index < len(categories):
+            return None
+        return categories[index]
+
+
+category_keyboards = CategoryKeyboards()
+
+
+def category_keyboard(prefix, version, page=0):
+    categories = category_keyboards.categories(version) or []
+    pages = max(1, -(-len(categories) // CATEGORY_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    first = page * CATEGORY_PAGE_SIZE
+    buttons = [
+        InlineKeyboardButton(category, callback_data=f"{prefix}:{version}:{index}")
+        for index, category in enumerate(
+            categories[first : first + CATEGORY_PAGE_SIZE], start=first
+        )
+    ]
+    keyboard = [
+        buttons[i : i + CATEGORY_KEYBOARD_COLUMNS]
+        for i in range(0, len(buttons), CATEGORY_KEYBOARD_COLUMNS)
+    ]
+    navigation = []
+    if page > 0:
+        navigation.append(
+            InlineKeyboardButton("«", callback_data=f"{prefix}:{version}:p{page - 1}")
+        )
+    if page < pages - 1:
+        navigation.append(
+            InlineKeyboardButton("»", callback_data=f"{prefix}:{version}:p{page + 1}")
+        )
+    if navigation:
+        keyboard.append(navigation)
+    return InlineKeyboardMarkup(keyboard), f"Wybierz kategorię ({page + 1}/{pages}):"
+
+
+async def reply_category_keyboard(update, prefix):
+    categories = await get_categories_from_notion()
     if not categories:
         await update.message.reply_text("Nie znaleziono żadnych kategorii.")
         return
+    reply_markup, text = category_keyboard(
+        prefix, category_keyboards.register(categories)
+    )
+    if category_cache.degraded:
+        text += STALE_CATEGORIES_NOTE
+    await update.message.reply_text(text, reply_markup=reply_markup)
+
+
+async def resolve_category_callback(query, prefix):
+    # Zmiana strony edytuje klawiaturę bez zapytań do backendu; zwraca wybraną
+    # kategorię albo None
+    _, version, item = query.data.split(":")
+    if category_keyboards.categories(version) is None:
+        # Nieznana wersja (np. klawiatura sprzed restartu) - bieżąca lista
+        # z pamięci podręcznej; pasuje tylko, gdy kategorie się nie zmieniły
+        category_keyboards.register(await get_categories_from_notion())
+    if item.startswith("p"):
+        await query.answer()
+        if category_keyboards.categories(version) is None:
+            await query.edit_message_text(
+                "Lista kategorii się zmieniła - wybierz ponownie."
+            )
+            return None
+        reply_markup, text = category_keyboard(prefix, version, int(item[1:]))
+        await query.edit_message_text(text, reply_markup=reply_markup)
+        return None
+    category = category_keyboards.resolve(version, int(item))
+    if category is None:
+        await query.answer("Lista kategorii się zmieniła - wybierz ponownie.")
+        return None
+    await query.answer()
+    return category
 
-    keyboard = [
-        [
-            InlineKeyboardButton(category, callback_data=f"setbudget_{category}")
-            for category in categories
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
 
-    await update.message.reply_text("Wybierz kategorię:", reply_markup=reply_markup)
+async def set_budget(update: Update, context: CallbackContext) -> None:
+    await reply_category_keyboard(update, "sb")
 
 
 async def set_budget_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
-    await query.answer()
-    category = query.data.split("_")[1]
+    if query.data.startswith("setbudget_"):
+        # Klawiatury wysłane przed zmianą formatu callback_data
+        await query.answer()
+        category = query.data.split("_", 1)[1]
+    else:
+        category = await resolve_category_callback(query, "sb")
+        if category is None:
+            return
     context.user_data["selected_category"] = category
     await query.edit_message_text(
         text=f"Wybrana kategoria: {category}. Podaj kwotę budżetu i miesiąc w formacie BUDŻET YYYY-MM (brak daty=aktualny miesiąc) "
     )
 
 
-async def handle_expense_input(update: Update, context: CallbackContext) -> None:
-    try:
-        text = update.message.text.split(maxsplit=3)
-        if len(text) < 4:
-            await update.message.reply_text(
-                "Błędny format. Użyj: WYDATEK KWOTA KATEGORIA OPIS; Sprobuj ponownie"
-            )
-            return
+def parse_quick_expenses(text, categories):
+    # Każda linia to jeden wydatek: KWOTA KATEGORIA KONTO [OPIS]
+    known = {category.lower(): category for category in categories}
+    date = datetime.now().strftime("%Y-%m-%d")
+    expenses, errors = [], []
+    for line_no, line in enumerate(text.splitlines(), start=1):
+        parts = line.split(maxsplit=3)
+        if not parts:
+            continue
+        if len(parts) < 3:
+            errors.append((line_no, "oczekiwano: KWOTA KATEGORIA KONTO [OPIS]"))
+            continue
+        try:
+            amount = float(parts[0].replace(",", "."))
+        except ValueError:
+            errors.append((line_no, f"błędna kwota {parts[0]}"))
+            continue
+        category = known.get(parts[1].lower(), parts[1] if not known else None)
+        if category is None:
+            errors.append((line_no, f"nieznana kategoria {parts[1]}"))
+            continue
+        expenses.append(
+            {
+                "date": date,
+                "category": category,
+                "account": parts[2],
+                "amount": amount,
+                "description": parts[3] if len(parts) > 3 else "",
+            }
+        )
+    return expenses, errors
 
-        amount = float(text[1])
-        category = text[2]
-        description = text[3]
 
-        # Dodaj wydatek do Notion
-        status_code, response = add_expense_to_notion(category, amount, description)
-        if status_code != 200:
-            await update.message.reply_text(
-                f"Wystąpił błąd podczas dodawania wydatku do Notion: {response}"
-            )
+def format_remaining(remaining):
+    lines = []
+    for (category, month), value in sorted(remaining.items()):
+        if value is None:
+            lines.append(f"{category} ({month}): brak znanego budżetu")
+        else:
+            lines.append(f"{category} ({month}): pozostało {value} PLN")
+    return lines
+
+
+def format_alerts(remaining):
+    lines = []
+    for category, month in sorted(remaining):
+        lines += budget_alerts(category, month)
+    return lines
+
+
+async def handle_expense_input(update: Update, context: CallbackContext) -> None:
+    try:
+        # Szybkie dodawanie - kilka wydatków w jednej wiadomości, zapisanych razem
+        expenses, errors = parse_quick_expenses(
+            update.message.text, await get_categories_from_notion()
+        )
+        if errors or not expenses:
+            lines = ["Błędny format. Użyj: KWOTA KATEGORIA KONTO OPIS (jeden na linię)"]
+            lines += [f"Linia {line_no}: {error}" for line_no, error in errors]
+            await update.message.reply_text("\n".join(lines))
             return
 
-        await update.message.reply_text(
-            f"Dodano wydatek: {amount} {category} - {description}"
+        keys = {(e["category"], month_key(e["date"])) for e in expenses}
+        await asyncio.gather(*(ensure_ledger_budget(c, m) for c, m in keys))
+        remaining = record_expenses(
+            expenses, ENABLED_BACKENDS, idempotency_key=update_key(update)
         )
+        schedule_outbox_flush(context)
+
+        total = sum(expense["amount"] for expense in expenses)
+        lines = [f"Dodano wydatków: {len(expenses)} na kwotę {total} PLN."]
+        lines += format_remaining(remaining)
+        lines += format_alerts(remaining)
+        await update.message.reply_text("\n".join(lines) + stale_note())
     except Exception as e:
         await update.message.reply_text(f"Wystąpił błąd: {e}")
 
 
 async def choose_category(update: Update, context: CallbackContext) -> None:
-    categories = get_categories_from_notion()
-    keyboard = [
-        [InlineKeyboardButton(category, callback_data=category)]
-        for category in categories
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("Wybierz kategorię:", reply_markup=reply_markup)
+    await reply_category_keyboard(update, "cc")
 
 
 # Funkcja obsługi callback dla wyboru kategorii
 async def handle_category_choice(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
-    category = query.data
+    category = await resolve_category_callback(query, "cc")
+    if category is None:
+        return
 
     context.user_data["selected_category"] = category
     await query.message.reply_text(f"Wybrano kategorię: {category}")
@@ -364,10 +3071,9 @@ async def handle_category_choice(update: Update, context: CallbackContext) -> No
 
 async def handle_budget_input(update: Update, context: CallbackContext) -> None:
     try:
+        # Bez wybranej kategorii budżetu wiadomość to szybkie dodanie wydatków
         if "selected_category" not in context.user_data:
-            await update.message.reply_text(
-                "Najpierw wybierz kategorię używając /setbudget."
-            )
+            await handle_expense_input(update, context)
             return
 
         text = update.message.text.split(maxsplit=2)
@@ -378,7 +3084,12 @@ async def handle_budget_input(update: Update, context: CallbackContext) -> None:
             # return
         else:
             month = text[1]
-        budget = float(text[0])
+        try:
+            budget = float(text[0])
+            datetime.strptime(month, "%Y-%m")
+        except ValueError:
+            await update.message.reply_text("Błędny format. Użyj: BUDŻET [YYYY-MM]")
+            return
 
         # Uzupełnij datę o pierwszy dzień danego miesiąca
         if "-" in month:
@@ -387,32 +3098,38 @@ async def handle_budget_input(update: Update, context: CallbackContext) -> None:
 
         category = context.user_data["selected_category"]
 
-        # Sprawdź, czy budżet dla danej kategorii i miesiąca już istnieje
-        existing_budget = get_existing_budget_from_notion(category, month)
-        if existing_budget:
+        # Istniejący budżet sprawdzany w lokalnej księdze; księga ma z góry tylko
+        # bieżący miesiąc, więc przy braku wpisu pytamy backendy - zawsze na
+        # nowo, żeby nie nadpisać bez pytania budżetu dodanego wprost w Notion
+        await ensure_ledger_budget(category, month, fresh=True)
+        existing = get_ledger_budget(category, month)
+        if existing is not None:
             keyboard = [
                 [InlineKeyboardButton("Tak", callback_data="yes")],
                 [InlineKeyboardButton("Nie", callback_data="no")],
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
             await update.message.reply_text(
-                f"Istnieje już budżet dla kategorii {category} na miesiąc {month} w wysokości {existing_budget}. Czy chcesz go nadpisać?",
+                f"Istnieje już budżet dla kategorii {category} na miesiąc {month} w wysokości {existing[0]}. Czy chcesz go nadpisać?",
                 reply_markup=reply_markup,
             )
-            context.user_data["existing_budget"] = existing_budget
+            context.user_data["existing_budget"] = existing[0]
             context.user_data["budget_month"] = month
+            context.user_data["pending_budget"] = budget
             return
 
-        # Dodaj budżet do Notion
-        status_code, response = add_budget_to_notion(category, budget, month)
-        if status_code != 200:
-            await update.message.reply_text(
-                f"Wystąpił błąd podczas dodawania budżetu do Notion: {response}"
-            )
-            return
+        # Zapisz budżet w księdze, do backendów trafi przez kolejkę zapisów
+        remaining = record_budget(
+            category,
+            month,
+            budget,
+            ENABLED_BACKENDS,
+            idempotency_key=update_key(update),
+        )
+        schedule_outbox_flush(context)
 
         await update.message.reply_text(
-            f"Ustawiono budżet dla kategorii {category} na miesiąc {month} w wysokości {budget}"
+            f"Ustawiono budżet dla kategorii {category} na miesiąc {month} w wysokości {budget}. Pozostało: {remaining} PLN."
         )
         del context.user_data["selected_category"]
     except Exception as e:
@@ -423,45 +3140,33 @@ async def handle_budget_input(update: Update, context: CallbackContext) -> None:
 async def handle_budget_confirmation(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     choice = query.data
-
-    if choice == "yes":
-        existing_budget = context.user_data.get("existing_budget")
-        budget_month = context.user_data.get("budget_month")
-        # Nadpisz istniejący budżet
-        # add_budget_to_notion(category, existing_budget, budget_month) - dodaj implementację nadpisywania budżetu
+    await query.answer()
+    category = context.user_data.pop("selected_category", None)
+    month = context.user_data.pop("budget_month", None)
+    budget = context.user_data.pop("pending_budget", None)
+    existing_budget = context.user_data.pop("existing_budget", None)
+
+    if choice == "yes" and budget is not None:
+        # Nadpisanie to upsert - pozostała kwota liczona od nowa z wydatków
+        remaining = record_budget(
+            category,
+            month,
+            budget,
+            ENABLED_BACKENDS,
+            idempotency_key=update_key(update),
+        )
+        schedule_outbox_flush(context)
+        await query.message.reply_text(
+            f"Nadpisano budżet dla kategorii {category} na miesiąc {month}: {existing_budget} -> {budget}. Pozostało: {remaining} PLN."
+        )
+    elif choice == "yes":
         await query.message.reply_text(
-            f"Nadpisano istniejący budżet dla miesiąca {budget_month} w wysokości {existing_budget}."
+            "Brak budżetu do nadpisania. Użyj ponownie /setbudget."
         )
     elif choice == "no":
         await query.message.reply_text("Nie nadpisano istniejącego budżetu.")
 
 
-# Rejestracja funkcji obsługi callback
-
-
-def get_existing_budget_from_notion(category, month):
-    url = f"https://api.notion.com/v1/databases/{NOTION_BUDGET_DATABASE_ID}/query"
-    headers = {
-        "Authorization": f"Bearer {NOTION_API_TOKEN}",
-        "Content-Type": "application/json",
-        "Notion-Version": "2022-06-28",
-    }
-    data = {
-        "filter": {
-            "and": [
-                {"property": "Kategoria", "title": {"equals": category}},
-                {"property": "Miesiąc", "date": {"equals": month}},
-            ]
-        }
-    }
-    response = requests.post(url, json=data, headers=headers)
-    if response.status_code == 200:
-        results = response.json().get("results", [])
-        if results:
-            return results[0]["properties"]["Budżet"]["number"]
-    return None
-
-
 async def add_expense(update: Update, context: CallbackContext) -> None:
     try:
         # Oczekiwany format: /add KATEGORIA KONTO WYDATEK OPIS
@@ -481,26 +3186,231 @@ async def add_expense(update: Update, context: CallbackContext) -> None:
         current_date = datetime.now().strftime("%Y-%m-%d")
         month = datetime.now().strftime("%Y-%m")  # Extracting YYYY-MM
 
-        # Dodaj wydatek do Notion
-        status_code, response = add_expense_to_notion(
-            current_date, category, account, amount, description
+        # Pozostała kwota liczona w lokalnej księdze, wydatek i budżet trafią
+        # do backendów przez kolejkę zapisów
+        await ensure_ledger_budget(category, month)
+        remaining = record_expense(
+            current_date,
+            category,
+            account,
+            amount,
+            description,
+            ENABLED_BACKENDS,
+            idempotency_key=update_key(update),
         )
-        if status_code != 200:
+        schedule_outbox_flush(context)
+        if remaining is None:
             await update.message.reply_text(
-                f"Wystąpił błąd podczas dodawania wydatku do Notion: {response}"
+                f"Dodano wydatek: {category} {account} {amount} {description}. "
+                f"Brak znanego budżetu dla kategorii {category} na miesiąc {month}."
+                + stale_note()
             )
             return
 
-        # Zaktualizuj budżet w Notion
-        status_code, response = update_budget_in_notion(category, month, amount)
-        if status_code != 200:
-            await update.message.reply_text(
-                f"Wystąpił błąd podczas aktualizacji budżetu w Notion: {response}"
-            )
+        alerts = "".join(f"\n{alert}" for alert in budget_alerts(category, month))
+        await update.message.reply_text(
+            f"Dodano wydatek: {category} {account} {amount} {description}. Pozostało: {remaining} PLN."
+            + alerts
+            + stale_note()
+        )
+    except Exception as e:
+        await update.message.reply_text(f"Wystąpił błąd: {e}")
+
+
+# Import wydatków z pliku CSV (np. wyciągu z banku)
+IMPORT_MAX_BYTES = int(os.environ.get("IMPORT_MAX_BYTES", str(5 * 1024 * 1024)))
+IMPORT_COLUMNS = {
+    "date": ("data", "date", "data operacji", "data transakcji"),
+    "category": ("kategoria", "category"),
+    "account": ("konto", "account"),
+    "amount": ("kwota", "wydatek", "amount"),
+    "description": ("opis", "description", "tytuł", "tytuł operacji"),
+}
+IMPORT_DATE_FORMATS = ("%Y-%m-%d", "%d.%m.%Y", "%d-%m-%Y", "%d/%m/%Y")
+
+
+def _parse_import_date(value):
+    for date_format in IMPORT_DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    raise ValueError(f"nieznany format daty: {value}")
+
+
+def parse_expense_csv(lines, default_account=""):
+    # Plik czytany wiersz po wierszu; zwraca (wydatki, numery błędnych wierszy)
+    lines = iter(lines)
+    header_line = next(lines, "")
+    try:
+        dialect = csv.Sniffer().sniff(header_line, delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    header = [name.strip().lower() for name in next(csv.reader([header_line], dialect))]
+    columns = {}
+    for field, names in IMPORT_COLUMNS.items():
+        for index, name in enumerate(header):
+            if name in names:
+                columns[field] = index
+                break
+    missing = {"date", "category", "amount"} - columns.keys()
+    if missing:
+        raise ValueError(f"brak kolumn: {', '.join(sorted(missing))}")
+
+    rows, errors = [], []
+    signed = False
+    for line_no, row in enumerate(csv.reader(lines, dialect), start=2):
+        if not any(cell.strip() for cell in row):
+            continue
+        try:
+            values = {
+                field: row[index].strip() if index < len(row) else ""
+                for field, index in columns.items()
+            }
+            amount = values["amount"].replace("\xa0", "").replace(" ", "")
+            amount = float(amount.replace(",", "."))
+            expense = {
+                "date": _parse_import_date(values["date"]),
+                "category": values["category"],
+                "account": values.get("account") or default_account,
+                "amount": abs(amount),
+                "description": values.get("description", ""),
+            }
+        except ValueError:
+            errors.append(line_no)
+            continue
+        if not expense["category"]:
+            errors.append(line_no)
+            continue
+        signed = signed or amount < 0
+        rows.append((line_no, expense, amount > 0))
+    # Wyciągi bankowe zapisują obciążenia jako kwoty ujemne - w pliku z kwotami
+    # ze znakiem dodatnie to wpływy (pensja, zwroty) i są pomijane; plik bez
+    # kwot ujemnych to zwykła lista wydatków
+    if signed:
+        errors = sorted(errors + [line_no for line_no, _, credit in rows if credit])
+    expenses = [expense for _, expense, credit in rows if not (signed and credit)]
+    return expenses, errors
+
+
+async def import_expenses(update: Update, context: CallbackContext) -> None:
+    try:
+        # Plik CSV z kolumnami Data, Kategoria, Kwota (opcjonalnie Konto, Opis);
+        # podpis pliku to domyślne konto
+        document = update.message.document
+        if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+            await update.message.reply_text("Plik jest zbyt duży do importu.")
+            return
+        buffer = io.BytesIO()
+        file = await document.get_file()
+        await file.download_to_memory(buffer)
+        buffer.seek(0)
+        expenses, errors = parse_expense_csv(
+            io.TextIOWrapper(buffer, encoding="utf-8-sig", newline=""),
+            default_account=(update.message.caption or "").strip(),
+        )
+        if not expenses:
+            await update.message.reply_text("Nie znaleziono wydatków w pliku.")
             return
 
+        keys = {(e["category"], month_key(e["date"])) for e in expenses}
+        await asyncio.gather(*(ensure_ledger_budget(c, m) for c, m in keys))
+        remaining = record_expenses(
+            expenses, ENABLED_BACKENDS, idempotency_key=update_key(update)
+        )
+        schedule_outbox_flush(context)
+
+        lines = [f"Zaimportowano wydatków: {len(expenses)}."]
+        lines += format_remaining(remaining)
+        lines += format_alerts(remaining)
+        if errors:
+            skipped = ", ".join(str(line_no) for line_no in errors[:10])
+            more = "..." if len(errors) > 10 else ""
+            lines.append(f"Pominięte wiersze: {skipped}{more}")
+        await update.message.reply_text("\n".join(lines) + stale_note())
+    except ValueError as e:
+        await update.message.reply_text(f"Błędny plik CSV: {e}")
+    except Exception as e:
+        await update.message.reply_text(f"Wystąpił błąd: {e}")
+
+
+async def get_stats(update: Update, context: CallbackContext) -> None:
+    # Tylko dla czatów z ADMIN_CHAT_IDS
+    if update.effective_chat.id not in ADMIN_CHAT_IDS:
+        await update.message.reply_text("Brak uprawnień do tej komendy.")
+        return
+    await update.message.reply_text(
+        f"{format_stats()}\n\n"
+        f"Kolejka zapisów: {pending_outbox_count()}\n"
+        f"Cache kategorii: {category_cache.stats()}\n"
+        f"Połączone odczyty: {coalesced_calls}\n"
+        f"Odrzucone duplikaty: {processed_updates.duplicates}\n"
+        f"Start (s): {startup_timings}"
+    )
+
+
+async def reconcile(update: Update, context: CallbackContext) -> None:
+    # Tylko dla czatów z ADMIN_CHAT_IDS; oczekiwany format: /reconcile [YYYY-MM]
+    if update.effective_chat.id not in ADMIN_CHAT_IDS:
+        await update.message.reply_text("Brak uprawnień do tej komendy.")
+        return
+    try:
+        text = update.message.text.split()
+        month = text[1] if len(text) > 1 else datetime.now().strftime("%Y-%m")
+        datetime.strptime(month, "%Y-%m")
+    except ValueError:
+        await update.message.reply_text("Błędny format. Użyj: /reconcile [YYYY-MM]")
+        return
+    try:
+        report = await reconcile_month(month)
+        await update.message.reply_text(format_reconciliation(month, report))
+    except Exception as e:
+        await update.message.reply_text(f"Wystąpił błąd: {e}")
+
+
+async def get_report(update: Update, context: CallbackContext) -> None:
+    try:
+        # Oczekiwany format: /report [YYYY-MM]
+        text = update.message.text.split()
+        month = text[1] if len(text) > 1 else datetime.now().strftime("%Y-%m")
+        datetime.strptime(month, "%Y-%m")
+        await update.message.reply_text(format_report(build_monthly_report(month)))
+    except ValueError:
+        await update.message.reply_text("Błędny format. Użyj: /report [YYYY-MM]")
+    except Exception as e:
+        await update.message.reply_text(f"Wystąpił błąd: {e}")
+
+
+async def export_expenses(update: Update, context: CallbackContext) -> None:
+    try:
+        # Oczekiwany format: /export [OD] [DO], np. /export 2024 albo
+        # /export 2024-01-15 2024-03; domyślnie bieżący miesiąc
+        text = update.message.text.split()
+        first = text[1] if len(text) > 1 else datetime.now().strftime("%Y-%m")
+        last = text[2] if len(text) > 2 else first
+        date_from, date_to = export_period(first), export_period(last, end=True)
+    except ValueError:
+        await update.message.reply_text("Błędny format. Użyj: /export [OD] [DO]")
+        return
+    try:
+        backend = STORAGE_BACKENDS[ENABLED_BACKENDS[0]]
+        with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES) as spool:
+            async with aclosing(backend.iter_expenses(date_from, date_to)) as rows:
+                count = await write_expense_export(rows, spool, EXPORT_MAX_BYTES)
+            if not count:
+                await update.message.reply_text(
+                    f"Brak wydatków od {date_from} do {date_to}."
+                )
+                return
+            await update.message.reply_document(
+                document=spool,
+                filename=f"wydatki_{date_from}_{date_to}.csv.gz",
+                caption=f"Wydatki od {date_from} do {date_to}: {count}",
+            )
+    except ExportTooLarge as e:
         await update.message.reply_text(
-            f'Dodano wydatek: {category} {account} {amount} {description}. Pozostało: {response["properties"]["Pozostało"]["number"]} PLN.'
+            f"Eksport przekracza {e.args[0] / 1024 / 1024:.0f} MB."
+            " Wybierz krótszy okres."
         )
     except Exception as e:
         await update.message.reply_text(f"Wystąpił błąd: {e}")
@@ -511,10 +3421,182 @@ async def echo(update: Update, context: CallbackContext) -> None:
     await update.message.reply_text(update.message.text)
 
 
-def main() -> None:
+# Tryb pracy bota: polling (domyślnie) albo webhook z wbudowanym serwerem HTTP
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or None
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MAX_CONCURRENT_UPDATES", "32"))
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    # Aktualizacje z różnych czatów są obsługiwane równolegle, a z jednego czatu
+    # po kolei, żeby stan rozmowy (selected_category, existing_budget) był spójny
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._chat_queues = {}
+
+    async def do_process_update(self, update, coroutine):
+        chat = getattr(update, "effective_chat", None)
+        if chat is None:
+            await coroutine
+            return
+        queue = self._chat_queues.get(chat.id)
+        if queue is not None:
+            # Czat jest już obsługiwany - ta obsługa wykona aktualizację po
+            # wcześniejszych, a miejsce w MAX_CONCURRENT_UPDATES od razu wraca
+            # do puli zamiast czekać na zajęty czat
+            queue.append(coroutine)
+            return
+        queue = self._chat_queues[chat.id] = deque([coroutine])
+        try:
+            while queue:
+                try:
+                    await queue.popleft()
+                except Exception:
+                    logger.exception("Processing update for chat %s failed", chat.id)
+        finally:
+            del self._chat_queues[chat.id]
+            # Przy anulowaniu (zamknięcie bota) nieuruchomione korutyny są zamykane
+            for pending in queue:
+                pending.close()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+# Start bota - konfiguracja backendów jest leniwa, a rozgrzewanie cache
+# (kategorie, budżety bieżącego miesiąca) biegnie równolegle z połączeniem
+# z Telegramem, więc zimny start to praktycznie tylko handshake z Bot API
+CACHE_WARMUP = os.environ.get("CACHE_WARMUP", "1") == "1"
+startup_timings = {}
+_startup_started = time.monotonic()
+_warmup_task = None
+
+
+def mark_startup(phase):
+    startup_timings[phase] = round(time.monotonic() - _startup_started, 3)
+
+
+async def warm_notion_budgets(month):
+    count = 0
+    async for page in iter_notion_query(
+        NOTION_BUDGET_DATABASE_ID,
+        filter={"property": "Miesiąc", "date": {"equals": f"{month}-01"}},
+    ):
+        properties = page["properties"]
+        if not properties["Kategoria"]["title"]:
+            continue
+        remember_notion_budget_page(page)
+        seed_ledger_budget(
+            properties["Kategoria"]["title"][0]["text"]["content"],
+            month,
+            properties["Budżet"]["number"],
+            properties["Pozostało"]["number"],
+        )
+        count += 1
+    return count
+
+
+async def warm_airtable_budgets(month):
+    records = await airtable_budget_snapshot.month(month)
+    for category, record in records.items():
+        fields = record["fields"]
+        seed_ledger_budget(
+            category, month, fields.get("Budget"), fields.get("Remaining")
+        )
+    return len(records)
+
+
+async def warm_up_caches():
+    month = datetime.now().strftime("%Y-%m")
+    steps = {"categories": get_categories_from_notion}
+    if "notion" in ENABLED_BACKENDS:
+        steps["notion_budgets"] = functools.partial(warm_notion_budgets, month)
+    if "airtable" in ENABLED_BACKENDS:
+        steps["airtable_budgets"] = functools.partial(warm_airtable_budgets, month)
+
+    async def timed(name, step):
+        started = time.monotonic()
+        try:
+            await step()
+        except Exception as e:
+            logger.warning("Cache warm-up step %s failed: %s", name, e)
+            return
+        startup_timings[f"warmup_{name}"] = round(time.monotonic() - started, 3)
+
+    await asyncio.gather(*(timed(name, step) for name, step in steps.items()))
+    mark_startup("warmup_done")
+    logger.info("Cache warm-up finished: %s", startup_timings)
+
+
+class BudgetBotApplication(Application):
+    async def initialize(self):
+        # Rozgrzewanie startuje przed getMe, a nie po nim (jak post_init)
+        global _warmup_task
+        if CACHE_WARMUP and _warmup_task is None:
+            _warmup_task = asyncio.create_task(warm_up_caches())
+        await super().initialize()
+
+
+async def post_init(application):
+    mark_startup("telegram_ready")
+    await start_metrics_server()
+    print(
+        f"Bot ready to receive requests! Startup {startup_timings['telegram_ready']}s"
+        f" (build {startup_timings.get('build')}s)"
+    )
+
+
+async def shutdown(application):
+    global _warmup_task
+    if _warmup_task is not None and not _warmup_task.done():
+        _warmup_task.cancel()
+    _warmup_task = None
+    await stop_metrics_server()
+    await close_http_clients()
+
+
+def build_application(token, request=None) -> Application:
     # # Stwórz application i przekaz mu token API bota
-    token = os.environ["TELEGRAM_TOKEN"]
-    application = Application.builder().token(token).build()
+    builder = (
+        Application.builder()
+        .application_class(BudgetBotApplication)
+        .token(token)
+        .concurrent_updates(PerChatUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .post_init(post_init)
+        .post_shutdown(shutdown)
+    )
+    # Własna warstwa żądań do Telegram API (np. atrapa w benchmark.py)
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    application = builder.build()
+
+    # Zadanie w tle wysyłające kolejkę zapisów do Notion/Airtable
+    application.job_queue.run_repeating(
+        flush_outbox, interval=OUTBOX_FLUSH_INTERVAL, first=1
+    )
+    # Przyrostowa synchronizacja lokalnej kopii bazy wydatków Notion - tylko
+    # gdy Notion jest backendem, inaczej obce wydatki trafiłyby do księgi
+    if "notion" in ENABLED_BACKENDS:
+        application.job_queue.run_repeating(
+            sync_expense_mirror, interval=MIRROR_SYNC_INTERVAL, first=10
+        )
+    # Okresowe uzgadnianie pozostałych kwot z wydatkami
+    application.job_queue.run_repeating(
+        reconcile_budgets, interval=RECONCILE_INTERVAL, first=reconcile_first_delay()
+    )
+    # Codzienne podsumowanie budżetów z sum trzymanych w pamięci
+    if DIGEST_CHAT_IDS:
+        application.job_queue.run_daily(send_daily_digest, time=digest_time())
+
+    # Duplikaty aktualizacji odrzucane przed wszystkimi pozostałymi handlerami
+    application.add_handler(TypeHandler(Update, drop_duplicate_updates), group=-1)
 
     # Zarejestruj handler dla komendy /start
     application.add_handler(CommandHandler("start", start))
@@ -527,7 +3609,7 @@ def main() -> None:
 
     # Zarejestruj handler dla odpowiedzi z Inline Keyboard
     application.add_handler(
-        CallbackQueryHandler(set_budget_callback, pattern="^setbudget_")
+        CallbackQueryHandler(set_budget_callback, pattern="^(sb:|setbudget_)")
     )
 
     # Zarejestruj handler dla komendy /addcategory
@@ -536,25 +3618,68 @@ def main() -> None:
     # Zarejestruj handler dla komendy /add
     application.add_handler(CommandHandler("add", add_expense))
 
+    # Zarejestruj handler dla komendy /report
+    application.add_handler(CommandHandler("report", get_report))
+
+    # Zarejestruj handler dla komendy /stats
+    application.add_handler(CommandHandler("stats", get_stats))
+
+    # Zarejestruj handler dla komendy /reconcile
+    application.add_handler(CommandHandler("reconcile", reconcile))
+
+    # Zarejestruj handler dla komendy /export
+    application.add_handler(CommandHandler("export", export_expenses))
+
+    # Zarejestruj handler dla importu wydatków z pliku CSV
+    application.add_handler(
+        MessageHandler(
+            filters.Document.FileExtension("csv")
+            | filters.Document.MimeType("text/csv"),
+            import_expenses,
+        )
+    )
+
     application.add_handler(
         MessageHandler(filters.TEXT & ~filters.COMMAND, handle_budget_input)
     )
 
     # Zarejestruj handler, który odbiera wszystkie wiadomości tekstowe i wysyła je z powrotem (echo)
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, echo))
-    application.add_handler(CallbackQueryHandler(handle_budget_confirmation))
+    application.add_handler(
+        CallbackQueryHandler(handle_budget_confirmation, pattern="^(yes|no)$")
+    )
     # Rejestracja funkcji obsługi callback dla wyboru kategorii
-    application.add_handler(CallbackQueryHandler(handle_category_choice))
-    print("Bot ready to receive requests!")
-    application.run_polling()
+    application.add_handler(
+        CallbackQueryHandler(handle_category_choice, pattern="^cc:")
+    )
+
+    # Pomiar czasu i błędów każdego zarejestrowanego handlera
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = instrument_handler(handler.callback)
+    return application
+
+
+def main() -> None:
+    # Kategorie zawsze pochodzą z Notion, także gdy STORAGE_BACKENDS=airtable
+    missing = missing_env(dict.fromkeys(("telegram", "notion", *ENABLED_BACKENDS)))
+    if missing:
+        raise SystemExit(f"Missing environment variables: {', '.join(missing)}")
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        raise SystemExit("WEBHOOK_URL is required when BOT_MODE=webhook")
+    application = build_application(os.environ["TELEGRAM_TOKEN"])
+    mark_startup("build")
+    if BOT_MODE == "webhook":
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        application.run_polling()
 
 
 if __name__ == "__main__":
-    # Dodaj wydatek
-    date = "2024-05-30"
-    category = "Jedzenie"
-    account = "Konto1"
-    amount = 50.00
-    description = "Obiad"
-    add_expense_airtable(date, category, account, amount, description)
     main()
@@ -1,15 +1,133 @@
+import asyncio
+import gzip
+import httpx
+import subprocess
+import sys
 import unittest
-from unittest.mock import patch, MagicMock
+import time
+from unittest.mock import patch, MagicMock, AsyncMock
+from telegram.ext import ApplicationHandlerStop
 import os
-from main import (
+from datetime import datetime
+
+os.environ.setdefault("BUDGET_DB_PATH", ":memory:")
+
+from main import (  # noqa: E402
+    add_expense_airtable,
     add_expense_to_airtable,
     get_budget_from_airtable,
     update_budget_in_airtable,
     add_budget_to_airtable,
+    add_category_to_notion,
+    airtable_budget_snapshot,
+    PerChatUpdateProcessor,
+    backend_request,
+    build_application,
+    build_monthly_report,
+    budget_alerts,
+    budget_totals,
+    format_digest,
+    RateLimiter,
+    StorageBackend,
+    rate_limiters,
+    category_cache,
+    CategoryKeyboards,
+    circuit_breakers,
+    CircuitOpenError,
+    get_categories,
+    hedged_request,
+    check_category_exists,
+    close_http_clients,
+    coalesced_calls,
+    get_categories_from_notion,
+    get_db,
+    get_http_client,
+    get_ledger_budget,
+    ensure_ledger_budget,
+    get_mirrored_expenses,
+    get_sync_state,
+    handle_budget_confirmation,
+    outbound_idempotency_key,
+    upsert_budget_in_notion,
+    NOTION_BUDGET_DATABASE_ID,
+    set_budget,
+    set_budget_callback,
+    drop_duplicate_updates,
+    processed_updates,
+    BACKEND_REQUIRED_ENV,
+    main,
+    startup_timings,
+    warm_up_caches,
+    get_stats,
+    instrument_handler,
+    metrics,
+    export_expenses,
+    export_period,
+    handle_budget_input,
+    parse_expense_csv,
+    record_expenses,
+    reconcile_month,
+    reconcile_budgets,
+    reconcile_first_delay,
+    sync_expense_mirror,
+    iter_notion_query,
+    lookup_budget_page,
+    record_expense,
+    seed_ledger_budget,
+    record_budget,
+    ledger_budget_misses,
+    fan_out,
+    flush_outbox,
+    pending_outbox_count,
+    remember_budget_page,
+    update_budget_in_notion,
+    update_budgets_in_airtable,
 )
 
 
-class TestTelegramBotFunctions(unittest.TestCase):
+def notion_page(category):
+    return {"properties": {"Kategoria": {"title": [{"text": {"content": category}}]}}}
+
+
+def notion_budget_page(page_id, category, month, remaining):
+    page = notion_page(category)
+    page["id"] = page_id
+    page["properties"]["Miesiąc"] = {"date": {"start": month}}
+    page["properties"]["Pozostało"] = {"number": remaining}
+    return page
+
+
+def notion_expense_page(page_id, date, amount, edited, **extra):
+    return {
+        "id": page_id,
+        "created_time": edited,
+        "last_edited_time": edited,
+        "properties": {
+            "Data": {"date": {"start": date}},
+            "Kategoria": {"title": [{"plain_text": "Jedzenie"}]},
+            "Konto": {"rich_text": [{"plain_text": "Konto1"}]},
+            "Wydatek": {"number": amount},
+            "Opis": {"rich_text": [{"plain_text": "Obiad"}]},
+        },
+        **extra,
+    }
+
+
+def airtable_budget_record(record_id, category, remaining):
+    return {
+        "id": record_id,
+        "fields": {"Category": category, "Month": "2024-05", "Remaining": remaining},
+    }
+
+
+def mock_response(status_code, body):
+    response = MagicMock()
+    response.status_code = status_code
+    response.json.return_value = body
+    return response
+
+
+class TestTelegramBotFunctions(unittest.IsolatedAsyncioTestCase):
     def test_environment_variables(self):
         required_vars = [
             "AIRTABLE_BASE_ID",
@@ -25,36 +143,59 @@ class TestTelegramBotFunctions(unittest.TestCase):
                     os.environ[var], "", f"{var} should not be an empty string"
                 )
 
-    @patch("requests.post")
-    def test_add_expense_to_airtable(self, mock_post):
+    @patch("main.airtable_request", new_callable=AsyncMock)
+    async def test_add_expense_to_airtable(self, mock_post):
         mock_response = MagicMock()
         mock_response.status_code = 200
         mock_response.json.return_value = {"id": "rec12345", "fields": {}}
         mock_post.return_value = mock_response
 
-        status_code, response = add_expense_to_airtable(
+        status_code, response = await add_expense_to_airtable(
             "2024-05-29", "Jedzenie", "Konto1", 50.00, "Obiad"
         )
         self.assertEqual(status_code, 200)
         self.assertIn("id", response)
         self.assertEqual(response["id"], "rec12345")
 
-    @patch("requests.get")
-    def test_get_budget_from_airtable(self, mock_get):
-        mock_response = MagicMock()
-        mock_response.status_code = 200
-        mock_response.json.return_value = {
-            "records": [{"id": "rec12345", "fields": {"Remaining": 500}}]
-        }
-        mock_get.return_value = mock_response
+    @patch("main.get_airtable_table")
+    async def test_get_budget_from_airtable(self, mock_table):
+        airtable_budget_snapshot.invalidate()
+        mock_table.return_value.iterate.return_value = iter(
+            [
+                [airtable_budget_record("rec12345", "Jedzenie", 500)],
+                [airtable_budget_record("rec67890", "Transport", 200)],
+            ]
+        )
 
-        budget = get_budget_from_airtable("Jedzenie", "2024-05")
+        budget = await get_budget_from_airtable("Jedzenie", "2024-05")
         self.assertIsNotNone(budget)
         self.assertEqual(budget["id"], "rec12345")
         self.assertEqual(budget["fields"]["Remaining"], 500)
 
-    @patch("requests.patch")
-    def test_update_budget_in_airtable(self, mock_patch):
+        # Cały miesiąc pobrany jednym zapytaniem - kolejne kategorie z migawki
+        budget = await get_budget_from_airtable("Transport", "2024-05")
+        self.assertEqual(budget["id"], "rec67890")
+        self.assertIsNone(await get_budget_from_airtable("Brak", "2024-05"))
+        mock_table.return_value.iterate.assert_called_once_with(
+            formula="{Month}='2024-05'", page_size=100
+        )
+
+    @patch("main.get_airtable_table")
+    async def test_update_budgets_in_airtable_batches_by_ten(self, mock_table):
+        table = mock_table.return_value
+        table.batch_update.side_effect = lambda records: [
+            airtable_budget_record(r["id"], "Jedzenie", r["fields"]["Remaining"])
+            for r in records
+        ]
+
+        updated = await update_budgets_in_airtable([(f"rec{i}", i) for i in range(23)])
+        self.assertEqual(len(updated), 23)
+        self.assertEqual(
+            [len(c.args[0]) for c in table.batch_update.call_args_list], [10, 10, 3]
+        )
+
+    @patch("main.airtable_request", new_callable=AsyncMock)
+    async def test_update_budget_in_airtable(self, mock_patch):
         mock_response = MagicMock()
         mock_response.status_code = 200
         mock_response.json.return_value = {
@@ -63,14 +204,14 @@ class TestTelegramBotFunctions(unittest.TestCase):
         }
         mock_patch.return_value = mock_response
 
-        status_code, response = update_budget_in_airtable("rec12345", 450)
+        status_code, response = await update_budget_in_airtable("rec12345", 450)
         self.assertEqual(status_code, 200)
         self.assertIn("id", response)
         self.assertEqual(response["id"], "rec12345")
         self.assertEqual(response["fields"]["Remaining"], 450)
 
-    @patch("requests.post")
-    def test_add_budget_to_airtable(self, mock_post):
+    @patch("main.airtable_request", new_callable=AsyncMock)
+    async def test_add_budget_to_airtable(self, mock_post):
         mock_response = MagicMock()
         mock_response.status_code = 200
         mock_response.json.return_value = {
@@ -79,7 +220,9 @@ class TestTelegramBotFunctions(unittest.TestCase):
         }
         mock_post.return_value = mock_response
 
-        status_code, response = add_budget_to_airtable("Jedzenie", 1000, "2024-06")
+        status_code, response = await add_budget_to_airtable(
+            "Jedzenie", 1000, "2024-06"
+        )
         self.assertEqual(status_code, 200)
         self.assertIn("id", response)
         self.assertEqual(response["id"], "rec12345")
@@ -87,6 +230,1095 @@ class TestTelegramBotFunctions(unittest.TestCase):
         self.assertEqual(response["fields"]["Budget"], 1000)
         self.assertEqual(response["fields"]["Remaining"], 1000)
 
+    @patch("main.get_budget_from_airtable", new_callable=AsyncMock)
+    async def test_airtable_budget_without_remaining_field(self, mock_get):
+        # Airtable pomija puste pola w odpowiedzi
+        mock_get.return_value = {"id": "rec1", "fields": {"Budget": 400}}
+        await ensure_ledger_budget("BezPozostało", "2019-04", backends=("airtable",))
+        self.assertEqual(get_ledger_budget("BezPozostało", "2019-04"), (400, 0))
+
+    @patch("main.update_budgets_in_airtable", new_callable=AsyncMock)
+    @patch("main.get_budget_from_airtable", new_callable=AsyncMock)
+    @patch("main.add_expense_to_airtable", new_callable=AsyncMock)
+    async def test_add_expense_airtable(self, mock_add, mock_get, mock_update):
+        mock_get.return_value = {
+            "id": "rec12345",
+            "fields": {"Budget": 1000, "Remaining": 500},
+        }
+
+        mock_add.return_value = (200, {"id": "rec999"})
+        mock_update.return_value = [{"id": "rec12345"}]
+
+        remaining = await add_expense_airtable(
+            "2024-04-29", "Jedzenie", "Konto1", 50.00, "Obiad"
+        )
+        self.assertEqual(remaining, 450)
+        mock_add.assert_not_awaited()
+        self.assertEqual(pending_outbox_count(), 2)
+
+        await flush_outbox()
+        mock_add.assert_awaited_once_with(
+            "2024-04-29", "Jedzenie", "Konto1", 50.00, "Obiad"
+        )
+        mock_get.assert_awaited_with("Jedzenie", "2024-04")
+        mock_update.assert_awaited_once_with([("rec12345", 450)])
+        self.assertEqual(pending_outbox_count(), 0)
+
+    async def test_http_client_is_pooled_per_backend(self):
+        notion = get_http_client("notion")
+        airtable = get_http_client("airtable")
+        self.assertIs(notion, get_http_client("notion"))
+        self.assertIsNot(notion, airtable)
+        self.assertIn("Notion-Version", notion.headers)
+        self.assertIsNotNone(notion.timeout.read)
+        await close_http_clients()
+        self.assertTrue(notion.is_closed)
+
+    @patch("main.notion_request", new_callable=AsyncMock)
+    async def test_categories_are_served_from_cache(self, mock_request):
+        category_cache.invalidate()
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = {"results": [notion_page("Jedzenie")]}
+        mock_request.return_value = mock_response
+        hits, misses = category_cache.hits, category_cache.misses
+
+        self.assertEqual(await get_categories_from_notion(), ["Jedzenie"])
+        self.assertTrue(await check_category_exists("Jedzenie"))
+        self.assertFalse(await check_category_exists("Transport"))
+        self.assertEqual(mock_request.await_count, 1)
+        self.assertEqual(category_cache.hits - hits, 2)
+        self.assertEqual(category_cache.misses - misses, 1)
+
+        mock_response.json.return_value = {"id": "page123"}
+        await add_category_to_notion("Transport")
+        self.assertTrue(await check_category_exists("Transport"))
+        self.assertEqual(mock_request.await_count, 2)
+        category_cache.invalidate()
+
+    @patch("main.notion_request", new_callable=AsyncMock)
+    async def test_update_budget_uses_indexed_page(self, mock_request):
+        remember_budget_page("Jedzenie", "2024-05-01", "page1", 500)
+        mock_request.return_value = mock_response(
+            200, notion_budget_page("page1", "Jedzenie", "2024-05-01", 450)
+        )
+
+        status_code, _ = await update_budget_in_notion("Jedzenie", "2024-05", 450)
+        self.assertEqual(status_code, 200)
+        mock_request.assert_awaited_once_with(
+            "PATCH",
+            "/pages/page1",
+            json={"properties": {"Pozostało": {"number": 450}}},
+        )
+        self.assertEqual(lookup_budget_page("Jedzenie", "2024-05"), ("page1", 450))
+
+    @patch("main.notion_request", new_callable=AsyncMock)
+    async def test_update_budget_requeries_after_404(self, mock_request):
+        remember_budget_page("Transport", "2024-05", "stale", 300)
+        fresh_page = notion_budget_page("page2", "Transport", "2024-05-01", 200)
+        mock_request.side_effect = [
+            mock_response(404, {"object": "error"}),
+            mock_response(200, {"results": [fresh_page]}),
+            mock_response(
+                200, notion_budget_page("page2", "Transport", "2024-05-01", 150)
+            ),
+        ]
+
+        status_code, _ = await update_budget_in_notion("Transport", "2024-05", 150)
+        self.assertEqual(status_code, 200)
+        self.assertEqual(mock_request.await_count, 3)
+        self.assertEqual(lookup_budget_page("Transport", "2024-05"), ("page2", 150))
+
+    def test_ledger_computes_remaining_locally(self):
+        record_budget("Rozrywka", "2024-03-01", 300)
+        seed_ledger_budget("Rozrywka", "2024-03", 999, 999)
+        self.assertEqual(get_ledger_budget("Rozrywka", "2024-03"), (300, 300))
+
+        record_expense("2024-03-02", "Rozrywka", "Konto1", 100, "Kino")
+        remaining = record_expense("2024-03-05", "Rozrywka", "Konto1", 50, "Koncert")
+        self.assertEqual(remaining, 150)
+        self.assertIsNone(record_expense("2024-03-05", "Brak", "Konto1", 10, "x"))
+        seed_ledger_budget("Brak", "2024-03", 100, 100)
+        self.assertEqual(get_ledger_budget("Brak", "2024-03"), (100, 90))
+
+    @patch("main.update_budget_in_notion", new_callable=AsyncMock)
+    @patch("main.add_expense_to_notion", new_callable=AsyncMock)
+    async def test_outbox_retries_and_keeps_order_per_key(self, mock_add, mock_update):
+        record_budget("Zdrowie", "2024-02", 200)
+        record_expense(
+            "2024-02-01", "Zdrowie", "Konto1", 20, "Apteka", backends=("notion",)
+        )
+        record_expense(
+            "2024-02-02", "Zdrowie", "Konto1", 30, "Lekarz", backends=("notion",)
+        )
+        mock_add.side_effect = [(502, {}), (200, {}), (200, {})]
+        mock_update.return_value = (200, {})
+
+        await flush_outbox()
+        self.assertEqual(mock_add.await_count, 1)
+        mock_update.assert_not_awaited()
+        self.assertEqual(pending_outbox_count(), 4)
+
+        get_db().execute("UPDATE outbox SET next_attempt_at = 0")
+        await flush_outbox()
+        self.assertEqual(
+            [c.args[4] for c in mock_add.await_args_list],
+            ["Apteka", "Apteka", "Lekarz"],
+        )
+        mock_update.assert_awaited_once_with("Zdrowie", "2024-02", 150)
+        self.assertEqual(pending_outbox_count(), 0)
+
+    @patch("main.add_expense_to_notion", new_callable=AsyncMock)
+    async def test_outbox_unexpected_error_backs_off_entry(self, mock_add):
+        with get_db() as db:
+            db.execute("DELETE FROM outbox")
+
+        async def add(date, category, *args):
+            if category == "Zepsuta":
+                raise KeyError("Remaining")
+            return 200, {"id": "ok1"}
+
+        mock_add.side_effect = add
+        record_expense("2019-02-01", "Zepsuta", "Konto1", 5, "x", backends=("notion",))
+        record_expense("2019-02-01", "Cała", "Konto1", 5, "y", backends=("notion",))
+
+        await flush_outbox()
+        rows = (
+            get_db()
+            .execute(
+                "SELECT attempts, last_error FROM outbox WHERE kind = 'notion_expense'"
+            )
+            .fetchall()
+        )
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]["attempts"], 1)
+        self.assertIn("KeyError", rows[0]["last_error"])
+
+    async def test_fan_out_writes_concurrently_and_reports_failures(self):
+        barrier = asyncio.Barrier(2)
+
+        async def notion_add(*args):
+            await barrier.wait()
+            return 200, {"id": "page1"}
+
+        async def airtable_add(*args):
+            await barrier.wait()
+            return 422, {"error": "INVALID_VALUE"}
+
+        with patch("main.NotionBackend.add_expense", side_effect=notion_add), patch(
+            "main.AirtableBackend.add_expense", side_effect=airtable_add
+        ):
+            results = await asyncio.wait_for(
+                fan_out(
+                    "add_expense",
+                    "2024-05-29",
+                    "Jedzenie",
+                    "Konto1",
+                    50.00,
+                    "Obiad",
+                    backends=("notion", "airtable"),
+                ),
+                timeout=1,
+            )
+        self.assertTrue(results["notion"].ok)
+        self.assertFalse(results["airtable"].ok)
+        self.assertIn("422", results["airtable"].error)
+
+    async def test_incomplete_backend_fails_at_instantiation(self):
+        class PartialBackend(StorageBackend):
+            name = "partial"
+
+            async def add_expense(self, date, category, account, amount, desc):
+                return 200, {}
+
+        with self.assertRaises(TypeError) as raised:
+            PartialBackend()
+        self.assertIn("month_budgets", str(raised.exception))
+
+    async def test_rate_limiter_paces_bursts(self):
+        limiter = RateLimiter(rate=20, burst=1)
+        await limiter.acquire()
+        await limiter.acquire()
+        self.assertEqual(limiter.stats()["acquired"], 2)
+        self.assertEqual(limiter.stats()["waits"], 1)
+        self.assertGreater(limiter.stats()["wait_time"], 0)
+
+    @patch("main.get_http_client")
+    async def test_backend_request_retries_after_429(self, mock_client):
+        throttled = mock_response(429, {})
+        throttled.headers = {"Retry-After": "0"}
+        mock_client.return_value.request = AsyncMock(
+            side_effect=[throttled, mock_response(200, {"results": []})]
+        )
+        rejections = rate_limiters["notion"].rejections
+
+        response = await backend_request("notion", "POST", "/databases/x/query")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(mock_client.return_value.request.await_count, 2)
+        self.assertEqual(rate_limiters["notion"].rejections - rejections, 1)
+
+    @patch("main.notion_request", new_callable=AsyncMock)
+    async def test_concurrent_category_reads_are_coalesced(self, mock_request):
+        category_cache.invalidate()
+        release = asyncio.Event()
+
+        async def slow_query(*args, **kwargs):
+            await release.wait()
+            return mock_response(200, {"results": [notion_page("Jedzenie")]})
+
+        mock_request.side_effect = slow_query
+        coalesced = coalesced_calls.get("get_categories_from_notion", 0)
+        waiters = [
+            asyncio.ensure_future(get_categories_from_notion()) for _ in range(5)
+        ]
+        await asyncio.sleep(0)
+        release.set()
+
+        for categories in await asyncio.gather(*waiters):
+            self.assertEqual(categories, ["Jedzenie"])
+        self.assertEqual(mock_request.await_count, 1)
+        self.assertEqual(coalesced_calls["get_categories_from_notion"] - coalesced, 4)
+        category_cache.invalidate()
+
+    async def test_update_processor_continues_after_failed_update(self):
+        processor = PerChatUpdateProcessor(2)
+        update = MagicMock()
+        update.effective_chat.id = 3
+        events = []
+        release = asyncio.Event()
+
+        async def failing():
+            await release.wait()
+            raise RuntimeError("boom")
+
+        async def record():
+            events.append("next")
+
+        first = asyncio.ensure_future(processor.process_update(update, failing()))
+        await asyncio.sleep(0)
+        await processor.process_update(update, record())
+        release.set()
+        await first
+        self.assertEqual(events, ["next"])
+
+    async def test_update_processor_orders_per_chat(self):
+        # process_update jest w PTB oznaczone @final
+        self.assertNotIn("process_update", vars(PerChatUpdateProcessor))
+        # Także przy 2 miejscach - czekająca aktualizacja czatu 1 nie blokuje czatu 2
+        for max_concurrent in (8, 2):
+            with self.subTest(max_concurrent=max_concurrent):
+                processor = PerChatUpdateProcessor(max_concurrent)
+                events = []
+                first_started = asyncio.Event()
+                release_first = asyncio.Event()
+
+                def update_for(chat_id):
+                    update = MagicMock()
+                    update.effective_chat.id = chat_id
+                    return update
+
+                async def first():
+                    events.append("chat1-first")
+                    first_started.set()
+                    await release_first.wait()
+                    events.append("chat1-first-done")
+
+                async def record(name):
+                    events.append(name)
+
+                tasks = [
+                    asyncio.ensure_future(
+                        processor.process_update(update_for(1), first())
+                    )
+                ]
+                await first_started.wait()
+                tasks.append(
+                    asyncio.ensure_future(
+                        processor.process_update(update_for(1), record("chat1-second"))
+                    )
+                )
+                tasks.append(
+                    asyncio.ensure_future(
+                        processor.process_update(update_for(2), record("chat2"))
+                    )
+                )
+                await asyncio.sleep(0.01)
+                self.assertEqual(events, ["chat1-first", "chat2"])
+
+                release_first.set()
+                await asyncio.gather(*tasks)
+                self.assertEqual(events[2:], ["chat1-first-done", "chat1-second"])
+
+    @patch("main.notion_request", new_callable=AsyncMock)
+    async def test_notion_query_iterator_follows_cursor(self, mock_request):
+        mock_request.side_effect = [
+            mock_response(
+                200,
+                {
+                    "results": [notion_page("A"), notion_page("B")],
+                    "has_more": True,
+                    "next_cursor": "cursor2",
+                },
+            ),
+            mock_response(200, {"results": [notion_page("C")], "has_more": False}),
+        ]
+
+        pages = [
+            page
+            async for page in iter_notion_query(
+                "db", page_size=2, filter_properties=["title"]
+            )
+        ]
+        self.assertEqual(len(pages), 3)
+        second_call = mock_request.await_args_list[1]
+        self.assertEqual(second_call.kwargs["json"]["start_cursor"], "cursor2")
+        self.assertEqual(second_call.kwargs["params"], [("filter_properties", "title")])
+
+        mock_request.reset_mock(side_effect=True)
+        mock_request.return_value = mock_response(
+            200,
+            {"results": [notion_page("A")], "has_more": True, "next_cursor": "c2"},
+        )
+        pages = [page async for page in iter_notion_query("db", limit=1)]
+        self.assertEqual(len(pages), 1)
+        self.assertEqual(mock_request.await_count, 1)
+
+    @patch("main.notion_request", new_callable=AsyncMock)
+    async def test_expense_mirror_syncs_incrementally(self, mock_request):
+        mock_request.return_value = mock_response(
+            200,
+            {
+                "results": [
+                    notion_expense_page("e1", "2023-01-05", 40, "2023-01-05T10:00Z"),
+                    notion_expense_page("e2", "2023-01-06", 60, "2023-01-06T10:00Z"),
+                ]
+            },
+        )
+        await sync_expense_mirror(full_sweep=False)
+        self.assertEqual(len(get_mirrored_expenses("2023-01-01", "2023-01-31")), 2)
+        self.assertEqual(
+            get_sync_state("expenses_high_water_mark"), "2023-01-06T10:00Z"
+        )
+
+        mock_request.return_value = mock_response(
+            200,
+            {
+                "results": [
+                    notion_expense_page(
+                        "e1", "2023-01-05", 40, "2023-01-07T10:00Z", archived=True
+                    ),
+                    notion_expense_page("e2", "2023-01-06", 65, "2023-01-07T11:00Z"),
+                ]
+            },
+        )
+        result = await sync_expense_mirror(full_sweep=False)
+        self.assertEqual(result, {"updated": 1, "removed": 1})
+        query = mock_request.await_args.kwargs["json"]
+        self.assertEqual(
+            query["filter"]["last_edited_time"]["on_or_after"], "2023-01-06T10:00Z"
+        )
+        expenses = get_mirrored_expenses("2023-01-01", "2023-01-31")
+        self.assertEqual([row["amount"] for row in expenses], [65])
+
+    def test_monthly_report_aggregates_locally(self):
+        record_budget("Jedzenie", "2022-02", 500)
+        record_expense("2022-02-01", "Jedzenie", "Konto1", 100, "Zakupy")
+        record_expense("2022-02-10", "Jedzenie", "Konto2", 40, "Obiad")
+        record_expense("2022-02-11", "Transport", "Konto1", 140, "Paliwo")
+
+        report = build_monthly_report("2022-02")
+        self.assertEqual(report["total"], 280)
+        self.assertEqual(report["by_category"], [("Jedzenie", 140), ("Transport", 140)])
+        self.assertEqual(report["by_account"], [("Konto1", 240), ("Konto2", 40)])
+        self.assertEqual(report["budgets"], [("Jedzenie", 500, 140)])
+        self.assertEqual(report["daily_burn"], 10)
+        self.assertIs(build_monthly_report("2022-02"), report)
+
+        record_expense("2022-02-12", "Transport", "Konto1", 20, "Bilet")
+        self.assertEqual(build_monthly_report("2022-02")["total"], 300)
+
+        # Budżet ustawiony lub zasiany z backendu po zbudowaniu raportu
+        record_budget("Jedzenie", "2022-02", 600)
+        seed_ledger_budget("Transport", "2022-02", 200, 200)
+        self.assertEqual(
+            build_monthly_report("2022-02")["budgets"],
+            [("Jedzenie", 600, 140), ("Transport", 200, 160)],
+        )
+
+    @patch("main.get_budget_from_airtable", new_callable=AsyncMock)
+    @patch("main.get_airtable_table")
+    async def test_csv_import_is_written_in_batches(self, mock_table, mock_get):
+        with get_db() as db:
+            db.execute("DELETE FROM outbox")
+        lines = ["Data operacji;Kategoria;Kwota;Opis"]
+        lines += [f"{day:02d}.01.2021;Jedzenie;-10,50;Sklep" for day in range(1, 21)]
+        lines += ["05.01.2021;Transport;-30;Bilet", "zła data;Transport;1;x", ""]
+        lines += ["06.01.2021;Transport;-20;Bilet", "07.01.2021;Transport;-5;Bus"]
+        lines += ["10.01.2021;Wynagrodzenie;5000,00;Pensja"]
+        expenses, errors = parse_expense_csv(lines, default_account="Konto1")
+        self.assertEqual(len(expenses), 23)
+        # Zła data i wpływ (kwota dodatnia w pliku z obciążeniami ujemnymi)
+        self.assertEqual(errors, [23, 27])
+        unsigned, _ = parse_expense_csv(["Data;Kategoria;Kwota", "2021-01-02;Kino;30"])
+        self.assertEqual([e["amount"] for e in unsigned], [30])
+        self.assertEqual(expenses[0]["date"], "2021-01-01")
+        self.assertEqual(expenses[0]["amount"], 10.5)
+        self.assertEqual(expenses[0]["account"], "Konto1")
+
+        record_budget("Jedzenie", "2021-01", 500)
+        remaining = record_expenses(expenses, backends=("airtable",))
+        self.assertEqual(remaining[("Jedzenie", "2021-01")], 290)
+        self.assertIsNone(remaining[("Transport", "2021-01")])
+        # 3 paczki wydatków i po jednej synchronizacji na (kategoria, miesiąc)
+        self.assertEqual(pending_outbox_count(), 5)
+
+        table = mock_table.return_value
+        table.batch_create.side_effect = lambda records: records
+        table.batch_update.return_value = []
+        mock_get.return_value = airtable_budget_record("rec1", "Jedzenie", 500)
+        summary = await flush_outbox()
+        self.assertEqual(summary["airtable"], {"delivered": 5, "failed": 0})
+        self.assertEqual(
+            [len(c.args[0]) for c in table.batch_create.call_args_list], [10, 10, 3]
+        )
+        table.batch_update.assert_called_once()
+
+    @patch("main.add_expense_to_notion", new_callable=AsyncMock)
+    async def test_notion_batch_retry_skips_linked_expenses(self, mock_add):
+        with get_db() as db:
+            db.execute("DELETE FROM outbox")
+        expenses = [
+            {
+                "date": f"2021-02-0{day}",
+                "category": "Jedzenie",
+                "account": "Konto1",
+                "amount": day,
+                "description": "Obiad",
+            }
+            for day in range(1, 4)
+        ]
+        record_expenses(expenses, backends=("notion",))
+        mock_add.side_effect = [
+            (200, {"id": "imp1"}),
+            (502, {}),
+            (200, {"id": "imp3"}),
+            (200, {"id": "imp2"}),
+        ]
+        summary = await flush_outbox()
+        self.assertEqual(summary["notion"]["failed"], 1)
+
+        get_db().execute("UPDATE outbox SET next_attempt_at = 0")
+        with patch("main.get_budget_from_notion", new_callable=AsyncMock) as get:
+            get.return_value = None
+            await flush_outbox()
+        self.assertEqual(mock_add.await_count, 4)
+        self.assertEqual(mock_add.await_args.args[0], "2021-02-02")
+        self.assertEqual(pending_outbox_count(), 0)
+
+    @patch("main.ensure_ledger_budget", new_callable=AsyncMock)
+    @patch("main.get_categories_from_notion", new_callable=AsyncMock)
+    async def test_quick_add_commits_message_as_one_batch(self, mock_get, _):
+        with get_db() as db:
+            db.execute("DELETE FROM outbox")
+        mock_get.return_value = ["Jedzenie", "Transport"]
+        update = MagicMock()
+        update.message.reply_text = AsyncMock()
+        context = MagicMock(user_data={}, job_queue=None)
+
+        update.message.text = "12,5 jedzenie Konto1 Bułki\n4 Kino Konto1"
+        await handle_budget_input(update, context)
+        self.assertIn(
+            "nieznana kategoria Kino", update.message.reply_text.call_args[0][0]
+        )
+        self.assertEqual(pending_outbox_count(), 0)
+
+        update.message.text = (
+            "12,5 jedzenie Konto1 Bułki\n\n30 Jedzenie Konto2\n8 Transport Konto1 Bilet"
+        )
+        await handle_budget_input(update, context)
+        reply = update.message.reply_text.call_args[0][0]
+        self.assertTrue(reply.startswith("Dodano wydatków: 3 na kwotę 50.5 PLN."))
+        self.assertEqual(update.message.reply_text.await_count, 2)
+        # Jedna paczka wydatków i po jednej synchronizacji na kategorię
+        self.assertEqual(pending_outbox_count(), 3)
+
+    @patch("main.notion_request", new_callable=AsyncMock)
+    async def test_export_streams_gzipped_csv(self, mock_request):
+        mock_request.side_effect = [
+            mock_response(
+                200,
+                {
+                    "results": [notion_expense_page("e1", "2020-01-05", 12.5, "t")],
+                    "has_more": True,
+                    "next_cursor": "c1",
+                },
+            ),
+            mock_response(
+                200,
+                {
+                    "results": [notion_expense_page("e2", "2020-11-30", 40, "t")],
+                    "has_more": False,
+                },
+            ),
+        ]
+        sent = {}
+
+        async def reply_document(document, filename, caption):
+            sent["filename"] = filename
+            sent["rows"] = gzip.decompress(document.read()).decode().splitlines()
+
+        update = MagicMock()
+        update.message.text = "/export 2020"
+        update.message.reply_document = reply_document
+        await export_expenses(update, MagicMock())
+
+        self.assertEqual(sent["filename"], "wydatki_2020-01-01_2020-12-31.csv.gz")
+        self.assertEqual(
+            sent["rows"],
+            [
+                "Data,Kategoria,Konto,Kwota,Opis",
+                "2020-01-05,Jedzenie,Konto1,12.5,Obiad",
+                "2020-11-30,Jedzenie,Konto1,40,Obiad",
+            ],
+        )
+        query = mock_request.await_args_list[0].kwargs["json"]
+        self.assertEqual(
+            query["filter"]["and"][1]["date"], {"on_or_before": "2020-12-31"}
+        )
+
+    @patch("main.EXPORT_MAX_BYTES", 64)
+    @patch("main.notion_request", new_callable=AsyncMock)
+    async def test_export_over_size_limit_is_refused(self, mock_request):
+        pages = [
+            notion_expense_page(f"big{i}", "2020-01-05", i, "t") for i in range(500)
+        ]
+        mock_request.return_value = mock_response(
+            200, {"results": pages, "has_more": False}
+        )
+        update = MagicMock()
+        update.message.text = "/export 2020"
+        update.message.reply_text = AsyncMock()
+        update.message.reply_document = AsyncMock()
+        await export_expenses(update, MagicMock())
+
+        update.message.reply_document.assert_not_awaited()
+        self.assertIn(
+            "Wybierz krótszy okres", update.message.reply_text.call_args[0][0]
+        )
+        self.assertEqual(export_period("2024-02", end=True), "2024-02-29")
+
+    @patch("main.get_http_client")
+    async def test_upstream_and_handler_latency_metrics(self, mock_client):
+        metrics.reset()
+        mock_client.return_value.request = AsyncMock(
+            side_effect=[
+                mock_response(200, {}),
+                mock_response(404, {}),
+                mock_response(200, {}),
+            ]
+        )
+        await backend_request("notion", "PATCH", "/pages/59833787-2cf9-4fdf-8782")
+        await backend_request("notion", "PATCH", "/pages/1234567890abcdef1234")
+
+        @instrument_handler
+        async def add_expense(update, context):
+            return await backend_request("airtable", "POST", "/Expenses")
+
+        await add_expense(None, None)
+        statuses = {
+            (labels["endpoint"], labels["status"]): histogram.count
+            for labels, histogram in metrics.series("upstream_request_seconds")
+        }
+        self.assertEqual(
+            statuses,
+            {("/pages/:id", 200): 1, ("/pages/:id", 404): 1, ("/Expenses", 200): 1},
+        )
+        self.assertIn(
+            'handler="add_expense",status="ok",le="+Inf"} 1', metrics.render()
+        )
+
+        update = MagicMock()
+        update.message.reply_text = AsyncMock()
+        update.effective_chat.id = 42
+        with patch("main.ADMIN_CHAT_IDS", {7}):
+            await get_stats(update, MagicMock())
+            self.assertEqual(
+                update.message.reply_text.await_args.args[0],
+                "Brak uprawnień do tej komendy.",
+            )
+            update.effective_chat.id = 7
+            await get_stats(update, MagicMock())
+        self.assertIn(
+            "add_expense: 1, 0,", update.message.reply_text.await_args.args[0]
+        )
+
+    def test_import_needs_no_configuration(self):
+        env = {
+            key: value
+            for key, value in os.environ.items()
+            if key not in BACKEND_REQUIRED_ENV["notion"] + ("AIRTABLE_TOKEN",)
+        }
+        result = subprocess.run(
+            [sys.executable, "-c", "import main; print(main.missing_env(['notion']))"],
+            env={**env, "BUDGET_DB_PATH": ":memory:"},
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(), "['NOTION_API_TOKEN']")
+
+    def test_airtable_only_deployment_still_needs_notion_token(self):
+        with patch("main.ENABLED_BACKENDS", ("airtable",)), patch.dict(
+            os.environ, {"NOTION_API_TOKEN": ""}
+        ):
+            with self.assertRaises(SystemExit) as raised:
+                main()
+        self.assertIn("NOTION_API_TOKEN", str(raised.exception))
+
+    def test_expense_mirror_runs_only_with_notion_backend(self):
+        for backends, scheduled in ((("notion",), True), (("airtable",), False)):
+            with patch("main.ENABLED_BACKENDS", backends):
+                application = build_application("1:token")
+            jobs = [job.name for job in application.job_queue.jobs()]
+            self.assertEqual("sync_expense_mirror" in jobs, scheduled)
+
+    @patch("main.notion_request", new_callable=AsyncMock)
+    async def test_warm_up_seeds_categories_and_budgets(self, mock_request):
+        category_cache.invalidate()
+        month = datetime.now().strftime("%Y-%m")
+        page = notion_budget_page("warm1", "Hobby", f"{month}-01", 80)
+        page["properties"]["Budżet"] = {"number": 100}
+
+        async def respond(method, path, json, params, **kwargs):
+            if json.get("filter"):
+                return mock_response(200, {"results": [page]})
+            return mock_response(200, {"results": [notion_page("Hobby")]})
+
+        mock_request.side_effect = respond
+        with patch("main.ENABLED_BACKENDS", ("notion",)):
+            await warm_up_caches()
+        self.assertEqual(category_cache.get(), ["Hobby"])
+        self.assertEqual(get_ledger_budget("Hobby", month), (100, 80))
+        self.assertEqual(lookup_budget_page("Hobby", month), ("warm1", 80))
+        self.assertIn("warmup_notion_budgets", startup_timings)
+
+    async def test_duplicate_updates_are_dropped(self):
+        def message_update(update_id, message_id):
+            update = MagicMock(update_id=update_id, callback_query=None)
+            update.effective_chat.id = 5
+            update.effective_message.message_id = message_id
+            return update
+
+        await drop_duplicate_updates(message_update(1, 77), None)
+        with self.assertRaises(ApplicationHandlerStop):
+            await drop_duplicate_updates(message_update(2, 77), None)
+        # Po restarcie (pusty LRU) duplikat wykrywa trwała tabela
+        processed_updates.clear()
+        with self.assertRaises(ApplicationHandlerStop):
+            await drop_duplicate_updates(message_update(1, 77), None)
+        await drop_duplicate_updates(message_update(3, 78), None)
+
+    @patch("main.get_http_client")
+    async def test_outbox_writes_carry_idempotency_key(self, mock_client):
+        with get_db() as db:
+            db.execute("DELETE FROM outbox")
+        mock_client.return_value.request = AsyncMock(
+            side_effect=[mock_response(502, {}), mock_response(200, {"id": "idem1"})]
+        )
+        record_expense(
+            "2019-01-01",
+            "Jedzenie",
+            "Konto1",
+            5,
+            "Obiad",
+            backends=("notion",),
+            idempotency_key="message:5:77",
+        )
+        with get_db() as db:
+            db.execute("DELETE FROM outbox WHERE kind = 'notion_remaining'")
+
+        await flush_outbox()
+        get_db().execute("UPDATE outbox SET next_attempt_at = 0")
+        await flush_outbox()
+        keys = [
+            c.kwargs["headers"]["Idempotency-Key"]
+            for c in mock_client.return_value.request.await_args_list
+        ]
+        self.assertEqual(keys, ["message:5:77", "message:5:77"])
+        self.assertEqual(pending_outbox_count(), 0)
+
+    @patch("main.get_http_client")
+    async def test_idempotency_key_only_on_creating_write(self, mock_client):
+        mock_client.return_value.request = AsyncMock(
+            side_effect=[
+                mock_response(200, {"results": [], "has_more": False}),
+                mock_response(200, {"id": "idem-budget"}),
+            ]
+        )
+        token = outbound_idempotency_key.set("outbox:42")
+        try:
+            await upsert_budget_in_notion("Idempotencja", "2018-03", 100, 100)
+        finally:
+            outbound_idempotency_key.reset(token)
+        query, create = mock_client.return_value.request.await_args_list
+        self.assertIn("/query", query.args[1])
+        self.assertNotIn("Idempotency-Key", query.kwargs.get("headers") or {})
+        self.assertEqual(create.kwargs["headers"]["Idempotency-Key"], "outbox:42")
+
+    @patch("main.get_categories_from_notion", new_callable=AsyncMock)
+    async def test_stale_keyboard_after_restart_is_not_misresolved(self, mock_get):
+        mock_get.return_value = ["Dom", "Jedzenie", "Transport"]
+        update = MagicMock()
+        update.message.reply_text = AsyncMock()
+        await set_budget(update, MagicMock())
+        markup = update.message.reply_text.await_args.kwargs["reply_markup"]
+        transport = markup.inline_keyboard[0][2].callback_data
+
+        for categories, expected in (
+            (["Dom", "Jedzenie", "Transport"], "Transport"),
+            (["Auto", "Dom", "Jedzenie", "Transport"], None),
+        ):
+            mock_get.return_value = categories
+            query = MagicMock(data=transport)
+            query.answer = AsyncMock()
+            query.edit_message_text = AsyncMock()
+            context = MagicMock(user_data={})
+            # Nowy proces - pusta pamięć wersji klawiatur
+            with patch("main.category_keyboards", CategoryKeyboards()):
+                await set_budget_callback(MagicMock(callback_query=query), context)
+            self.assertEqual(context.user_data.get("selected_category"), expected)
+
+    @patch("main.get_categories_from_notion", new_callable=AsyncMock)
+    async def test_category_keyboard_is_paginated_and_compact(self, mock_get):
+        mock_get.return_value = [f"Kategoria z długą nazwą {i:02d}" for i in range(30)]
+        update = MagicMock()
+        update.message.reply_text = AsyncMock()
+        await set_budget(update, MagicMock())
+
+        text, markup = (
+            update.message.reply_text.await_args.args[0],
+            update.message.reply_text.await_args.kwargs["reply_markup"],
+        )
+        buttons = [b for row in markup.inline_keyboard for b in row]
+        self.assertEqual(text, "Wybierz kategorię (1/3):")
+        self.assertEqual(len(buttons), 13)
+        self.assertTrue(all(len(b.callback_data.encode()) <= 16 for b in buttons))
+
+        query = MagicMock()
+        query.answer = AsyncMock()
+        query.edit_message_text = AsyncMock()
+        query.data = buttons[-1].callback_data
+        context = MagicMock(user_data={})
+        await set_budget_callback(MagicMock(callback_query=query), context)
+        page = query.edit_message_text.await_args.kwargs["reply_markup"]
+        self.assertEqual(
+            query.edit_message_text.await_args.args[0], "Wybierz kategorię (2/3):"
+        )
+
+        query.data = page.inline_keyboard[0][1].callback_data
+        await set_budget_callback(MagicMock(callback_query=query), context)
+        self.assertEqual(
+            context.user_data["selected_category"], "Kategoria z długą nazwą 13"
+        )
+        mock_get.assert_awaited_once()
+
+    @patch("main.notion_request", new_callable=AsyncMock)
+    async def test_budget_input_asks_before_overwriting_backend_budget(
+        self, mock_request
+    ):
+        page = notion_budget_page("film1", "Film", "2019-02-01", 40)
+        page["properties"]["Budżet"] = {"number": 120}
+        mock_request.return_value = mock_response(200, {"results": [page]})
+        update = MagicMock()
+        update.message.text = "300 2019-02"
+        update.message.reply_text = AsyncMock()
+        context = MagicMock(user_data={"selected_category": "Film"}, job_queue=None)
+        with patch("main.ENABLED_BACKENDS", ("notion",)):
+            await handle_budget_input(update, context)
+        self.assertIn(
+            "w wysokości 120.0. Czy chcesz go nadpisać?",
+            update.message.reply_text.await_args.args[0],
+        )
+        self.assertEqual(context.user_data["pending_budget"], 300)
+        self.assertEqual(get_ledger_budget("Film", "2019-02"), (120, 40))
+
+    async def test_budget_input_rejects_invalid_month(self):
+        with get_db() as db:
+            db.execute("DELETE FROM outbox")
+        update = MagicMock()
+        update.message.text = "50 Jedzenie Konto1"
+        update.message.reply_text = AsyncMock()
+        context = MagicMock(user_data={"selected_category": "Jedzenie"}, job_queue=None)
+        await handle_budget_input(update, context)
+        update.message.reply_text.assert_awaited_once_with(
+            "Błędny format. Użyj: BUDŻET [YYYY-MM]"
+        )
+        self.assertIsNone(get_ledger_budget("Jedzenie", "Jedzeni"))
+        self.assertEqual(pending_outbox_count(), 0)
+
+    @patch("main.notion_request", new_callable=AsyncMock)
+    async def test_budget_overwrite_upserts_indexed_page(self, mock_request):
+        with get_db() as db:
+            db.execute("DELETE FROM outbox")
+        record_budget("Sport", "2018-06-01", 200)
+        record_expense("2018-06-03", "Sport", "Konto1", 50, "Basen")
+        remember_budget_page("Sport", "2018-06", "sport1", 150)
+
+        update = MagicMock()
+        update.message.text = "300 2018-06"
+        update.message.reply_text = AsyncMock()
+        context = MagicMock(user_data={"selected_category": "Sport"}, job_queue=None)
+        await handle_budget_input(update, context)
+        self.assertIn(
+            "Czy chcesz go nadpisać?", update.message.reply_text.await_args.args[0]
+        )
+        mock_request.assert_not_awaited()
+
+        query = MagicMock(data="yes")
+        query.answer = AsyncMock()
+        query.message.reply_text = AsyncMock()
+        await handle_budget_confirmation(
+            MagicMock(callback_query=query, update_id=9001), context
+        )
+        self.assertIn(
+            "200.0 -> 300.0. Pozostało: 250.0",
+            query.message.reply_text.await_args.args[0],
+        )
+        self.assertEqual(get_ledger_budget("Sport", "2018-06"), (300, 250))
+
+        page = notion_budget_page("sport1", "Sport", "2018-06-01", 250)
+        mock_request.return_value = mock_response(200, page)
+        with get_db() as db:
+            db.execute("DELETE FROM outbox WHERE kind != 'notion_budget'")
+        with patch("main.ENABLED_BACKENDS", ("notion",)):
+            await flush_outbox()
+        mock_request.assert_awaited_once_with(
+            "PATCH",
+            "/pages/sport1",
+            json={
+                "properties": {
+                    "Budżet": {"number": 300},
+                    "Pozostało": {"number": 250},
+                }
+            },
+        )
+
+    @patch("main.notion_request", new_callable=AsyncMock)
+    async def test_budget_upsert_creates_page_only_on_miss(self, mock_request):
+        mock_request.side_effect = [
+            mock_response(200, {"results": []}),
+            mock_response(200, {"id": "new1"}),
+        ]
+        status_code, _ = await upsert_budget_in_notion("Kino", "2018-07", 100, 80)
+        self.assertEqual(status_code, 200)
+        self.assertEqual(
+            [c.args[:2] for c in mock_request.await_args_list],
+            [
+                ("POST", f"/databases/{NOTION_BUDGET_DATABASE_ID}/query"),
+                ("POST", "/pages"),
+            ],
+        )
+        self.assertEqual(lookup_budget_page("Kino", "2018-07"), ("new1", 80))
+
+    @patch("main.get_budget_from_notion", new_callable=AsyncMock)
+    async def test_ledger_budget_miss_is_cached(self, mock_get):
+        mock_get.side_effect = [httpx.ConnectError("down"), None, None]
+        for _ in range(3):
+            await ensure_ledger_budget("BezBudżetu", "2018-09", backends=("notion",))
+        # Błąd nie jest zapamiętany, potwierdzony brak - tak
+        self.assertEqual(mock_get.await_count, 2)
+
+        await ensure_ledger_budget("BezBudżetu", "2018-09", ("notion",), fresh=True)
+        self.assertEqual(mock_get.await_count, 3)
+
+        record_budget("BezBudżetu", "2018-09", 50)
+        self.assertEqual(get_ledger_budget("BezBudżetu", "2018-09"), (50, 50))
+        self.assertNotIn(("BezBudżetu", "2018-09"), ledger_budget_misses)
+
+    @patch("main.notion_request", new_callable=AsyncMock)
+    async def test_budget_upsert_reuses_handler_miss(self, mock_request):
+        mock_request.side_effect = [
+            mock_response(200, {"results": []}),
+            mock_response(200, {"id": "new2"}),
+        ]
+        # Sprawdzenie nadpisania w /setbudget, potem zapis z kolejki
+        await ensure_ledger_budget("Teatr", "2018-08", backends=("notion",))
+        status_code, _ = await upsert_budget_in_notion("Teatr", "2018-08", 100, 100)
+        self.assertEqual(status_code, 200)
+        self.assertEqual(
+            [c.args[:2] for c in mock_request.await_args_list],
+            [
+                ("POST", f"/databases/{NOTION_BUDGET_DATABASE_ID}/query"),
+                ("POST", "/pages"),
+            ],
+        )
+
+    @patch("main.reconcile_month", new_callable=AsyncMock)
+    async def test_reconcile_schedule_survives_restarts(self, mock_reconcile):
+        with get_db() as db:
+            db.execute("DELETE FROM sync_state WHERE name = 'reconcile_last_run'")
+        self.assertEqual(reconcile_first_delay(), 60)
+
+        await reconcile_budgets()
+        # Restart tuż po przebiegu - następny po pełnym interwale od przebiegu,
+        # a nie od startu
+        self.assertAlmostEqual(reconcile_first_delay(), 86400, delta=5)
+        with patch("main.time.time", return_value=time.time() + 86000):
+            self.assertAlmostEqual(reconcile_first_delay(), 400, delta=5)
+        with patch("main.time.time", return_value=time.time() + 3 * 86400):
+            self.assertEqual(reconcile_first_delay(), 60)
+
+    def test_budget_alerts_fire_once_per_threshold(self):
+        early, later = datetime(2017, 3, 2), datetime(2017, 3, 10)
+        record_budget("Kawa", "2017-03", 100)
+        record_expense("2017-03-01", "Kawa", "Konto1", 50, "Ziarno")
+        self.assertEqual(budget_alerts("Kawa", "2017-03", early), [])
+
+        record_expense("2017-03-02", "Kawa", "Konto1", 35, "Kawiarnia")
+        self.assertEqual(
+            budget_alerts("Kawa", "2017-03", early),
+            ["Uwaga: wydano 85% budżetu kategorii Kawa (85.00 z 100.00 PLN)."],
+        )
+        record_expense("2017-03-02", "Kawa", "Konto1", 10, "Kawiarnia")
+        self.assertEqual(budget_alerts("Kawa", "2017-03", early), [])
+
+        alerts = budget_alerts("Kawa", "2017-03", later)
+        self.assertEqual(len(alerts), 1)
+        self.assertIn("wyniosą 294.50 PLN", alerts[0])
+
+        record_expense("2017-03-10", "Kawa", "Konto2", 20, "Ekspres")
+        self.assertIn("wydano 115%", budget_alerts("Kawa", "2017-03", later)[0])
+        self.assertIn(
+            "Kawa: 115.00 / 100.00 (115%), prognoza 356.50", format_digest(later)
+        )
+
+    def test_budget_alert_survives_reloading_totals(self):
+        early = datetime(2016, 8, 2)
+        record_budget("Herbata", "2016-08", 100)
+        record_expense("2016-08-01", "Herbata", "Konto1", 70, "Zapas")
+        self.assertEqual(budget_alerts("Herbata", "2016-08", early), [])
+
+        # Np. po restarcie albo synchronizacji kopii wydatków
+        budget_totals.invalidate(["2016-08"])
+        record_expense("2016-08-02", "Herbata", "Konto1", 15, "Dzbanek")
+        self.assertEqual(
+            budget_alerts("Herbata", "2016-08", early),
+            ["Uwaga: wydano 85% budżetu kategorii Herbata (85.00 z 100.00 PLN)."],
+        )
+
+    @patch("main.notion_request", new_callable=AsyncMock)
+    async def test_reconciliation_writes_back_only_drifted_rows(self, mock_request):
+        record_budget("Jedzenie", "2016-04", 500)
+        record_expense("2016-04-03", "Jedzenie", "Konto1", 100, "Zakupy")
+        with get_db() as db:
+            db.execute("DELETE FROM outbox")
+            db.execute(
+                "UPDATE budgets SET remaining = 123"
+                " WHERE category = 'Jedzenie' AND month = '2016-04'"
+            )
+
+        drifted = notion_budget_page("b1", "Jedzenie", "2016-04-01", 300)
+        correct = notion_budget_page("b2", "Transport", "2016-04-01", 200)
+        for page, budget in ((drifted, 500), (correct, 200)):
+            page["properties"]["Budżet"] = {"number": budget}
+        mock_request.side_effect = [
+            mock_response(200, {"results": [drifted, correct], "has_more": False}),
+            mock_response(
+                200,
+                {
+                    "results": [
+                        notion_expense_page("e1", "2016-04-03", 100, "2016-04-03"),
+                        notion_expense_page("e2", "2016-04-09", 50, "2016-04-09"),
+                    ],
+                    "has_more": False,
+                },
+            ),
+            mock_response(200, drifted),
+        ]
+
+        report = await reconcile_month("2016-04", backends=("notion",))
+        # Księga przejmuje kwotę policzoną z pełnej bazy wydatków Notion
+        self.assertEqual(report["ledger"], [("Jedzenie", 123, 350)])
+        self.assertEqual(
+            report["notion"].value["corrections"], [("Jedzenie", 300, 350)]
+        )
+        self.assertEqual(get_ledger_budget("Jedzenie", "2016-04"), (500, 350))
+        self.assertEqual(mock_request.await_count, 3)
+        self.assertEqual(mock_request.await_args.args, ("PATCH", "/pages/b1"))
+        self.assertEqual(
+            mock_request.await_args.kwargs["json"],
+            {"properties": {"Pozostało": {"number": 350}}},
+        )
+
+    @patch("main.CIRCUIT_MIN_CALLS", 2)
+    @patch("main.get_http_client")
+    async def test_open_circuit_fails_fast_and_serves_stale_categories(
+        self, mock_client
+    ):
+        circuit_breakers["notion"].reset()
+        self.addCleanup(circuit_breakers["notion"].reset)
+        mock_client.return_value.request = AsyncMock(
+            side_effect=httpx.ConnectTimeout("timeout")
+        )
+        with patch.object(category_cache, "ttl", 0):
+            category_cache.set(["Kino", "Teatr"])
+
+        for _ in range(2):
+            with self.assertRaises(httpx.ConnectTimeout):
+                await backend_request("notion", "GET", "/users/me")
+        with self.assertRaises(CircuitOpenError):
+            await backend_request("notion", "GET", "/users/me")
+        self.assertEqual(mock_client.return_value.request.await_count, 2)
+
+        update = MagicMock()
+        update.message.reply_text = AsyncMock()
+        await get_categories(update, MagicMock())
+        reply = update.message.reply_text.await_args.args[0]
+        self.assertIn("Kino\nTeatr", reply)
+        self.assertIn("Nieaktualna lista z pamięci podręcznej", reply)
+        self.assertEqual(mock_client.return_value.request.await_count, 2)
+
+    @patch("main.HEDGE_DELAY", 0.01)
+    @patch("main.notion_request", new_callable=AsyncMock)
+    async def test_slow_read_is_hedged(self, mock_request):
+        async def respond(method, path, **kwargs):
+            if mock_request.await_count == 1:
+                await asyncio.sleep(5)
+                return "slow"
+            return "fast"
+
+        mock_request.side_effect = respond
+        started = asyncio.get_running_loop().time()
+        self.assertEqual(await hedged_request("notion", "GET", "/users/me"), "fast")
+        self.assertLess(asyncio.get_running_loop().time() - started, 1)
+        self.assertEqual(mock_request.await_count, 2)
+
+    @patch("main.HEDGE_DELAY", 0.01)
+    @patch("main.CIRCUIT_MIN_CALLS", 2)
+    @patch.dict("main.rate_limiters", {"notion": RateLimiter(1000)})
+    @patch("main.get_http_client")
+    async def test_cancelled_hedges_do_not_open_circuit(self, mock_client):
+        breaker = circuit_breakers["notion"]
+        breaker.reset()
+        self.addCleanup(breaker.reset)
+        calls = []
+
+        async def request(method, path, **kwargs):
+            # Pierwsza kopia odpowiada po 50 ms, zdublowana jeszcze później
+            calls.append(path)
+            await asyncio.sleep(0.05 if len(calls) % 2 else 0.2)
+            return mock_response(200, {})
+
+        mock_client.return_value.request = request
+        trips = breaker.trips
+        for _ in range(12):
+            response = await hedged_request("notion", "GET", "/users/me")
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(calls), 24)
+        self.assertEqual(breaker.state, "closed")
+        self.assertEqual(breaker.trips, trips)
+
 
 if __name__ == "__main__":
     unittest.main()